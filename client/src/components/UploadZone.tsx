@@ -99,7 +99,7 @@ export function UploadZone({ onFileSelect }: UploadZoneProps) {
             Drag your old photo here or click to browse
           </p>
           <p className="text-sm text-muted-foreground">
-            Supported formats: JPG, PNG up to 10MB
+            Supported formats: JPG, PNG, TIFF up to 100MB
           </p>
         </div>
 
@@ -0,0 +1,213 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import zipfile
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from executor import PoolSaturated
+from uploads import SpooledUpload
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+BatchItem = Tuple[str, Callable[[], Union[bytes, SpooledUpload]]]
+
+
+def is_zip_upload(filename: Optional[str], content_type: Optional[str]) -> bool:
+    return (content_type or '').endswith('zip') or (filename or '').lower().endswith('.zip')
+
+
+def _too_large(max_file_size: int) -> str:
+    return f"File size must be less than {max_file_size // (1024 * 1024)}MB"
+
+
+def _read_entry(archive: zipfile.ZipFile, info: zipfile.ZipInfo, max_file_size: Optional[int]) -> bytes:
+    if max_file_size is None:
+        return archive.read(info)
+    if info.file_size > max_file_size:
+        raise ValueError(_too_large(max_file_size))
+    # The header size can lie; one byte past the limit is enough to reject it
+    with archive.open(info) as entry:
+        return entry.read(max_file_size + 1)
+
+
+def iter_zip_images(archive: zipfile.ZipFile, max_file_size: Optional[int] = None) -> Iterator[BatchItem]:
+    """
+    List image entries of an archive; each entry is read only when processed
+
+    Args:
+        archive: The uploaded archive
+        max_file_size: Entries that decompress to more than this are
+            rejected without inflating them fully
+    """
+    for info in archive.infolist():
+        name = info.filename
+        if info.is_dir() or name.startswith('__MACOSX/') or os.path.basename(name).startswith('.'):
+            continue
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        yield name, (lambda info=info: _read_entry(archive, info, max_file_size))
+
+
+class BatchResult:
+    """Outcome of one image of a batch"""
+
+    def __init__(self, index: int, filename: str, data: Optional[bytes] = None,
+                 error: Optional[str] = None):
+        self.index = index
+        self.filename = filename
+        self.data = data
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def manifest_entry(self, output_name: Optional[str] = None) -> Dict[str, Any]:
+        entry = {"index": self.index, "filename": self.filename, "status": "ok" if self.ok else "error"}
+        if self.ok:
+            entry["output"] = output_name
+            entry["size"] = len(self.data)
+        else:
+            entry["error"] = self.error
+        return entry
+
+
+async def run_batch(items: Iterable[BatchItem], process: Callable[..., bytes], pool,
+                    parallelism: int, max_file_size: int,
+                    params: Dict[str, Any]) -> AsyncIterator[BatchResult]:
+    """
+    Restore many images with bounded parallelism, yielding each result as it finishes
+
+    Only `parallelism` inputs are held in memory at once. A failing image is
+    reported in its result and does not stop the batch.
+
+    Args:
+        items: (filename, read) pairs; read() returns the image bytes, or
+            the image spooled to disk, which is deleted once processed
+        process: Pipeline entry point, called as process(contents, **params),
+            or process(path, input_digest=..., **params) for spooled images
+        pool: executor.WorkerPool the pipelines run on
+        parallelism: Maximum number of images processed at the same time
+        max_file_size: Inputs larger than this are rejected individually
+        params: Pipeline options shared by every image
+    """
+    async def restore(index: int, filename: str, read: Callable[[], Union[bytes, SpooledUpload]]) -> BatchResult:
+        contents = None
+        try:
+            contents = await asyncio.to_thread(read)
+            if isinstance(contents, SpooledUpload):
+                source, options = contents.path, {**params, "input_digest": contents.digest}
+            elif len(contents) > max_file_size:
+                return BatchResult(index, filename, error=_too_large(max_file_size))
+            else:
+                source, options = contents, params
+            while True:
+                try:
+                    data = await pool.run(process, source, **options)
+                    return BatchResult(index, filename, data=data)
+                except PoolSaturated as e:
+                    # Batch work waits for interactive requests instead of failing
+                    await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"Batch item {filename} failed: {str(e)}")
+            return BatchResult(index, filename, error=str(e))
+        finally:
+            if isinstance(contents, SpooledUpload):
+                contents.close()
+
+    iterator = iter(enumerate(items))
+    in_flight = set()
+
+    def start_next() -> bool:
+        try:
+            index, (filename, read) = next(iterator)
+        except StopIteration:
+            return False
+        in_flight.add(asyncio.create_task(restore(index, filename, read)))
+        return True
+
+    try:
+        while len(in_flight) < parallelism and start_next():
+            pass
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                in_flight.discard(task)
+                start_next()
+                yield task.result()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object that hands written bytes to a generator"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _output_name(result: BatchResult, used: set, extension: str) -> str:
+    stem = os.path.splitext(os.path.basename(result.filename))[0] or 'image'
+    name = f"restored_{stem}{extension}"
+    if name in used:
+        name = f"restored_{stem}_{result.index}{extension}"
+    used.add(name)
+    return name
+
+
+async def stream_zip(results: AsyncIterator[BatchResult], extension: str = '.jpg') -> AsyncIterator[bytes]:
+    """
+    Stream results as a ZIP archive, one entry per finished image
+
+    Ends with manifest.ndjson listing every input and its status.
+
+    Args:
+        extension: File extension of the encoded results
+    """
+    sink = _ChunkSink()
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED)
+    manifest = []
+    used = set()
+
+    async for result in results:
+        output_name = None
+        if result.ok:
+            output_name = _output_name(result, used, extension)
+            archive.writestr(output_name, result.data)
+        manifest.append(result.manifest_entry(output_name))
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+
+    lines = ''.join(json.dumps(entry) + '\n' for entry in manifest)
+    archive.writestr('manifest.ndjson', lines, compress_type=zipfile.ZIP_DEFLATED)
+    archive.close()
+    yield sink.drain()
+
+
+async def stream_ndjson(results: AsyncIterator[BatchResult], extension: str = '.jpg') -> AsyncIterator[bytes]:
+    """Stream results as NDJSON, one line per finished image with the encoded image base64-encoded"""
+    used = set()
+    async for result in results:
+        output_name = _output_name(result, used, extension) if result.ok else None
+        entry = result.manifest_entry(output_name)
+        if result.ok:
+            entry["data"] = base64.b64encode(result.data).decode('ascii')
+        yield (json.dumps(entry) + '\n').encode('utf-8')
@@ -0,0 +1,467 @@
+"""
+Benchmark suite for the restoration pipeline.
+
+Runs individual AIPhotoProcessor stages and the full process_image pipeline
+over a corpus built from attached_assets/generated_images, upscaled to the
+requested sizes. Replicate is replaced by mock_model_server.py running in a
+separate process, so model latency is controlled and RSS measurements only
+cover the pipeline. Results are written as JSON that can be compared across
+commits:
+
+    python3 benchmark.py run --sizes 1,12,48 --repeat 5 --output before.json
+    python3 benchmark.py run --sizes 1,12,48 --repeat 5 --output after.json
+    python3 benchmark.py compare before.json after.json
+
+`startup` guards cold-start time instead: it imports the API module in
+fresh interpreters under `python -X importtime` and fails when the import
+exceeds a budget or loads a library that should only load on first use:
+
+    python3 benchmark.py startup --budget-ms 1000
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS = os.path.join(os.path.dirname(SERVER_DIR), 'attached_assets', 'generated_images')
+PERCENTILES = (50, 90, 95, 99)
+# Libraries the server imports on first use, never at startup
+LAZY_LIBRARIES = ('numpy', 'cv2', 'PIL', 'replicate', 'requests', 'onnxruntime')
+
+
+class RssSampler:
+    """Tracks the peak resident set size of this process while active"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    def current(self) -> int:
+        """Current RSS in bytes (peak RSS of the process where /proc is unavailable)"""
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self._page_size
+        except OSError:
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self) -> "RssSampler":
+        self.peak = self.current()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_server(latency: float, model_latency: List[str], jitter: float,
+                      seed: int) -> Tuple[subprocess.Popen, str]:
+    """Start mock_model_server.py in a child process and wait until it accepts connections"""
+    port = _free_port()
+    command = [sys.executable, os.path.join(SERVER_DIR, 'mock_model_server.py'),
+               '--port', str(port), '--latency', str(latency),
+               '--jitter', str(jitter), '--seed', str(seed), '--max-files', '16']
+    for value in model_latency:
+        command += ['--model-latency', value]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Mock model server exited during startup")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("Mock model server did not start")
+
+
+def load_sources(directory: str, limit: Optional[int] = None) -> List[Tuple[str, str]]:
+    """List the corpus source images as (name, path) pairs in a stable order"""
+    names = sorted(n for n in os.listdir(directory) if n.lower().endswith(('.png', '.jpg', '.jpeg')))
+    if limit:
+        names = names[:limit]
+    if not names:
+        raise ValueError(f"No images found in {directory}")
+    return [(os.path.splitext(n)[0], os.path.join(directory, n)) for n in names]
+
+
+def resize_to_megapixels(image: np.ndarray, megapixels: float) -> np.ndarray:
+    """Resize keeping the aspect ratio so the image has about `megapixels` million pixels"""
+    height, width = image.shape[:2]
+    factor = (megapixels * 1e6 / (width * height)) ** 0.5
+    new_width = max(8, int(round(width * factor / 8)) * 8)
+    new_height = max(8, int(round(height * factor / 8)) * 8)
+    interpolation = cv2.INTER_CUBIC if factor > 1 else cv2.INTER_AREA
+    return cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    values = np.asarray(latencies, dtype=np.float64)
+    summary = {
+        "min": float(values.min()),
+        "mean": float(values.mean()),
+        "max": float(values.max())
+    }
+    for p in PERCENTILES:
+        summary[f"p{p}"] = float(np.percentile(values, p))
+    return {k: round(v, 6) for k, v in summary.items()}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_cases(processor, transfer_cls) -> Dict[str, Callable[[Dict[str, Any]], Any]]:
+    """
+    Benchmark cases, each called with a fixture dict holding the RGB image
+    ('rgb'), its grayscale copy as RGB ('gray') and its PNG encoding ('png')
+    """
+    from image_analysis import ImageAnalyzer
+    analyzer = processor.analyzer or ImageAnalyzer()
+
+    def output(image_format: str) -> Callable[[Dict[str, Any]], bytes]:
+        settings = processor.encoder.resolve({'format': image_format})
+        return lambda fixture: processor.encoder.encode(fixture['rgb'], settings)
+
+    def data_uri_encoding(fixture: Dict[str, Any]) -> str:
+        # A fresh transfer each time so the encode memo never short-circuits
+        return transfer_cls(mode='data_uri', reuse_entries=0).prepare_input(fixture['rgb'], 'benchmark')
+
+    def process_image(fixture: Dict[str, Any]) -> bytes:
+        # Every run encodes and uploads its inputs as a new request would
+        processor.transfer.clear()
+        fixture['trace'] = fixture['trace_cls']()
+        return processor.process_image(fixture['png'], trace=fixture['trace'])
+
+    cases = {
+        'is_grayscale': lambda f: processor._is_grayscale(f['gray']),
+        'image_analysis': lambda f: analyzer.analyze(f['rgb']),
+        'inpainting': lambda f: processor._apply_basic_inpainting(f['rgb']),
+        'inpainting_no_denoise': lambda f: processor._apply_basic_inpainting(f['rgb'], denoise=False),
+        'damage_detection': lambda f: processor.damage.detect(f['rgb']),
+        'fallback_colorization': lambda f: processor._fallback_colorization(f['gray']),
+        'fallback_super_resolution': lambda f: processor._fallback_super_resolution(f['rgb'], 2),
+        'data_uri_encoding': data_uri_encoding,
+        'jpeg_output': output('jpeg'),
+        'process_image': process_image,
+    }
+    if 'webp' in processor.encoder.formats:
+        cases['webp_output'] = output('webp')
+    return cases
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    mock = None
+    if args.mock:
+        mock, base_url = start_mock_server(args.latency, args.model_latency or [], args.jitter, args.seed)
+        # Must be set before replicate builds its HTTP client
+        os.environ['REPLICATE_BASE_URL'] = base_url
+        os.environ['REPLICATE_POLL_INTERVAL'] = '0.05'
+        logger.info(f"Using mock model server at {base_url} (latency {args.latency}s)")
+    os.environ.setdefault('PHOTO_CACHE', '0')
+
+    from photo_processor import AIPhotoProcessor
+    from image_transfer import ImageTransfer
+    from metrics import PipelineTrace
+
+    processor = AIPhotoProcessor(api_key='mock' if args.mock else None)
+    if not args.mock:
+        # Ignore any token in the environment so every stage takes the local path
+        processor.api_key = None
+    cases = build_cases(processor, ImageTransfer)
+    selected = args.cases.split(',') if args.cases else list(cases)
+    unknown = [name for name in selected if name not in cases]
+    if unknown:
+        raise SystemExit(f"Unknown case(s): {', '.join(unknown)}; choose from {', '.join(cases)}")
+
+    sizes = [float(s) for s in args.sizes.split(',')]
+    sources = load_sources(args.corpus, args.images)
+    samples: Dict[Tuple[str, float], Dict[str, Any]] = {}
+    sampler = RssSampler()
+
+    try:
+        for size in sizes:
+            for source_name, path in sources:
+                rgb = resize_to_megapixels(np.asarray(Image.open(path).convert('RGB')), size)
+                gray = cv2.cvtColor(cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY), cv2.COLOR_GRAY2RGB)
+                fixture = {"rgb": rgb, "gray": gray, "trace_cls": PipelineTrace}
+                if 'process_image' in selected:
+                    fixture['png'] = cv2.imencode('.png', cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR),
+                                                  [cv2.IMWRITE_PNG_COMPRESSION, 1])[1].tobytes()
+                megapixels = rgb.shape[0] * rgb.shape[1] / 1e6
+                logger.info(f"{source_name} at {size} MP ({rgb.shape[1]}x{rgb.shape[0]})")
+
+                for name in selected:
+                    fn = cases[name]
+                    entry = samples.setdefault((name, size), {
+                        "latencies": [], "cpu": [], "megapixels": [], "peak_rss": 0,
+                        "rss_growth": 0, "stages": {}
+                    })
+                    for _ in range(args.warmup):
+                        fn(fixture)
+                    gc.collect()
+                    baseline = sampler.current()
+                    with sampler:
+                        for _ in range(args.repeat):
+                            cpu_start = time.process_time()
+                            start = time.perf_counter()
+                            fn(fixture)
+                            entry["latencies"].append(time.perf_counter() - start)
+                            entry["cpu"].append(time.process_time() - cpu_start)
+                            entry["megapixels"].append(megapixels)
+                            for record in getattr(fixture.get('trace'), 'stages', []):
+                                entry["stages"].setdefault(record.name, []).append(record.wall_s)
+                    fixture.pop('trace', None)
+                    entry["peak_rss"] = max(entry["peak_rss"], sampler.peak)
+                    entry["rss_growth"] = max(entry["rss_growth"], sampler.peak - baseline)
+                del rgb, gray, fixture
+                gc.collect()
+    finally:
+        processor.http.close()
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+
+    results = []
+    for (name, size), entry in samples.items():
+        total = sum(entry["latencies"])
+        results.append({
+            "case": name,
+            "size_mp": size,
+            "runs": len(entry["latencies"]),
+            "latency_s": summarize(entry["latencies"]),
+            "cpu_s_mean": round(float(np.mean(entry["cpu"])), 6),
+            "throughput": {
+                "images_per_s": round(len(entry["latencies"]) / total, 4) if total else None,
+                "megapixels_per_s": round(sum(entry["megapixels"]) / total, 4) if total else None
+            },
+            "peak_rss_mb": round(entry["peak_rss"] / 2 ** 20, 1),
+            "rss_growth_mb": round(entry["rss_growth"] / 2 ** 20, 1),
+            "stages_p50_s": {stage: round(float(np.median(times)), 6)
+                             for stage, times in entry["stages"].items()}
+        })
+
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__
+        },
+        "config": {
+            "sizes_mp": sizes,
+            "cases": selected,
+            "images": [name for name, _ in sources],
+            "repeat": args.repeat,
+            "warmup": args.warmup,
+            "mock": args.mock,
+            "latency_s": args.latency,
+            "model_latency": args.model_latency or [],
+            "jitter_s": args.jitter
+        },
+        "results": results
+    }
+
+
+def print_results(report: Dict[str, Any]) -> None:
+    print(f"{'case':28} {'MP':>5} {'runs':>5} {'p50 s':>9} {'p95 s':>9} {'p99 s':>9} "
+          f"{'MP/s':>8} {'peak MB':>8}")
+    for r in report["results"]:
+        latency = r["latency_s"]
+        print(f"{r['case']:28} {r['size_mp']:>5g} {r['runs']:>5} {latency['p50']:>9.4f} "
+              f"{latency['p95']:>9.4f} {latency['p99']:>9.4f} "
+              f"{r['throughput']['megapixels_per_s'] or 0:>8.2f} {r['peak_rss_mb']:>8.1f}")
+
+
+def compare(baseline_path: str, current_path: str, metric: str, threshold: float) -> int:
+    """
+    Print the change of `metric` between two result files
+
+    Returns:
+        Number of cases slower than the baseline by more than `threshold`
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    before = {(r["case"], r["size_mp"]): r for r in baseline["results"]}
+    regressions = 0
+    print(f"baseline {baseline['meta'].get('commit')} -> current {current['meta'].get('commit')} ({metric})")
+    print(f"{'case':28} {'MP':>5} {'before s':>10} {'after s':>10} {'change':>8} {'peak MB':>15}")
+    for r in current["results"]:
+        old = before.get((r["case"], r["size_mp"]))
+        if old is None:
+            print(f"{r['case']:28} {r['size_mp']:>5g} {'-':>10} {r['latency_s'][metric]:>10.4f}")
+            continue
+        a, b = old["latency_s"][metric], r["latency_s"][metric]
+        change = (b - a) / a if a else 0.0
+        flag = ''
+        if change > threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f"{r['case']:28} {r['size_mp']:>5g} {a:>10.4f} {b:>10.4f} {change:>+8.1%} "
+              f"{old['peak_rss_mb']:>7.1f}->{r['peak_rss_mb']:<7.1f}{flag}")
+    return regressions
+
+
+def import_times(module: str) -> List[Tuple[int, int, str]]:
+    """
+    Import `module` in a fresh interpreter under -X importtime
+
+    Returns:
+        (depth, cumulative microseconds, name) of every module `module`
+        imported, itself last (modules the interpreter loads at startup
+        are left out)
+    """
+    with tempfile.TemporaryDirectory() as job_dir:
+        env = {**os.environ, 'PHOTO_JOB_DIR': job_dir, 'PYTHONPATH': SERVER_DIR}
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                   cwd=SERVER_DIR, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr[-2000:]}")
+    entries = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        entries.append(((len(name) - len(name.lstrip())) // 2, int(cumulative), name.strip()))
+    # A module's imports are listed before it, one level deeper
+    end = next(i for i, (depth, _, name) in enumerate(entries) if depth == 0 and name == module)
+    start = end
+    while start > 0 and entries[start - 1][0] > 0:
+        start -= 1
+    return entries[start:end + 1]
+
+
+def startup(module: str, budget_ms: float, repeat: int) -> int:
+    """
+    Check the cold import time of `module` against a budget
+
+    Returns:
+        Number of failed checks: the best of `repeat` imports over budget,
+        and each of LAZY_LIBRARIES imported at startup
+    """
+    runs = [import_times(module) for _ in range(max(1, repeat))]
+    totals = [entries[-1][1] for entries in runs]
+    best = runs[totals.index(min(totals))]
+
+    print(f"import {module}: best {min(totals) / 1000:.1f} ms, worst {max(totals) / 1000:.1f} ms "
+          f"over {len(totals)} run(s) (budget {budget_ms:g} ms)")
+    # The module's direct imports, slowest first
+    children = sorted(((us, name) for depth, us, name in best if depth == 1), reverse=True)
+    for us, name in children[:8]:
+        print(f"  {name:32} {us / 1000:>8.1f} ms")
+
+    failures = 0
+    if min(totals) / 1000 > budget_ms:
+        failures += 1
+        print(f"OVER BUDGET by {min(totals) / 1000 - budget_ms:.1f} ms")
+    loaded = sorted({name.split('.')[0] for _, _, name in best} & set(LAZY_LIBRARIES))
+    if loaded:
+        failures += len(loaded)
+        print(f"EAGER IMPORTS: {', '.join(loaded)} should only load when first used")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the photo restoration pipeline")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="Run the benchmarks and write JSON results")
+    run_parser.add_argument('--sizes', default='1,12,48', help="Comma-separated image sizes in megapixels")
+    run_parser.add_argument('--cases', default=None, help="Comma-separated cases (default: all)")
+    run_parser.add_argument('--corpus', default=DEFAULT_CORPUS, help="Directory of source images")
+    run_parser.add_argument('--images', type=int, default=None, help="Use only the first N source images")
+    run_parser.add_argument('--repeat', type=int, default=3, help="Measured runs per image and case")
+    run_parser.add_argument('--warmup', type=int, default=1, help="Unmeasured runs per image and case")
+    run_parser.add_argument('--no-mock', dest='mock', action='store_false',
+                            help="Run process_image without models (OpenCV fallbacks only)")
+    run_parser.add_argument('--latency', type=float, default=0.5, help="Mock model latency in seconds")
+    run_parser.add_argument('--model-latency', action='append', metavar='MODEL=SECONDS',
+                            help="Per-model mock latency, e.g. swinir=2 (repeatable)")
+    run_parser.add_argument('--jitter', type=float, default=0.0, help="Random extra mock latency in seconds")
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', default=None, help="Write JSON results to this file")
+    run_parser.add_argument('--verbose', action='store_true', help="Log every pipeline stage")
+
+    compare_parser = commands.add_parser('compare', help="Compare two result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--metric', default='p50', choices=['min', 'mean', 'max'] + [f"p{p}" for p in PERCENTILES])
+    compare_parser.add_argument('--threshold', type=float, default=0.10,
+                                help="Relative slowdown reported as a regression (default 0.10)")
+
+    startup_parser = commands.add_parser('startup', help="Check the API's cold import time against a budget")
+    startup_parser.add_argument('--module', default='photo_api', help="Module to import (default photo_api)")
+    startup_parser.add_argument('--budget-ms', type=float, default=1000.0,
+                                help="Largest acceptable import time in milliseconds (default 1000)")
+    startup_parser.add_argument('--repeat', type=int, default=3, help="Imports to take the best of")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.command == 'run' else logging.WARNING)
+    if not getattr(args, 'verbose', False):
+        for name in ('photo_processor', 'image_transfer', 'httpx'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    if args.command == 'compare':
+        regressions = compare(args.baseline, args.current, args.metric, args.threshold)
+        sys.exit(1 if regressions else 0)
+    if args.command == 'startup':
+        sys.exit(1 if startup(args.module, args.budget_ms, args.repeat) else 0)
+
+    report = run(args)
+    print_results(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
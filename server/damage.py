@@ -0,0 +1,311 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+# Repair methods for the damaged pixels, with rough costs the planner uses:
+# seconds per megapixel of repair regions (the mask's padded bounding boxes).
+# OpenCV flags are named, so reading the table does not load OpenCV
+METHODS = {
+    'telea': {'flag': 'INPAINT_TELEA', 'per_region_mp_s': 2.0},
+    'ns': {'flag': 'INPAINT_NS', 'per_region_mp_s': 2.5},
+    'bilateral': {'flag': None, 'per_region_mp_s': 0.3},
+    'median': {'flag': None, 'per_region_mp_s': 0.05},
+}
+DEFAULT_METHOD = 'telea'
+# Detection (top-hat, line openings, components) per image megapixel
+DETECT_S_PER_MP = 0.12
+# Whole-image NL-means denoising per megapixel, run only on noisy photos
+DENOISE_S_PER_MP = 2.4
+# Repair regions cover the damage plus its padding; on typical scans they
+# are this many times the mask area
+REGION_GROWTH = 12
+
+# Bumped when detection changes, so cached masks are recomputed
+MASK_VERSION = 1
+
+LINE_ANGLES = (0, 22.5, 45, 67.5, 90, 112.5, 135, 157.5)
+
+
+def _line_kernel(length: int, angle: float) -> np.ndarray:
+    """One-pixel line of `length` at `angle` degrees, as a structuring element"""
+    kernel = np.zeros((length, length), np.uint8)
+    center = (length - 1) / 2.0
+    dx, dy = np.cos(np.radians(angle)) * center, np.sin(np.radians(angle)) * center
+    cv2.line(kernel, (int(round(center - dx)), int(round(center - dy))),
+             (int(round(center + dx)), int(round(center + dy))), 1, 1)
+    return kernel
+
+
+class DamageMask:
+    """
+    Scratch and dust pixels of one image, kept as mask crops of the regions
+    that contain them, so a mask for a large photo stays small
+    """
+
+    def __init__(self, shape: Tuple[int, int], regions: List[Tuple[int, int, int, int, np.ndarray]],
+                 scratch_pixels: int, dust_pixels: int):
+        """
+        Args:
+            shape: (height, width) of the image
+            regions: (y0, y1, x0, x1, mask crop) of each repair region
+            scratch_pixels: Pixels detected as scratches
+            dust_pixels: Pixels detected as dust
+        """
+        self.shape = shape
+        self.regions = regions
+        self.scratch_pixels = scratch_pixels
+        self.dust_pixels = dust_pixels
+
+    @property
+    def pixels(self) -> int:
+        return self.scratch_pixels + self.dust_pixels
+
+    @property
+    def region_pixels(self) -> int:
+        return sum((y1 - y0) * (x1 - x0) for y0, y1, x0, x1, _ in self.regions)
+
+    def full(self) -> np.ndarray:
+        """The mask at image size (for inspection; repairs use the crops)"""
+        mask = np.zeros(self.shape, np.uint8)
+        for y0, y1, x0, x1, crop in self.regions:
+            np.maximum(mask[y0:y1, x0:x1], crop, out=mask[y0:y1, x0:x1])
+        return mask
+
+    def as_dict(self) -> Dict[str, Any]:
+        pixels = float(self.shape[0] * self.shape[1])
+        return {
+            "scratch_pixels": self.scratch_pixels,
+            "dust_pixels": self.dust_pixels,
+            "regions": len(self.regions),
+            "region_fraction": round(self.region_pixels / pixels, 6) if pixels else 0.0
+        }
+
+    def to_bytes(self) -> bytes:
+        header = json.dumps({
+            "version": MASK_VERSION,
+            "shape": list(self.shape),
+            "regions": [[y0, y1, x0, x1] for y0, y1, x0, x1, _ in self.regions],
+            "scratch_pixels": self.scratch_pixels,
+            "dust_pixels": self.dust_pixels
+        }).encode('utf-8')
+        bits = [np.packbits(crop > 0).tobytes() for _, _, _, _, crop in self.regions]
+        return len(header).to_bytes(4, 'big') + header + b''.join(bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Optional["DamageMask"]:
+        """Decode a cached mask; None if it was written by another detector version"""
+        size = int.from_bytes(data[:4], 'big')
+        header = json.loads(data[4:4 + size].decode('utf-8'))
+        if header.get("version") != MASK_VERSION:
+            return None
+        offset = 4 + size
+        regions = []
+        for y0, y1, x0, x1 in header["regions"]:
+            count = (y1 - y0) * (x1 - x0)
+            length = (count + 7) // 8
+            bits = np.frombuffer(data, np.uint8, length, offset)
+            crop = np.unpackbits(bits, count=count).reshape(y1 - y0, x1 - x0) * np.uint8(255)
+            regions.append((y0, y1, x0, x1, crop))
+            offset += length
+        return cls(tuple(header["shape"]), regions, header["scratch_pixels"], header["dust_pixels"])
+
+
+class DamageRepair:
+    """
+    Scratch and dust removal that only touches the damage.
+
+    Detection finds thin features that differ from their surroundings
+    (top-hat and black-hat responses) and keeps:
+    - scratches: responses that survive an opening with a line element in
+      one of eight orientations, filtered to long thin components
+    - dust: tiny high-contrast specks in a quiet neighbourhood
+    Real edges are steps rather than thin ridges and barely respond, so
+    unlike a Canny mask they are left alone.
+
+    Repair runs per padded bounding region of the mask with OpenCV's
+    Telea or Navier-Stokes inpainting, or with a bilateral or median filter
+    whose output only replaces masked pixels.
+    """
+
+    def __init__(self, method: str = DEFAULT_METHOD, radius: int = 3, threshold: int = 40,
+                 ridge_size: int = 5, min_length: int = 15, max_width: float = 2.5,
+                 dust_area: int = 12, dust_contrast: int = 70, margin: int = 8):
+        """
+        Args:
+            method: Default repair method, one of METHODS
+            radius: Inpainting radius in pixels
+            threshold: Top-hat/black-hat response that counts as damage
+            ridge_size: Structuring element size; features thinner than this are candidates
+            min_length: Shortest scratch in pixels (grows with large images)
+            max_width: Largest area/length ratio of a scratch component
+            dust_area: Largest dust speck in pixels
+            dust_contrast: Smallest response at a dust speck's center
+            margin: Context pixels around each damaged area given to the repair
+
+        Raises:
+            ValueError: For an unknown method
+        """
+        if method not in METHODS:
+            raise ValueError(f"Inpaint method must be one of: {', '.join(METHODS)}")
+        self.method = method
+        self.radius = radius
+        self.threshold = threshold
+        self.ridge_size = ridge_size
+        self.min_length = min_length
+        self.max_width = max_width
+        self.dust_area = dust_area
+        self.dust_contrast = dust_contrast
+        self.margin = margin
+
+    @classmethod
+    def from_env(cls) -> "DamageRepair":
+        """Build from PHOTO_INPAINT_METHOD, PHOTO_INPAINT_RADIUS and PHOTO_DAMAGE_THRESHOLD"""
+        method = os.environ.get('PHOTO_INPAINT_METHOD', DEFAULT_METHOD)
+        if method not in METHODS:
+            logger.warning(f"Unknown inpaint method '{method}', using {DEFAULT_METHOD}")
+            method = DEFAULT_METHOD
+        return cls(
+            method=method,
+            radius=int(os.environ.get('PHOTO_INPAINT_RADIUS', '3')),
+            threshold=int(os.environ.get('PHOTO_DAMAGE_THRESHOLD', '40'))
+        )
+
+    def settings(self) -> Dict[str, Any]:
+        """Detection settings, for cache keys of detected masks"""
+        return {
+            "version": MASK_VERSION,
+            "threshold": self.threshold,
+            "ridge_size": self.ridge_size,
+            "min_length": self.min_length,
+            "max_width": self.max_width,
+            "dust_area": self.dust_area,
+            "dust_contrast": self.dust_contrast,
+            "pad": self.radius + self.margin
+        }
+
+    @property
+    def key(self) -> str:
+        """Short identifier of the detection settings, for stage cache keys"""
+        return hashlib.sha1(json.dumps(self.settings(), sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    def estimate(self, megapixels: float, damage_fraction: Optional[float] = None,
+                 method: Optional[str] = None, denoise: bool = False) -> float:
+        """
+        Rough seconds to detect and repair damage on an image
+
+        Args:
+            megapixels: Image size
+            damage_fraction: Share of damaged pixels (e.g. scratch plus dust
+                density from the analysis); a heavily damaged 2% when unknown
+            method: Repair method (defaults to the configured one)
+            denoise: Whether NL-means denoising runs first
+        """
+        if damage_fraction is None:
+            damage_fraction = 0.02
+        region_mp = megapixels * min(1.0, damage_fraction * REGION_GROWTH)
+        seconds = megapixels * DETECT_S_PER_MP + region_mp * METHODS[method or self.method]['per_region_mp_s']
+        if denoise:
+            seconds += megapixels * DENOISE_S_PER_MP
+        return seconds
+
+    def detect(self, image: np.ndarray) -> DamageMask:
+        """
+        Find scratches and dust
+
+        Args:
+            image: RGB or gray uint8 image
+        """
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        height, width = gray.shape
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (self.ridge_size, self.ridge_size))
+        response = cv2.max(cv2.morphologyEx(gray, cv2.MORPH_TOPHAT, kernel),
+                           cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, kernel))
+        _, candidates = cv2.threshold(response, self.threshold, 255, cv2.THRESH_BINARY)
+
+        # Line openings: a pixel survives if a line of min_length at some
+        # orientation fits inside the candidates through it
+        length = max(self.min_length, max(height, width) // 400)
+        lines = np.zeros_like(candidates)
+        for angle in LINE_ANGLES:
+            cv2.bitwise_or(lines, cv2.morphologyEx(candidates, cv2.MORPH_OPEN, _line_kernel(length, angle)),
+                           dst=lines)
+
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(candidates, connectivity=8)
+        if count <= 1:
+            return DamageMask((height, width), [], 0, 0)
+        x, y = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+        w, h, area = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT], stats[:, cv2.CC_STAT_AREA]
+
+        # Scratches: components holding a line, long and about as thin as one
+        on_line = np.zeros(count, bool)
+        on_line[np.unique(labels[lines > 0])] = True
+        extent = np.hypot(w, h)
+        scratches = on_line & (extent >= length) & (area / np.maximum(extent, 1) <= self.max_width)
+
+        # Dust: tiny, high-contrast specks in an otherwise quiet neighbourhood;
+        # clusters of small responses are texture (foliage, hair, fabric)
+        # The background label has no bounds when every pixel is a candidate
+        cx, cy = np.clip(x + w // 2, 0, width - 1), np.clip(y + h // 2, 0, height - 1)
+        busy = cv2.blur((candidates > 0).astype(np.float32), (15, 15))[cy, cx]
+        dust = (area <= self.dust_area) & ~scratches & (busy < 0.08) & (response[cy, cx] >= self.dust_contrast)
+        scratches[0] = dust[0] = False
+
+        keep = (scratches | dust).astype(np.uint8) * 255
+        mask = keep[labels]
+        # Cover the soft halo around each defect
+        mask = cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+        return DamageMask((height, width), self._regions(mask),
+                          int(area[scratches].sum()), int(area[dust].sum()))
+
+    def _regions(self, mask: np.ndarray) -> List[Tuple[int, int, int, int, np.ndarray]]:
+        """Padded bounding boxes of the mask, nearby damage merged into one region"""
+        height, width = mask.shape
+        pad = self.radius + self.margin
+        grown = cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_RECT, (2 * pad + 1, 2 * pad + 1)))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(grown, connectivity=8)
+        regions = []
+        for x, y, w, h, _ in stats[1:]:
+            y0, y1, x0, x1 = int(y), int(y + h), int(x), int(x + w)
+            crop = mask[y0:y1, x0:x1].copy()
+            if cv2.countNonZero(crop):
+                regions.append((y0, y1, x0, x1, crop))
+        return regions
+
+    def repair(self, image: np.ndarray, damage: DamageMask, method: Optional[str] = None) -> np.ndarray:
+        """
+        Repair the masked pixels of an RGB image
+
+        Args:
+            image: RGB uint8 image the mask was detected on; not modified
+            damage: Mask from detect()
+            method: One of METHODS (defaults to the configured one)
+
+        Returns:
+            A repaired copy, or `image` itself when nothing was detected
+        """
+        method = method or self.method
+        if not damage.regions:
+            return image
+        flag = METHODS[method]['flag']
+        out = image.copy()
+        for y0, y1, x0, x1, crop in damage.regions:
+            patch = out[y0:y1, x0:x1]
+            if flag is not None:
+                fixed = cv2.inpaint(patch, crop, self.radius, getattr(cv2, flag))
+            elif method == 'median':
+                fixed = cv2.medianBlur(patch, 2 * self.radius - 1 if self.radius > 1 else 3)
+            else:
+                fixed = cv2.bilateralFilter(patch, 2 * self.radius + 1, 60, 5)
+            np.copyto(patch, fixed, where=(crop > 0)[:, :, None])
+        return out
@@ -0,0 +1,258 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from shared_images import SharedImages
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturated(Exception):
+    """Raised when a worker pool has no free slot and its queue is full"""
+
+    def __init__(self, pool_name: str, retry_after: int):
+        super().__init__(f"Worker pool '{pool_name}' is at capacity")
+        self.pool_name = pool_name
+        self.retry_after = retry_after
+
+
+class WorkerPool:
+    """
+    Bounded executor with admission control.
+
+    At most `max_workers` calls run at once and at most `max_queue` more may
+    wait for a slot. Beyond that, run() is rejected immediately with
+    PoolSaturated so the API can answer with 503 instead of piling up work;
+    call() waits up to `queue_wait` seconds for room before it gives up.
+    """
+
+    def __init__(self, name: str, kind: str = 'thread', max_workers: int = 4,
+                 max_queue: int = 8, queue_wait: float = 30.0, retry_after: int = 5,
+                 start_method: str = 'forkserver', images: Optional[SharedImages] = None):
+        """
+        Args:
+            name: Pool name used in logs and error messages
+            kind: 'thread' for I/O-bound work, 'process' for CPU-bound work,
+                  or 'inline' to run calls in the caller's thread
+            max_workers: Maximum number of calls running concurrently
+            max_queue: Maximum number of calls waiting for a worker
+            queue_wait: Seconds call() waits for room in a full queue
+            retry_after: Seconds suggested to rejected clients
+            start_method: How 'process' workers are started. 'forkserver'
+                forks them from a clean helper process: forking the API
+                process itself while other threads are inside OpenCV can
+                leave a worker holding a lock that is never released
+            images: Shared image buffers; with a 'process' pool, large
+                array arguments and results of call() travel through them
+                instead of being pickled
+        """
+        if kind not in ('thread', 'process', 'inline'):
+            raise ValueError(f"Unknown pool kind: {kind}")
+
+        self.name = name
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.queue_wait = max(0.0, queue_wait)
+        self.retry_after = retry_after
+        self.start_method = start_method
+        self.images = images if kind == 'process' else None
+
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._pending = 0
+        self._rejected = 0
+
+    def _get_executor(self) -> Optional[Executor]:
+        if self.kind == 'inline':
+            return None
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.kind == 'process':
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.max_workers,
+                            mp_context=multiprocessing.get_context(self.start_method)
+                        )
+                    else:
+                        self._executor = ThreadPoolExecutor(
+                            max_workers=self.max_workers,
+                            thread_name_prefix=f"photo-{self.name}"
+                        )
+        return self._executor
+
+    def _acquire(self, wait: float = 0.0) -> None:
+        """Take a place among the running and queued calls, waiting up to `wait` seconds for one"""
+        capacity = self.max_workers + self.max_queue
+        with self._room:
+            if wait > 0:
+                self._room.wait_for(lambda: self._pending < capacity, timeout=wait)
+            if self._pending >= capacity:
+                self._rejected += 1
+                raise PoolSaturated(self.name, self.retry_after)
+            self._pending += 1
+
+    def _release(self, *_: Any) -> None:
+        with self._room:
+            self._pending -= 1
+            self._room.notify()
+
+    async def run(self, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        """
+        Run `fn` on the pool from async code without blocking the event loop
+
+        Raises:
+            PoolSaturated: If all workers are busy and the queue is full
+        """
+        self._acquire()
+        future = None
+        try:
+            executor = self._get_executor()
+            call = functools.partial(fn, *args, **kwargs)
+            if executor is None:
+                return call()
+            future = executor.submit(call)
+        finally:
+            if future is None:
+                self._release()
+        # A cancelled caller does not stop a call that already started, so
+        # the slot is only given back once the call itself has finished
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def call(self, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        """
+        Run `fn` on the pool from synchronous code and wait for the result.
+
+        Used for stages nested inside an already-admitted request, so it
+        waits up to `queue_wait` seconds for room in a full queue rather
+        than rejecting at once.
+
+        Raises:
+            PoolSaturated: If the queue stayed full for `queue_wait` seconds
+        """
+        self._acquire(self.queue_wait)
+        try:
+            executor = self._get_executor()
+            if executor is None:
+                return fn(*args, **kwargs)
+            if self.images is not None:
+                return self.images.call(executor.submit, fn, args, kwargs)
+            return executor.submit(fn, *args, **kwargs).result()
+        finally:
+            self._release()
+
+    def warm_up(self, fn: Optional[Callable] = None) -> int:
+        """
+        Start the pool's workers before the first request needs them
+
+        Args:
+            fn: Run once per worker slot as they start, e.g. to import what
+                the stages need (a process pool's workers are new interpreters)
+
+        Returns:
+            Number of times `fn` ran
+        """
+        executor = self._get_executor()
+        if fn is None:
+            return 0
+        if executor is None:
+            fn()
+            return 1
+        # Submitted together, so a process pool starts a worker for each
+        futures = [executor.submit(fn) for _ in range(self.max_workers)]
+        for future in futures:
+            future.result()
+        return len(futures)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "kind": self.kind,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queue_wait": self.queue_wait,
+                "pending": self._pending,
+                "rejected": self._rejected
+            }
+        if self.images is not None:
+            stats["shared_images"] = self.images.stats()
+        return stats
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if self.images is not None:
+            self.images.close()
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"Ignoring invalid {name}={value!r}, using {default}")
+        return default
+
+
+class WorkerPools:
+    """
+    The executor layer used by the API.
+
+    - io: thread pool that runs whole restore pipelines (remote model calls,
+      downloads) off the event loop
+    - cpu: process pool for OpenCV stages such as denoising and inpainting
+
+    Configured through environment variables:
+        PHOTO_IO_WORKERS, PHOTO_IO_QUEUE,
+        PHOTO_CPU_WORKERS, PHOTO_CPU_QUEUE, PHOTO_CPU_QUEUE_WAIT,
+        PHOTO_CPU_POOL (process|thread|inline),
+        PHOTO_CPU_START_METHOD (forkserver|spawn|fork), PHOTO_RETRY_AFTER,
+        PHOTO_SHARED_IMAGES, PHOTO_SHM_DIR, PHOTO_SHM_POOL_MB
+    """
+
+    def __init__(self, io: WorkerPool, cpu: WorkerPool):
+        self.io = io
+        self.cpu = cpu
+
+    @classmethod
+    def from_env(cls) -> "WorkerPools":
+        retry_after = _env_int('PHOTO_RETRY_AFTER', 5)
+        cpu_count = os.cpu_count() or 2
+
+        io = WorkerPool(
+            'io',
+            kind='thread',
+            max_workers=_env_int('PHOTO_IO_WORKERS', 8),
+            max_queue=_env_int('PHOTO_IO_QUEUE', 16),
+            retry_after=retry_after
+        )
+        cpu_kind = os.environ.get('PHOTO_CPU_POOL', 'process')
+        cpu = WorkerPool(
+            'cpu',
+            kind=cpu_kind,
+            max_workers=_env_int('PHOTO_CPU_WORKERS', cpu_count),
+            max_queue=_env_int('PHOTO_CPU_QUEUE', cpu_count * 2),
+            queue_wait=_env_int('PHOTO_CPU_QUEUE_WAIT', 30),
+            retry_after=retry_after,
+            start_method=os.environ.get('PHOTO_CPU_START_METHOD', 'forkserver'),
+            images=SharedImages.from_env() if cpu_kind == 'process' else None
+        )
+        return cls(io, cpu)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"io": self.io.stats(), "cpu": self.cpu.stats()}
+
+    def shutdown(self) -> None:
+        self.io.shutdown()
+        self.cpu.shutdown()
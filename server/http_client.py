@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import logging
+import os
+import random
+import threading
+import time
+from typing import Optional, Tuple
+
+from lazy import lazy_import
+
+requests = lazy_import('requests')
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadError(Exception):
+    """Raised when a model output could not be downloaded"""
+
+
+class DownloadClient:
+    """
+    Shared HTTP client for model output downloads.
+
+    One connection-pooled session is reused for every stage of every image,
+    so downloads skip the TCP and TLS handshake after the first request.
+    Bodies are streamed into a buffer preallocated from Content-Length, and
+    failed attempts (including connection drops mid-body) are retried with
+    exponential backoff. The session (and requests itself) is set up on
+    the first download.
+    """
+
+    def __init__(self, pool_size: int = 16, connect_timeout: float = 5.0,
+                 read_timeout: float = 60.0, retries: int = 3, backoff: float = 0.5,
+                 max_bytes: int = 512 * 1024 * 1024, chunk_size: int = 256 * 1024):
+        """
+        Args:
+            pool_size: Maximum keep-alive connections per host
+            connect_timeout: Seconds to wait for a connection
+            read_timeout: Seconds to wait between bytes of the response
+            retries: Additional attempts after a failed download
+            backoff: Base delay in seconds, doubled after each failed attempt
+            max_bytes: Largest response body accepted
+            chunk_size: Bytes read from the socket at a time
+        """
+        self.timeout: Tuple[float, float] = (connect_timeout, read_timeout)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.pool_size = pool_size
+
+        self._lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+
+    @classmethod
+    def from_env(cls) -> "DownloadClient":
+        """
+        Build from PHOTO_HTTP_POOL_SIZE, PHOTO_HTTP_CONNECT_TIMEOUT,
+        PHOTO_HTTP_READ_TIMEOUT, PHOTO_HTTP_RETRIES and PHOTO_HTTP_BACKOFF
+        """
+        return cls(
+            pool_size=int(os.environ.get('PHOTO_HTTP_POOL_SIZE', '16')),
+            connect_timeout=float(os.environ.get('PHOTO_HTTP_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.environ.get('PHOTO_HTTP_READ_TIMEOUT', '60')),
+            retries=int(os.environ.get('PHOTO_HTTP_RETRIES', '3')),
+            backoff=float(os.environ.get('PHOTO_HTTP_BACKOFF', '0.5'))
+        )
+
+    def fetch(self, url: str) -> memoryview:
+        """
+        Download a URL into memory
+
+        Returns:
+            The response body as a memoryview over a single buffer
+
+        Raises:
+            DownloadError: If every attempt failed
+        """
+        last_error: Optional[Exception] = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * (2 ** (attempt - 1))
+                time.sleep(delay + random.uniform(0, delay / 2))
+            try:
+                return self._fetch_once(url)
+            except DownloadError:
+                raise
+            except (requests.RequestException, OSError) as e:
+                last_error = e
+                logger.warning(f"Download attempt {attempt + 1} failed for {url}: {str(e)}")
+
+        raise DownloadError(f"Download failed after {self.retries + 1} attempts: {last_error}")
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                # Status-level retries are left to urllib3; body failures are retried below
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_size,
+                    pool_maxsize=self.pool_size,
+                    max_retries=Retry(
+                        total=self.retries,
+                        backoff_factor=self.backoff,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(['GET']),
+                        raise_on_status=False
+                    )
+                )
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def _fetch_once(self, url: str) -> memoryview:
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+
+            length = response.headers.get('Content-Length')
+            expected = int(length) if length and length.isdigit() else None
+            if expected is not None and expected > self.max_bytes:
+                raise DownloadError(f"Response of {expected} bytes exceeds the {self.max_bytes} byte limit")
+
+            # Preallocate when the size is known; compressed transfers may
+            # report the encoded length, so the buffer still grows if needed
+            buffer = bytearray(expected or self.chunk_size)
+            view = memoryview(buffer)
+            size = 0
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                end = size + len(chunk)
+                if end > self.max_bytes:
+                    raise DownloadError(f"Response exceeds the {self.max_bytes} byte limit")
+                if end > len(buffer):
+                    view.release()
+                    buffer.extend(bytes(max(end - len(buffer), len(buffer))))
+                    view = memoryview(buffer)
+                view[size:end] = chunk
+                size = end
+
+            if expected is not None and size < expected and 'Content-Encoding' not in response.headers:
+                raise requests.ConnectionError(f"Connection closed after {size} of {expected} bytes")
+
+            return view[:size]
+
+    def close(self) -> None:
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
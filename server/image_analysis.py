@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+# Laplacian-of-Laplacian kernel from Immerkaer, "Fast Noise Variance Estimation" (1996)
+NOISE_KERNEL = ((1, -2, 1), (-2, 4, -2), (1, -2, 1))
+
+# Bumped when ImageAnalysis gains fields, so cached analyses are recomputed
+ANALYSIS_VERSION = 2
+
+
+def sample_view(image: np.ndarray, max_side: int) -> np.ndarray:
+    """Strided view of at most max_side pixels per side; no pixels are copied"""
+    step = max(1, -(-max(image.shape[:2]) // max_side))
+    return image[::step, ::step]
+
+
+def channel_spread(image: np.ndarray, max_side: int = 512) -> np.ndarray:
+    """Per-pixel difference between the largest and smallest channel, on a strided sample"""
+    sample = np.ascontiguousarray(sample_view(image, max_side))
+    return (sample.max(axis=2) - sample.min(axis=2)).ravel()
+
+
+def is_grayscale(image: np.ndarray, tolerance: int = 4, max_side: int = 512) -> bool:
+    """
+    Check whether an RGB image is neutral gray, on a strided sample
+
+    Lossy encoding leaves a few levels of chroma noise in gray photos, so a
+    pixel counts as gray when its channels are within `tolerance` levels.
+    """
+    if image.ndim == 2 or image.shape[2] == 1:
+        return True
+    spread = channel_spread(image, max_side)
+    return float(np.percentile(spread, 99.5)) <= tolerance
+
+
+class ImageAnalysis:
+    """What the analysis pre-pass learned about an input image"""
+
+    def __init__(self, width: int, height: int, grayscale: bool, sepia: bool,
+                 noise_sigma: float, scratch_density: float, dust_density: float,
+                 faces: Optional[int], brightness: Dict[str, float],
+                 face_boxes: Optional[List[List[int]]] = None):
+        self.width = width
+        self.height = height
+        self.grayscale = grayscale
+        self.sepia = sepia
+        self.noise_sigma = noise_sigma
+        self.scratch_density = scratch_density
+        self.dust_density = dust_density
+        self.faces = faces
+        self.brightness = brightness
+        self.face_boxes = face_boxes
+
+    @property
+    def monochrome(self) -> bool:
+        """Gray or sepia-toned, i.e. a candidate for colorization"""
+        return self.grayscale or self.sepia
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "width": self.width,
+            "height": self.height,
+            "grayscale": self.grayscale,
+            "sepia": self.sepia,
+            "noise_sigma": round(self.noise_sigma, 3),
+            "scratch_density": round(self.scratch_density, 6),
+            "dust_density": round(self.dust_density, 6),
+            "faces": self.faces,
+            "brightness": {k: round(v, 2) for k, v in self.brightness.items()},
+            "face_boxes": self.face_boxes
+        }
+
+    def to_bytes(self) -> bytes:
+        return json.dumps(self.as_dict()).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ImageAnalysis":
+        return cls(**json.loads(data))
+
+
+class ImageAnalyzer:
+    """
+    One cheap pass over a downsampled copy of the input that tells the
+    pipeline which stages are worth running.
+
+    - grayscale / sepia: channel spread and LAB chroma on a strided sample
+    - noise: Immerkaer's estimator on a full-resolution center crop
+    - scratches and dust: top-hat / black-hat responses filtered by shape
+    - faces: Haar cascade, when the installed OpenCV ships one
+    - brightness: luminance mean, spread and percentiles
+
+    Only the sample (at most `sample_side` pixels per side) and the crop
+    are ever read, so the cost does not grow with image size.
+    """
+
+    def __init__(self, sample_side: int = 768, crop_side: int = 512,
+                 noise_threshold: float = 1.5, scratch_threshold: float = 0.003,
+                 dust_threshold: float = 0.0006, color_tolerance: int = 4, detect_faces: bool = True,
+                 cascade_path: Optional[str] = None):
+        """
+        Args:
+            sample_side: Longest side of the downsampled copy
+            crop_side: Side of the full-resolution crop used for noise
+            noise_threshold: Noise sigma (in 8-bit levels) below which denoising is skipped
+            scratch_threshold: Fraction of scratch pixels below which inpainting is skipped
+            dust_threshold: Fraction of dust pixels below which inpainting is skipped
+            color_tolerance: Channel difference still counted as gray
+            detect_faces: Run face detection to decide on face enhancement
+            cascade_path: Haar cascade file (defaults to OpenCV's frontal face cascade)
+        """
+        self.sample_side = sample_side
+        self.crop_side = crop_side
+        self.noise_threshold = noise_threshold
+        self.scratch_threshold = scratch_threshold
+        self.dust_threshold = dust_threshold
+        self.color_tolerance = color_tolerance
+        self.detect_faces = detect_faces
+        self.cascade_path = cascade_path
+        self._local = threading.local()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Travels with the processor to CPU pool workers; cascades are per thread
+        state = self.__dict__.copy()
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls) -> Optional["ImageAnalyzer"]:
+        """
+        Build from PHOTO_NOISE_THRESHOLD, PHOTO_SCRATCH_THRESHOLD,
+        PHOTO_DUST_THRESHOLD, PHOTO_FACE_DETECTION and PHOTO_FACE_CASCADE;
+        PHOTO_ANALYSIS=0 disables the pre-pass and returns None
+        """
+        if os.environ.get('PHOTO_ANALYSIS', '1') == '0':
+            return None
+        return cls(
+            noise_threshold=float(os.environ.get('PHOTO_NOISE_THRESHOLD', '1.5')),
+            scratch_threshold=float(os.environ.get('PHOTO_SCRATCH_THRESHOLD', '0.003')),
+            dust_threshold=float(os.environ.get('PHOTO_DUST_THRESHOLD', '0.0006')),
+            detect_faces=os.environ.get('PHOTO_FACE_DETECTION', '1') != '0',
+            cascade_path=os.environ.get('PHOTO_FACE_CASCADE')
+        )
+
+    def settings(self) -> Dict[str, Any]:
+        """Parameters that change analysis results, for cache keys"""
+        return {
+            "version": ANALYSIS_VERSION,
+            "sample_side": self.sample_side,
+            "crop_side": self.crop_side,
+            "noise_threshold": self.noise_threshold,
+            "scratch_threshold": self.scratch_threshold,
+            "dust_threshold": self.dust_threshold,
+            "color_tolerance": self.color_tolerance,
+            "faces": self.detect_faces and self._cascade() is not None
+        }
+
+    def analyze(self, image: np.ndarray) -> ImageAnalysis:
+        """Analyze an RGB (or grayscale) image"""
+        height, width = image.shape[:2]
+        if image.ndim == 2:
+            # Zero-copy RGB view; only the sample and the crop are materialized
+            image = np.broadcast_to(image[:, :, None], (height, width, 3))
+
+        # Area-averaged sample for structure; strided views for exact pixel values
+        step = max(1, -(-max(height, width) // (self.sample_side * 2)))
+        small = np.ascontiguousarray(image[::step, ::step])
+        if max(small.shape[:2]) > self.sample_side:
+            scale = self.sample_side / max(small.shape[:2])
+            small = cv2.resize(small, (max(1, round(small.shape[1] * scale)), max(1, round(small.shape[0] * scale))),
+                               interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+
+        spread = channel_spread(image, self.sample_side)
+        grayscale = float(np.percentile(spread, 99.5)) <= self.color_tolerance
+        sepia = not grayscale and self._is_sepia(small)
+
+        scratch_density, dust_density = self._damage(gray)
+        boxes = self._faces(gray)
+        if boxes is not None:
+            # Back to input coordinates
+            factor = width / gray.shape[1]
+            boxes = [[int(round(v * factor)) for v in box] for box in boxes]
+        brightness = {
+            "mean": float(gray.mean()),
+            "std": float(gray.std()),
+            "p1": float(np.percentile(gray, 1)),
+            "p99": float(np.percentile(gray, 99))
+        }
+
+        return ImageAnalysis(
+            width=width,
+            height=height,
+            grayscale=grayscale,
+            sepia=sepia,
+            noise_sigma=self._noise(image),
+            scratch_density=scratch_density,
+            dust_density=dust_density,
+            faces=len(boxes) if boxes is not None else None,
+            brightness=brightness,
+            face_boxes=boxes
+        )
+
+    def skip_reasons(self, analysis: ImageAnalysis) -> Dict[str, str]:
+        """Stages that would not change the image, with the reason"""
+        reasons = {}
+        if (analysis.noise_sigma < self.noise_threshold
+                and analysis.scratch_density < self.scratch_threshold
+                and analysis.dust_density < self.dust_threshold):
+            reasons['inpainting'] = (f"no noise, scratches or dust detected (noise {analysis.noise_sigma:.1f}, "
+                                     f"scratches {analysis.scratch_density:.4f}, dust {analysis.dust_density:.4f})")
+        if not analysis.monochrome:
+            reasons['colorization'] = "image already has color"
+        if analysis.faces == 0:
+            reasons['face_enhancement'] = "no faces detected"
+        return reasons
+
+    def _is_sepia(self, small: np.ndarray) -> bool:
+        # Toned prints carry one warm hue everywhere: chroma is present but
+        # barely varies across the image
+        lab = cv2.cvtColor(small, cv2.COLOR_RGB2LAB).reshape(-1, 3).astype(np.float32)
+        a, b = lab[:, 1] - 128, lab[:, 2] - 128
+        warm = float(np.median(b)) > 3 and float(np.median(a)) >= -2
+        return warm and float(a.std()) < 4 and float(b.std()) < 6
+
+    def _noise(self, image: np.ndarray) -> float:
+        height, width = image.shape[:2]
+        side = min(self.crop_side, height, width)
+        y, x = (height - side) // 2, (width - side) // 2
+        crop = cv2.cvtColor(np.ascontiguousarray(image[y:y + side, x:x + side]), cv2.COLOR_RGB2GRAY)
+        if side < 3:
+            return 0.0
+        response = cv2.filter2D(crop.astype(np.float32), -1, np.array(NOISE_KERNEL, np.float32))[1:-1, 1:-1]
+        return float(np.sqrt(np.pi / 2) * np.abs(response).mean() / 6)
+
+    @staticmethod
+    def _damage(gray: np.ndarray) -> tuple:
+        """Fractions of the sample covered by thin scratches and by isolated dust specks"""
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+        response = cv2.max(cv2.morphologyEx(gray, cv2.MORPH_TOPHAT, kernel),
+                           cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, kernel))
+        _, mask = cv2.threshold(response, 40, 255, cv2.THRESH_BINARY)
+
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        if count <= 1:
+            return 0.0, 0.0
+        stats = stats[1:]
+        x, y = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+        w, h, area = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT], stats[:, cv2.CC_STAT_AREA]
+
+        # Scratches: long components about as thin as a line
+        length = np.hypot(w, h)
+        scratches = (length >= max(15, max(gray.shape) // 40)) & (area / length <= 2.0)
+
+        # Dust: tiny, high-contrast specks in an otherwise quiet neighbourhood;
+        # clusters of small responses are texture (foliage, hair, fabric)
+        cx, cy = x + w // 2, y + h // 2
+        busy = cv2.blur((mask > 0).astype(np.float32), (15, 15))[cy, cx]
+        dust = (area <= 12) & ~scratches & (busy < 0.08) & (response[cy, cx] >= 70)
+
+        pixels = float(gray.size)
+        return float(area[scratches].sum()) / pixels, float(area[dust].sum()) / pixels
+
+    def _cascade(self):
+        if not hasattr(self._local, 'cascade'):
+            self._local.cascade = None
+            factory = getattr(cv2, 'CascadeClassifier', None)
+            path = self.cascade_path
+            if path is None and hasattr(cv2, 'data'):
+                path = os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+            if factory is not None and path and os.path.exists(path):
+                cascade = factory(path)
+                if not cascade.empty():
+                    self._local.cascade = cascade
+        return self._local.cascade
+
+    def _faces(self, gray: np.ndarray) -> Optional[List[List[int]]]:
+        """(x, y, w, h) of each face found, or None when detection is off or unavailable"""
+        if not self.detect_faces:
+            return None
+        cascade = self._cascade()
+        if cascade is None:
+            return None
+        equalized = cv2.equalizeHist(gray)
+        min_side = max(20, min(gray.shape[:2]) // 20)
+        faces = cascade.detectMultiScale(equalized, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side))
+        return [[int(v) for v in face] for face in faces]
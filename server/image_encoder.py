@@ -0,0 +1,467 @@
+from __future__ import annotations
+
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+features = lazy_import('PIL.features')
+
+logger = logging.getLogger(__name__)
+
+# Output formats: Pillow format, media type and file extension
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+    'webp': ('WEBP', 'image/webp', '.webp'),
+    'avif': ('AVIF', 'image/avif', '.avif'),
+    'png': ('PNG', 'image/png', '.png'),
+}
+LOSSY = ('jpeg', 'webp', 'avif')
+DEFAULT_QUALITY = {'jpeg': 95, 'webp': 90, 'avif': 75}
+SUBSAMPLING = ('4:4:4', '4:2:2', '4:2:0')
+
+# Encoder settings per format, from the slowest (smallest output) to the
+# fastest. Without a time budget the second level is used, which is
+# Pillow's default (for JPEG: no Huffman table optimization)
+EFFORT_LEVELS = {
+    'jpeg': ({'optimize': True}, {'optimize': False}),
+    'webp': ({'method': 6}, {'method': 4}, {'method': 2}, {'method': 0}),
+    'avif': ({'speed': 4}, {'speed': 6}, {'speed': 8}, {'speed': 10}),
+    'png': ({'compress_level': 9}, {'compress_level': 6}, {'compress_level': 3}, {'compress_level': 1}),
+}
+DEFAULT_LEVEL = 1
+# Rough seconds per megapixel of each level, used until it has been measured
+INITIAL_S_PER_MP = {
+    'jpeg': (0.02, 0.012),
+    'webp': (0.6, 0.25, 0.1, 0.05),
+    'avif': (4.0, 1.5, 0.6, 0.25),
+    'png': (1.5, 0.15, 0.08, 0.05),
+}
+# Weight of the newest measurement in the per-level estimates
+RATE_SMOOTHING = 0.3
+
+# A target-size search bisects quality between this and the requested quality
+MIN_QUALITY = 30
+TARGET_SEARCH_STEPS = 7
+
+
+def available_formats() -> Tuple[str, ...]:
+    """Output formats this Pillow build can write"""
+    try:
+        # Registers AVIF on Pillow releases without built-in support
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+    Image.init()
+    available = []
+    for name, (pil_format, _, _) in FORMATS.items():
+        if pil_format not in Image.SAVE:
+            continue
+        if name in ('webp', 'avif'):
+            try:
+                if not features.check_module(name):
+                    continue
+            except ValueError:
+                # Older Pillow without the feature flag; the plugin is registered
+                pass
+        available.append(name)
+    return tuple(available)
+
+
+class _ChunkPipe:
+    """Write-only file object handing fixed-size chunks to a reader thread"""
+
+    def __init__(self, chunk_size: int, depth: int = 8):
+        self.chunk_size = chunk_size
+        self.chunks: "queue.Queue[Any]" = queue.Queue(maxsize=depth)
+        self.closed = threading.Event()
+        self._buffer = bytearray()
+
+    def write(self, data) -> int:
+        if self.closed.is_set():
+            raise BrokenPipeError("Output stream was closed")
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size:
+            self._put(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        if self._buffer and error is None:
+            self._put(bytes(self._buffer))
+        self._buffer = bytearray()
+        self._put(error if error is not None else None)
+
+    def _put(self, item: Any) -> None:
+        # Gives up once the reader has gone, so the encoder thread can exit
+        while not self.closed.is_set():
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise BrokenPipeError("Output stream was closed")
+
+
+class _CountingWriter:
+    def __init__(self, target):
+        self.target = target
+        self.count = 0
+
+    def write(self, data) -> int:
+        self.count += len(data)
+        return self.target.write(data)
+
+    def flush(self) -> None:
+        pass
+
+
+class OutputEncoder:
+    """
+    Encodes restored images for the client:
+    - JPEG (libjpeg-turbo, optionally progressive and with a chosen chroma
+      subsampling), WebP, AVIF when Pillow can write it, and PNG
+    - format negotiation from a request parameter or the Accept header
+    - a target-size mode that bisects quality to the largest output that
+      fits, and an encode-time budget that picks the best encoder effort
+      expected to finish in time, from timings of earlier encodes
+    - streaming of encoded chunks while the encoder is still running
+    """
+
+    def __init__(self, default_format: str = 'jpeg', quality: Optional[Dict[str, int]] = None,
+                 progressive: bool = False, subsampling: Optional[str] = None,
+                 budget_ms: Optional[int] = None, chunk_size: int = 64 * 1024):
+        """
+        Args:
+            default_format: Format used when the request does not pick one
+            quality: Default quality per lossy format (see DEFAULT_QUALITY)
+            progressive: Write progressive JPEGs
+            subsampling: Chroma subsampling for JPEG and AVIF ('4:4:4',
+                '4:2:2' or '4:2:0'; None keeps the encoder's default)
+            budget_ms: Default encode-time budget in milliseconds (None: no budget)
+            chunk_size: Bytes per chunk when streaming
+        """
+        if default_format not in FORMATS:
+            raise ValueError(f"Output format must be one of: {', '.join(FORMATS)}")
+        if subsampling is not None and subsampling not in SUBSAMPLING:
+            raise ValueError(f"Chroma subsampling must be one of: {', '.join(SUBSAMPLING)}")
+
+        self.default_format = default_format
+        self.quality = {**DEFAULT_QUALITY, **(quality or {})}
+        self.progressive = progressive
+        self.subsampling = subsampling
+        self.budget_ms = budget_ms
+        self.chunk_size = chunk_size
+
+        self._lock = threading.Lock()
+        self._rates: Dict[Tuple[str, int, bool], float] = {}
+        self._formats: Optional[Tuple[str, ...]] = None
+
+    @classmethod
+    def from_env(cls) -> "OutputEncoder":
+        """
+        Build from PHOTO_OUTPUT_FORMAT, PHOTO_JPEG_QUALITY, PHOTO_WEBP_QUALITY,
+        PHOTO_AVIF_QUALITY, PHOTO_JPEG_PROGRESSIVE, PHOTO_CHROMA_SUBSAMPLING
+        and PHOTO_ENCODE_BUDGET_MS
+        """
+        quality = {}
+        for name in LOSSY:
+            value = os.environ.get(f'PHOTO_{name.upper()}_QUALITY')
+            if value:
+                quality[name] = int(value)
+        budget_ms = int(os.environ.get('PHOTO_ENCODE_BUDGET_MS', '0'))
+        return cls(
+            default_format=os.environ.get('PHOTO_OUTPUT_FORMAT', 'jpeg'),
+            quality=quality,
+            progressive=os.environ.get('PHOTO_JPEG_PROGRESSIVE', '0') == '1',
+            subsampling=os.environ.get('PHOTO_CHROMA_SUBSAMPLING') or None,
+            budget_ms=budget_ms or None
+        )
+
+    @property
+    def formats(self) -> Tuple[str, ...]:
+        """
+        Formats this Pillow build can write; Pillow is loaded and probed on
+        first use (the API does so while warming up)
+
+        Raises:
+            ValueError: If the default format cannot be written
+        """
+        if self._formats is None:
+            formats = available_formats()
+            if self.default_format not in formats:
+                raise ValueError(f"Output format must be one of: {', '.join(formats)}")
+            self._formats = formats
+        return self._formats
+
+    def negotiate(self, accept: Optional[str] = None, requested: Optional[str] = None) -> str:
+        """
+        Pick the output format for a request
+
+        Args:
+            accept: The request's Accept header
+            requested: Format named by the request, which wins over `accept`
+
+        Returns:
+            The requested format, else the supported image type the Accept
+            header ranks highest (preferring the default format, then the
+            order of FORMATS, on ties), else the default format. Wildcards
+            leave the default in place.
+
+        Raises:
+            ValueError: If `requested` is not an available format
+        """
+        if requested:
+            requested = requested.lower()
+            requested = 'jpeg' if requested == 'jpg' else requested
+            if requested not in self.formats:
+                raise ValueError(f"Output format must be one of: {', '.join(self.formats)}")
+            return requested
+        if not accept:
+            return self.default_format
+
+        by_type = {FORMATS[name][1]: name for name in self.formats}
+        ranked = []
+        for entry in accept.split(','):
+            media_type, _, params = entry.strip().partition(';')
+            name = by_type.get(media_type.strip().lower())
+            if name is None:
+                continue
+            q = 1.0
+            for param in params.split(';'):
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if q > 0:
+                order = -1 if name == self.default_format else list(FORMATS).index(name)
+                ranked.append((-q, order, name))
+        return min(ranked)[2] if ranked else self.default_format
+
+    def resolve(self, output: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Complete a request's output options with the defaults
+
+        Args:
+            output: Any of 'format', 'quality', 'progressive', 'subsampling',
+                'target_kb' (largest output, lossy formats only) and
+                'budget_ms' (encode-time budget); missing or None entries
+                take the defaults. Resolved settings resolve to themselves.
+
+        Returns:
+            Settings dict, JSON-serializable, also used in cache keys
+
+        Raises:
+            ValueError: If an option is out of range
+        """
+        output = output or {}
+        image_format = self.negotiate(requested=output.get('format'))
+        lossy = image_format in LOSSY
+
+        quality = output.get('quality')
+        if quality is None:
+            quality = self.quality.get(image_format)
+        elif not 1 <= int(quality) <= 100:
+            raise ValueError("Output quality must be between 1 and 100")
+        subsampling = output.get('subsampling', self.subsampling)
+        if subsampling is not None and subsampling not in SUBSAMPLING:
+            raise ValueError(f"Chroma subsampling must be one of: {', '.join(SUBSAMPLING)}")
+        target_kb = output.get('target_kb')
+        if target_kb is not None and int(target_kb) <= 0:
+            raise ValueError("Target size must be positive")
+        budget_ms = output.get('budget_ms', self.budget_ms)
+        if budget_ms is not None and int(budget_ms) <= 0:
+            raise ValueError("Encode budget must be positive")
+
+        return {
+            'format': image_format,
+            'quality': int(quality) if lossy else None,
+            'progressive': bool(output.get('progressive', self.progressive)) if image_format == 'jpeg' else False,
+            'subsampling': subsampling if image_format in ('jpeg', 'avif') else None,
+            'target_kb': int(target_kb) if lossy and target_kb is not None else None,
+            'budget_ms': int(budget_ms) if budget_ms is not None else None
+        }
+
+    @staticmethod
+    def media_type(settings: Dict[str, Any]) -> str:
+        return FORMATS[settings.get('format') or 'jpeg'][1]
+
+    @staticmethod
+    def extension(settings: Dict[str, Any]) -> str:
+        return FORMATS[settings.get('format') or 'jpeg'][2]
+
+    def _estimate(self, image_format: str, level: int, progressive: bool, megapixels: float) -> float:
+        with self._lock:
+            rate = self._rates.get((image_format, level, progressive))
+        if rate is None:
+            rate = INITIAL_S_PER_MP[image_format][level]
+        return rate * megapixels
+
+    def _learn(self, image_format: str, level: int, progressive: bool, megapixels: float,
+               seconds: float) -> None:
+        if megapixels <= 0:
+            return
+        rate = seconds / megapixels
+        key = (image_format, level, progressive)
+        with self._lock:
+            previous = self._rates.get(key)
+            self._rates[key] = rate if previous is None else previous + RATE_SMOOTHING * (rate - previous)
+
+    def _level(self, settings: Dict[str, Any], megapixels: float) -> int:
+        """Slowest effort level expected to finish within the budget"""
+        budget_ms = settings['budget_ms']
+        if budget_ms is None:
+            return DEFAULT_LEVEL
+        image_format = settings['format']
+        levels = len(EFFORT_LEVELS[image_format])
+        for level in range(levels):
+            if self._estimate(image_format, level, settings['progressive'], megapixels) * 1000 <= budget_ms:
+                return level
+        return levels - 1
+
+    def _save(self, image: Image.Image, target, settings: Dict[str, Any], level: int,
+              quality: Optional[int]) -> None:
+        image_format = settings['format']
+        params = dict(EFFORT_LEVELS[image_format][level])
+        if quality is not None:
+            params['quality'] = quality
+        if settings['progressive']:
+            params['progressive'] = True
+        if settings['subsampling'] is not None:
+            params['subsampling'] = settings['subsampling']
+        image.save(target, format=FORMATS[image_format][0], **params)
+
+    def _encode_measured(self, image: Image.Image, target, settings: Dict[str, Any], level: int,
+                         quality: Optional[int], megapixels: float) -> float:
+        start = time.perf_counter()
+        self._save(image, target, settings, level, quality)
+        elapsed = time.perf_counter() - start
+        self._learn(settings['format'], level, settings['progressive'], megapixels, elapsed)
+        return elapsed
+
+    def encode(self, image: np.ndarray, settings: Optional[Dict[str, Any]] = None) -> bytes:
+        """
+        Encode an RGB image
+
+        Args:
+            image: RGB uint8 array
+            settings: Output settings from resolve() (defaults to resolve())
+
+        Returns:
+            Encoded image bytes
+        """
+        settings = self.resolve(settings)
+        pil_image = Image.fromarray(image)
+        megapixels = image.shape[0] * image.shape[1] / 1e6
+        level = self._level(settings, megapixels)
+
+        if settings['target_kb'] is not None:
+            return self._encode_to_size(pil_image, settings, level, megapixels)
+
+        output_buffer = io.BytesIO()
+        self._encode_measured(pil_image, output_buffer, settings, level, settings['quality'], megapixels)
+        return output_buffer.getvalue()
+
+    def _encode_to_size(self, image: Image.Image, settings: Dict[str, Any], level: int,
+                        megapixels: float) -> bytes:
+        """
+        Highest quality whose output fits target_kb, by bisection
+
+        The budget, if any, bounds the whole search: it stops with the best
+        fit so far once another attempt is not expected to finish in time.
+        """
+        target_bytes = settings['target_kb'] * 1024
+        budget_s = settings['budget_ms'] / 1000 if settings['budget_ms'] is not None else None
+        estimate = self._estimate(settings['format'], level, settings['progressive'], megapixels)
+        spent = 0.0
+        low, high = MIN_QUALITY, max(settings['quality'], MIN_QUALITY)
+        quality = high
+        best = None
+        smallest = None
+        for _ in range(TARGET_SEARCH_STEPS):
+            output_buffer = io.BytesIO()
+            spent += self._encode_measured(image, output_buffer, settings, level, quality, megapixels)
+            data = output_buffer.getvalue()
+            if len(data) <= target_bytes:
+                best = data
+                low = quality + 1
+            else:
+                if smallest is None or len(data) < len(smallest):
+                    smallest = data
+                high = quality - 1
+            if low > high or (budget_s is not None and spent + estimate > budget_s):
+                break
+            quality = (low + high + 1) // 2
+        if best is None:
+            logger.info(f"No {settings['format']} quality down to {MIN_QUALITY} fits "
+                        f"{settings['target_kb']}KB; returning the smallest attempt")
+            return smallest
+        return best
+
+    def iter_encode(self, image: np.ndarray, settings: Optional[Dict[str, Any]] = None,
+                    trace=None) -> Iterator[bytes]:
+        """
+        Encode an RGB image, yielding chunks as the encoder writes them
+
+        The encoder runs on its own thread and stops if the consumer closes
+        the iterator early. Target-size encodes have to finish their search
+        first, so they yield only once the result is known.
+
+        Args:
+            image: RGB uint8 array
+            settings: Output settings from resolve()
+            trace: Optional PipelineTrace receiving the 'encode' stage
+        """
+        settings = self.resolve(settings)
+        pipe = _ChunkPipe(self.chunk_size)
+
+        def encode_into(writer: _CountingWriter) -> None:
+            if settings['target_kb'] is not None:
+                writer.write(self.encode(image, settings))
+                return
+            megapixels = image.shape[0] * image.shape[1] / 1e6
+            self._encode_measured(Image.fromarray(image), writer, settings,
+                                  self._level(settings, megapixels), settings['quality'], megapixels)
+
+        def run() -> None:
+            writer = _CountingWriter(pipe)
+            try:
+                if trace is None:
+                    encode_into(writer)
+                else:
+                    with trace.stage('encode', image) as record:
+                        encode_into(writer)
+                        record.bytes['encoded'] = writer.count
+                pipe.finish()
+            except BrokenPipeError:
+                logger.info("Client left before the image was fully encoded")
+            except BaseException as e:
+                try:
+                    pipe.finish(e)
+                except BrokenPipeError:
+                    pass
+
+        thread = threading.Thread(target=run, name='photo-encode', daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = pipe.chunks.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            pipe.closed.set()
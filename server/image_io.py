@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import io
+import logging
+import os
+from typing import Callable, Optional, Tuple, Union
+
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+logger = logging.getLogger(__name__)
+
+ImageSource = Union[bytes, bytearray, memoryview, str, os.PathLike, 'np.ndarray']
+
+# Decode-time reductions OpenCV supports; JPEG applies them in the DCT
+REDUCED_FLAGS = {
+    2: 'IMREAD_REDUCED_COLOR_2',
+    4: 'IMREAD_REDUCED_COLOR_4',
+    8: 'IMREAD_REDUCED_COLOR_8',
+}
+
+
+def _probe(source: ImageSource) -> Tuple[Optional[Tuple[int, int]], Optional[str]]:
+    """Read (width, height) and format from the header without decoding pixels"""
+    try:
+        handle = source if isinstance(source, (str, os.PathLike)) else io.BytesIO(source)
+        with Image.open(handle) as image:
+            return image.size, image.format
+    except Exception:
+        return None, None
+
+
+def image_size(source: ImageSource, max_pixels: Optional[int] = None) -> Optional[Tuple[int, int]]:
+    """
+    (width, height) that read_image() will return for a source, read from
+    the header without decoding; None when the header cannot be read
+    """
+    if isinstance(source, np.ndarray):
+        width, height = source.shape[1], source.shape[0]
+    else:
+        size, _ = _probe(source)
+        if size is None:
+            return None
+        width, height = size
+    if max_pixels and width * height > max_pixels:
+        factor = (max_pixels / (width * height)) ** 0.5
+        return max(1, int(width * factor)), max(1, int(height * factor))
+    return width, height
+
+
+def _reduction(size: Optional[Tuple[int, int]], max_pixels: Optional[int]) -> int:
+    """Largest decode reduction that still leaves at least max_pixels"""
+    if not size or not max_pixels:
+        return 1
+    pixels = size[0] * size[1]
+    factor = 1
+    for candidate in (2, 4, 8):
+        if pixels / (candidate * candidate) >= max_pixels:
+            factor = candidate
+    return factor
+
+
+def _decode_cv2(source: ImageSource, reduction: int) -> Optional[np.ndarray]:
+    flags = getattr(cv2, REDUCED_FLAGS.get(reduction, 'IMREAD_COLOR')) | cv2.IMREAD_IGNORE_ORIENTATION
+    if isinstance(source, (str, os.PathLike)):
+        return cv2.imread(os.fspath(source), flags)
+    return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flags)
+
+
+def _decode_pil(source: ImageSource, reduction: int) -> np.ndarray:
+    handle = source if isinstance(source, (str, os.PathLike)) else io.BytesIO(source)
+    with Image.open(handle) as image:
+        if reduction > 1:
+            image.draft('RGB', (image.width // reduction, image.height // reduction))
+        if image.mode.startswith('I;16'):
+            # 16-bit scans: keep the high byte
+            gray = (np.asarray(image, dtype=np.uint16) >> 8).astype(np.uint8)
+            return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
+
+
+def to_rgb(image: np.ndarray) -> np.ndarray:
+    """Return a 3-channel RGB view of an array, converting grayscale and dropping alpha"""
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    if image.shape[2] == 4:
+        return np.ascontiguousarray(image[:, :, :3])
+    return image
+
+
+def read_image(source: ImageSource, max_pixels: Optional[int] = None,
+               allocate: Optional[Callable[[Tuple[int, ...]], np.ndarray]] = None) -> np.ndarray:
+    """
+    Decode an image into a single RGB uint8 array
+
+    Files are decoded straight from disk, so the encoded upload never has to
+    be held in memory. When the image is larger than `max_pixels` it is
+    downscaled during decoding (JPEG decodes at 1/2, 1/4 or 1/8 scale in the
+    DCT), then resized to fit the budget exactly.
+
+    Args:
+        source: Encoded bytes, a file path, or an already decoded array
+        max_pixels: Optional pixel budget; larger images are downscaled
+        allocate: Returns an empty uint8 array of a given shape to hold the
+            result (e.g. SharedImages.empty); the last conversion or resize
+            writes straight into it. Arrays given as the source are
+            returned as they are.
+
+    Returns:
+        RGB image as numpy array
+    """
+    if isinstance(source, np.ndarray):
+        image = to_rgb(source)
+    else:
+        size, image_format = _probe(source)
+        reduction = _reduction(size, max_pixels)
+        if reduction > 1:
+            logger.info(f"Decoding {image_format} {size[0]}x{size[1]} at 1/{reduction} scale")
+
+        image = _decode_cv2(source, reduction)
+        if image is None:
+            # Formats OpenCV cannot read (e.g. GIF, some TIFF compressions)
+            image = _decode_pil(source, reduction)
+        height, width = image.shape[:2]
+        if allocate is None or (max_pixels and width * height > max_pixels):
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+        else:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=allocate(image.shape))
+            allocate = None
+
+    height, width = image.shape[:2]
+    if max_pixels and width * height > max_pixels:
+        factor = (max_pixels / (width * height)) ** 0.5
+        new_size = (max(1, int(width * factor)), max(1, int(height * factor)))
+        logger.info(f"Downscaling input from {width}x{height} to {new_size[0]}x{new_size[1]}")
+        dst = allocate((new_size[1], new_size[0], 3)) if allocate is not None else None
+        image = cv2.resize(image, new_size, dst=dst, interpolation=cv2.INTER_AREA)
+    return image
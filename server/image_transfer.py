@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import base64
+import contextvars
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Tuple
+
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+logger = logging.getLogger(__name__)
+
+ENCODINGS = {
+    'png': ('.png', 'image/png'),
+    'webp': ('.webp', 'image/webp'),
+}
+
+# (transfer, stats) for the current request; a context variable rather than
+# a thread-local so the stats follow model calls onto guard worker threads
+_RECORDING: contextvars.ContextVar = contextvars.ContextVar('photo_transfer_stats', default=None)
+
+
+class ImageTransfer:
+    """
+    Moves images between the pipeline and remote models:
+    - a fast encoder (PNG at a low compression level, or lossless WebP)
+    - 'upload' mode, which sends the encoded file through the Replicate
+      files API (multipart) and passes the model a URL, falling back to a
+      data URI if the upload fails
+    - a small memo of recently encoded images, so the same pixels are never
+      encoded or uploaded twice
+    - per-stage timing of encode, upload and decode work
+    """
+
+    def __init__(self, mode: str = 'upload', encoding: str = 'png',
+                 png_compression: int = 1, reuse_entries: int = 4, client=None):
+        """
+        Args:
+            mode: 'upload' (files API) or 'data_uri' (inline base64)
+            encoding: 'png' or 'webp' (lossless)
+            png_compression: zlib level for PNG (0-9, lower is faster)
+            reuse_entries: Number of encoded images kept for reuse
+            client: Replicate client used for uploads (defaults to the module client)
+        """
+        if mode not in ('upload', 'data_uri'):
+            raise ValueError(f"Unknown transfer mode: {mode}")
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown transfer encoding: {encoding}")
+
+        self.mode = mode
+        self.encoding = encoding
+        self.png_compression = png_compression
+        self.reuse_entries = reuse_entries
+        self.client = client
+
+        self._lock = threading.Lock()
+        self._memo: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "ImageTransfer":
+        """Build from PHOTO_TRANSFER_MODE, PHOTO_TRANSFER_ENCODING and PHOTO_PNG_COMPRESSION"""
+        return cls(
+            mode=os.environ.get('PHOTO_TRANSFER_MODE', 'upload'),
+            encoding=os.environ.get('PHOTO_TRANSFER_ENCODING', 'png'),
+            png_compression=int(os.environ.get('PHOTO_PNG_COMPRESSION', '1'))
+        )
+
+    @contextmanager
+    def record(self) -> Iterator[Dict[str, Dict[str, Any]]]:
+        """
+        Collect transfer statistics for the calling context.
+
+        Yields a dict mapping stage name to its timings and byte counts,
+        filled in as stages encode and decode images.
+        """
+        stats: Dict[str, Dict[str, Any]] = {}
+        token = _RECORDING.set((self, stats))
+        try:
+            yield stats
+        finally:
+            _RECORDING.reset(token)
+
+    def _note(self, stage: str, **values: float) -> None:
+        recording = _RECORDING.get()
+        if recording is None or recording[0] is not self:
+            return
+        stats = recording[1]
+        entry = stats.setdefault(stage, {
+            "encode_s": 0.0, "upload_s": 0.0, "decode_s": 0.0,
+            "encoded_bytes": 0, "uploaded_bytes": 0, "downloaded_bytes": 0, "reused": 0
+        })
+        for name, value in values.items():
+            entry[name] += value
+
+    def encode(self, image: np.ndarray) -> Dict[str, Any]:
+        """
+        Encode an RGB image, reusing the encoded buffer of identical pixels
+
+        Returns:
+            Dict with 'digest', 'data' (encoded bytes) and 'content_type'
+        """
+        return self._encode(image)[0]
+
+    def _encode(self, image: np.ndarray) -> Tuple[Dict[str, Any], bool]:
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        image = np.ascontiguousarray(image)
+
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(str((image.shape, image.dtype.str, self.encoding)).encode('ascii'))
+        hasher.update(memoryview(image).cast('B'))
+        digest = hasher.hexdigest()
+
+        with self._lock:
+            entry = self._memo.get(digest)
+            if entry is not None:
+                self._memo.move_to_end(digest)
+                return entry, True
+
+        extension, content_type = ENCODINGS[self.encoding]
+        if self.encoding == 'webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+        else:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+
+        ok, encoded = cv2.imencode(extension, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), params)
+        if not ok:
+            raise ValueError(f"Could not encode image as {self.encoding}")
+
+        entry = {"digest": digest, "data": encoded.tobytes(), "content_type": content_type}
+        with self._lock:
+            self._memo[digest] = entry
+            while len(self._memo) > self.reuse_entries:
+                self._memo.popitem(last=False)
+        return entry, False
+
+    def clear(self) -> None:
+        """Forget recently encoded images and their upload URLs"""
+        with self._lock:
+            self._memo.clear()
+
+    def prepare_input(self, image: np.ndarray, stage: str) -> str:
+        """
+        Turn an image into a model input value (an uploaded file URL or a data URI)
+
+        Args:
+            image: RGB or grayscale image
+            stage: Stage name used for statistics
+        """
+        start = time.perf_counter()
+        entry, reused = self._encode(image)
+        self._note(stage, encode_s=time.perf_counter() - start,
+                   encoded_bytes=0 if reused else len(entry['data']), reused=int(reused))
+
+        if self.mode == 'upload':
+            if 'url' in entry:
+                return entry['url']
+            start = time.perf_counter()
+            try:
+                url = self._upload(entry)
+                entry['url'] = url
+                self._note(stage, uploaded_bytes=len(entry['data']))
+                return url
+            except Exception as e:
+                logger.warning(f"File upload failed, sending inline data URI instead: {str(e)}")
+            finally:
+                self._note(stage, upload_s=time.perf_counter() - start)
+
+        if 'data_uri' not in entry:
+            base64_data = base64.b64encode(entry['data']).decode('ascii')
+            entry['data_uri'] = f"data:{entry['content_type']};base64,{base64_data}"
+        self._note(stage, uploaded_bytes=len(entry['data_uri']))
+        return entry['data_uri']
+
+    def _upload(self, entry: Dict[str, Any]) -> str:
+        client = self.client
+        if client is None:
+            import replicate
+            client = replicate.default_client
+        extension, _ = ENCODINGS[self.encoding]
+        uploaded = client.files.create(
+            io.BytesIO(entry['data']),
+            filename=f"{entry['digest']}{extension}",
+            content_type=entry['content_type']
+        )
+        return uploaded.urls['get']
+
+    def decode(self, data, stage: str) -> np.ndarray:
+        """
+        Decode a model output into an RGB numpy array
+
+        Args:
+            data: Encoded image as any bytes-like object; decoded without copying
+            stage: Stage name used for statistics
+        """
+        start = time.perf_counter()
+        decoded = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if decoded is not None:
+            result = cv2.cvtColor(decoded, cv2.COLOR_BGR2RGB)
+        else:
+            # Formats OpenCV cannot read (e.g. GIF)
+            image = Image.open(io.BytesIO(data))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            result = np.asarray(image)
+        self._note(stage, decode_s=time.perf_counter() - start, downloaded_bytes=len(data))
+        return result
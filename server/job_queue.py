@@ -0,0 +1,508 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Union
+
+from executor import PoolSaturated
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class JobEvents:
+    """
+    Wakes event streams when a job changes.
+
+    Changes are made on worker threads while streams wait on the event
+    loop, so each waiter is woken through its own loop. Streams also poll
+    on a timeout, which covers changes made by another process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: Dict[str, List[tuple]] = {}
+
+    def listen(self, job_id: str) -> "JobWaiter":
+        """Register interest before reading the job, so no change is missed"""
+        waiter = JobWaiter(self, job_id, asyncio.get_running_loop())
+        with self._lock:
+            self._waiters.setdefault(job_id, []).append(waiter)
+        return waiter
+
+    def notify(self, job_id: str) -> None:
+        with self._lock:
+            waiters = self._waiters.pop(job_id, [])
+        for waiter in waiters:
+            waiter.loop.call_soon_threadsafe(waiter.event.set)
+
+    def _discard(self, waiter: "JobWaiter") -> None:
+        with self._lock:
+            waiters = self._waiters.get(waiter.job_id)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[waiter.job_id]
+
+
+class JobWaiter:
+    def __init__(self, events: JobEvents, job_id: str, loop: asyncio.AbstractEventLoop):
+        self.events = events
+        self.job_id = job_id
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    async def wait(self, timeout: float) -> None:
+        """Wait until the job changes or `timeout` seconds pass"""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Stop listening without waiting"""
+        self.events._discard(self)
+
+
+class JobStore:
+    """
+    Durable job records backed by SQLite.
+
+    Input uploads and results are kept as files next to the database so the
+    table stays small. Several API worker processes can share one store: a
+    claimed job is leased to its worker, which keeps renewing the lease
+    while it runs, and a job whose lease ran out (its worker died) is put
+    back in the queue for any worker to pick up.
+    """
+
+    def __init__(self, directory: str, lease: float = 60.0):
+        """
+        Args:
+            directory: Directory for the database, uploaded inputs and results
+            lease: Seconds a claimed job stays with its worker without renewal
+        """
+        self.directory = directory
+        self.lease = lease
+        # Identifies this store's claims among the workers sharing the database
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        os.makedirs(directory, exist_ok=True)
+        self.events = JobEvents()
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(directory, 'jobs.sqlite3'),
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=30
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                filename TEXT,
+                params TEXT NOT NULL,
+                progress TEXT NOT NULL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (('owner', 'TEXT'), ('lease_until', 'REAL')):
+            if column not in columns:
+                try:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+                except sqlite3.OperationalError:
+                    # Another worker added it first
+                    pass
+
+    def input_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.input")
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.result")
+
+    def preview_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.preview")
+
+    def create(self, source: Union[bytes, str], filename: Optional[str], params: Dict[str, Any],
+               stages: List[str]) -> str:
+        """
+        Persist a new job and its input; returns the job ID
+
+        Args:
+            source: Input image bytes, or the path of a spooled upload, which
+                is moved into the job directory
+        """
+        job_id = uuid.uuid4().hex
+        if isinstance(source, str):
+            shutil.move(source, self.input_path(job_id))
+        else:
+            with open(self.input_path(job_id), 'wb') as f:
+                f.write(source)
+
+        now = time.time()
+        progress = {"current": None, "stages": {stage: 'pending' for stage in stages}}
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, filename, params, progress, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, filename, json.dumps(params), json.dumps(progress), now, now)
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def claim_next(self) -> Optional[Dict[str, Any]]:
+        """Atomically move the oldest queued job to running, leased to this store, and return it"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    now = time.time()
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, owner = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                        (RUNNING, self.owner, now + self.lease, now, row['id'])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = self._to_dict(row)
+        job['status'] = RUNNING
+        return job
+
+    def release(self, job_id: str) -> None:
+        """Put a claimed job back in the queue without touching its progress"""
+        self._set(job_id, status=QUEUED)
+
+    def renew(self, job_ids: List[str]) -> None:
+        """Extend the leases of jobs this store is running"""
+        if not job_ids:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = ?",
+                [(time.time() + self.lease, job_id, self.owner, RUNNING) for job_id in job_ids]
+            )
+
+    def update_progress(self, job_id: str, stage: str, state: str) -> None:
+        with self._lock:
+            row = self._conn.execute("SELECT progress FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            progress = json.loads(row['progress'])
+            progress['stages'][stage] = state
+            progress['current'] = stage if state == 'running' else None
+            self._conn.execute(
+                "UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(progress), time.time(), job_id)
+            )
+        self.events.notify(job_id)
+
+    def complete(self, job_id: str, result: bytes) -> None:
+        self._write(self.result_path(job_id), result)
+        self._set(job_id, status=SUCCEEDED)
+
+    def set_preview(self, job_id: str, preview: bytes) -> None:
+        self._write(self.preview_path(job_id), preview)
+        self.events.notify(job_id)
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def fail(self, job_id: str, error: str) -> None:
+        self._set(job_id, status=FAILED, error=error)
+
+    def requeue_interrupted(self) -> int:
+        """Return running jobs whose lease ran out (their worker stopped) to the queue"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, updated_at = ? "
+                "WHERE status = ? AND (lease_until IS NULL OR lease_until < ?)",
+                (QUEUED, now, RUNNING, now)
+            )
+        return cursor.rowcount
+
+    def purge(self, max_age_seconds: float) -> int:
+        """Delete finished jobs (and their files) older than `max_age_seconds`"""
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (SUCCEEDED, FAILED, cutoff)
+            ).fetchall()
+            self._conn.executemany("DELETE FROM jobs WHERE id = ?", [(row['id'],) for row in rows])
+
+        for row in rows:
+            for path in (self.input_path(row['id']), self.result_path(row['id']), self.preview_path(row['id'])):
+                if os.path.exists(path):
+                    os.remove(path)
+        return len(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _set(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id)
+            )
+        self.events.notify(job_id)
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "id": row['id'],
+            "status": row['status'],
+            "filename": row['filename'],
+            "params": json.loads(row['params']),
+            "progress": json.loads(row['progress']),
+            "error": row['error'],
+            "created_at": row['created_at'],
+            "updated_at": row['updated_at']
+        }
+
+
+class JobQueue:
+    """
+    Drains a JobStore with a fixed number of asyncio workers.
+
+    Each worker claims one job at a time and runs `process_image` on the I/O
+    worker pool, recording per-stage progress as the pipeline advances. A
+    heartbeat renews the leases of the jobs running here and requeues jobs
+    whose worker (possibly another process) stopped renewing theirs.
+    """
+
+    def __init__(self, store: JobStore, pool, process: Callable[..., bytes],
+                 concurrency: int = 2, poll_interval: float = 1.0,
+                 preview: Optional[Callable[..., bytes]] = None):
+        """
+        Args:
+            store: Job persistence
+            pool: executor.WorkerPool the pipelines run on
+            process: Pipeline entry point, called as process(input_path, progress_callback=..., **params)
+            concurrency: Number of jobs processed at the same time
+            poll_interval: Seconds between queue checks when idle
+            preview: Quick preview entry point, called as preview(input_path, **params)
+        """
+        self.store = store
+        self.pool = pool
+        self.process = process
+        self.preview = preview
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._running: Set[str] = set()
+
+    async def start(self) -> None:
+        self._requeue()
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self) -> None:
+        """Stop claiming jobs; waits for the running ones, whose leases are renewed until they finish"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+
+    def submit(self, source: Union[bytes, str], filename: Optional[str], params: Dict[str, Any],
+               stages: List[str], preview: bool = False) -> str:
+        """
+        Queue a job; returns its ID
+
+        Args:
+            preview: Also render a quick preview right away, without waiting
+                for a queue slot (must be called from the event loop)
+        """
+        job_id = self.store.create(source, filename, params, stages)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if preview and self.preview is not None:
+            asyncio.get_running_loop().create_task(self._make_preview(job_id, params))
+        return job_id
+
+    async def _make_preview(self, job_id: str, params: Dict[str, Any]) -> None:
+        try:
+            await self.pool.run(self._run_preview, job_id, params)
+        except Exception as e:
+            # The full result still follows; the client just waits for it
+            logger.warning(f"Preview for job {job_id} failed: {str(e)}")
+
+    def _run_preview(self, job_id: str, params: Dict[str, Any]) -> None:
+        self.store.set_preview(job_id, self.preview(self.store.input_path(job_id), **params))
+
+    def _requeue(self) -> None:
+        requeued = self.store.requeue_interrupted()
+        if requeued:
+            logger.info(f"Requeued {requeued} interrupted job(s)")
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    async def _heartbeat(self) -> None:
+        # Renewing three times per lease rides out a slow tick or two
+        interval = self.store.lease / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.store.renew, list(self._running))
+                await asyncio.to_thread(self._requeue)
+            except sqlite3.Error as e:
+                logger.warning(f"Job lease heartbeat failed: {str(e)}")
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job = await asyncio.to_thread(self.store.claim_next)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._running.add(job['id'])
+            run = asyncio.ensure_future(self.pool.run(self._run_job, job))
+            try:
+                await asyncio.shield(run)
+            except PoolSaturated as e:
+                # Interactive requests are holding every slot; try again later
+                self.store.release(job['id'])
+                await asyncio.sleep(e.retry_after)
+            except asyncio.CancelledError:
+                # The pipeline thread cannot be interrupted. Releasing the job
+                # now would let another worker run it a second time, so it
+                # keeps its lease until the thread has recorded the outcome
+                logger.info(f"Waiting for job {job['id']} to finish before stopping")
+                await asyncio.wait([run])
+                if isinstance(run.exception(), PoolSaturated):
+                    self.store.release(job['id'])
+                raise
+            finally:
+                self._running.discard(job['id'])
+
+    def _run_job(self, job: Dict[str, Any]) -> None:
+        job_id = job['id']
+        logger.info(f"Running job {job_id}")
+
+        def on_progress(stage: str, state: str) -> None:
+            self.store.update_progress(job_id, stage, state)
+
+        try:
+            result = self.process(self.store.input_path(job_id), progress_callback=on_progress, **job['params'])
+            self.store.complete(job_id, result)
+            logger.info(f"Job {job_id} completed")
+        except PoolSaturated:
+            # The CPU pool stayed full; _worker() puts the job back in the queue
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}")
+            self.store.fail(job_id, str(e))
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> bytes:
+    """One Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+async def stream_job_events(store: JobStore, job_id: str, poll_interval: float = 1.0,
+                            keepalive: float = 15.0) -> AsyncIterator[bytes]:
+    """
+    Server-Sent Events for one job, until it succeeds or fails
+
+    Events:
+        status: {"status"} whenever the job status changes
+        progress: {"stage", "state"} for each stage transition
+        preview: {"url", "image"} once the quick preview exists; `image`
+            is the JPEG as a data URI
+        done: {"result_url"} when the full result is ready
+        failed: {"error"}
+    """
+    status = None
+    stages: Dict[str, str] = {}
+    sent_preview = False
+    last_sent = time.monotonic()
+    waiter = None
+    try:
+        while True:
+            waiter = store.events.listen(job_id)
+            job = await asyncio.to_thread(store.get, job_id)
+            if job is None:
+                yield sse_event('failed', {"error": "Job not found"})
+                return
+
+            sent = False
+            if job['status'] != status:
+                status = job['status']
+                yield sse_event('status', {"status": status})
+                sent = True
+            for stage, state in job['progress']['stages'].items():
+                if stages.get(stage, 'pending') != state:
+                    stages[stage] = state
+                    yield sse_event('progress', {"stage": stage, "state": state})
+                    sent = True
+            if not sent_preview and os.path.exists(store.preview_path(job_id)):
+                with open(store.preview_path(job_id), 'rb') as f:
+                    preview = base64.b64encode(f.read()).decode('ascii')
+                sent_preview = True
+                yield sse_event('preview', {"url": f"/api/jobs/{job_id}/preview",
+                                       "image": f"data:image/jpeg;base64,{preview}"})
+                sent = True
+
+            if status == SUCCEEDED:
+                yield sse_event('done', {"result_url": f"/api/jobs/{job_id}/result"})
+                return
+            if status == FAILED:
+                yield sse_event('failed', {"error": job['error']})
+                return
+
+            now = time.monotonic()
+            if sent:
+                last_sent = now
+            elif now - last_sent >= keepalive:
+                # Keeps proxies from closing a quiet connection
+                last_sent = now
+                yield b": keepalive\n\n"
+            await waiter.wait(poll_interval)
+    finally:
+        if waiter is not None:
+            waiter.close()
@@ -0,0 +1,93 @@
+import importlib
+import logging
+import threading
+import time
+import types
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_modules: Dict[str, "LazyModule"] = {}
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    `cv2 = lazy_import('cv2')` at the top of a file reads like the import
+    it replaces, but numpy, OpenCV, PIL and the HTTP clients only load when
+    a stage first uses them. After loading, the module's namespace is copied
+    onto the proxy, so later lookups cost the same as on the module itself.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__['_lazy_module'] = None
+        self.__dict__['_lazy_missing'] = False
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            # importlib serialises concurrent imports of the same module
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        # Only reached for names not yet copied over, i.e. before loading
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self.__dict__['_lazy_module'] is not None else 'not loaded'
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """The (shared) lazy stand-in for module `name`"""
+    with _lock:
+        module = _modules.get(name)
+        if module is None:
+            module = _modules[name] = LazyModule(name)
+        return module
+
+
+def available(module: LazyModule) -> bool:
+    """Load an optional module; False when it is not installed (remembered)"""
+    if module.__dict__['_lazy_missing']:
+        return False
+    try:
+        module._load()
+    except ImportError:
+        module.__dict__['_lazy_missing'] = True
+        return False
+    return True
+
+
+def preload(names: Optional[List[str]] = None) -> Dict[str, float]:
+    """
+    Import lazy modules now, e.g. before a server reports ready
+
+    Args:
+        names: Modules to load (defaults to every module declared lazy)
+
+    Returns:
+        Seconds spent importing each module that loaded; modules that are
+        not installed (optional backends) are skipped
+    """
+    with _lock:
+        modules = [module for name, module in _modules.items() if names is None or name in names]
+    timings = {}
+    for module in modules:
+        if module.__dict__['_lazy_module'] is not None:
+            continue
+        start = time.perf_counter()
+        if available(module):
+            timings[module.__name__] = round(time.perf_counter() - start, 3)
+        else:
+            logger.debug(f"Skipped preloading {module.__name__}: not installed")
+    return timings
@@ -0,0 +1,281 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+MEGAPIXEL_BUCKETS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 12.0, 24.0, 48.0, 100.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """Monotonic counter with labels, rendered in Prometheus text format"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge:
+    """Gauge whose value is read from a callback when metrics are scraped"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str],
+                 collect: Callable[[], Dict[LabelValues, float]]):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def samples(self) -> List[str]:
+        try:
+            items = sorted(self.collect().items())
+        except Exception as e:
+            logger.warning(f"Could not collect {self.name}: {str(e)}")
+            return []
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram:
+    """Cumulative histogram with labels, rendered in Prometheus text format"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._lock = threading.Lock()
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts, then sum and count
+                state = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state):
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {_format_value(count)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {_format_value(state[-1])}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics exposed on /metrics"""
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def register(self, metric: Any) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    'photo_stage_duration_seconds', 'Wall time per pipeline stage', ('stage', 'path')))
+STAGE_CPU = REGISTRY.register(Histogram(
+    'photo_stage_cpu_seconds', 'CPU time of the calling thread per pipeline stage', ('stage', 'path')))
+STAGE_PIXELS = REGISTRY.register(Histogram(
+    'photo_stage_megapixels', 'Image size entering and leaving each stage', ('stage', 'direction'),
+    buckets=MEGAPIXEL_BUCKETS))
+STAGE_BYTES = REGISTRY.register(Counter(
+    'photo_stage_bytes_total', 'Bytes encoded, uploaded and downloaded per stage', ('stage', 'direction')))
+STAGE_RUNS = REGISTRY.register(Counter(
+    'photo_stage_runs_total', 'Stage executions by path taken (remote, fallback, local, skipped, cached)',
+    ('stage', 'path')))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'photo_request_duration_seconds', 'HTTP request latency', ('endpoint',)))
+REQUESTS = REGISTRY.register(Counter(
+    'photo_requests_total', 'HTTP requests by endpoint and status code', ('endpoint', 'status')))
+COALESCED = REGISTRY.register(Counter(
+    'photo_coalesced_requests_total',
+    'Restorations that joined an identical one in flight (joined), stopped waiting (cancelled) '
+    'or were stopped because every caller had gone (abandoned)', ('outcome',)))
+MODEL_CALLS = REGISTRY.register(Counter(
+    'photo_model_calls_total',
+    'Remote model calls by outcome (ok, error, timeout, or rejected by an open circuit breaker)',
+    ('backend', 'model', 'outcome')))
+MODEL_HEDGES = REGISTRY.register(Counter(
+    'photo_model_hedges_total', 'Extra model calls started because the first was slow or failed early',
+    ('backend', 'model')))
+
+
+class StageRecord:
+    """Measurements of one stage of one request"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.path = 'local'
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.size_in: Optional[Tuple[int, int]] = None
+        self.size_out: Optional[Tuple[int, int]] = None
+        self.bytes = {"encoded": 0, "uploaded": 0, "downloaded": 0}
+        self.transfer_s = {"encode": 0.0, "upload": 0.0, "decode": 0.0}
+
+    def output(self, image: Any) -> None:
+        """Record the dimensions of the stage output"""
+        if image is not None and hasattr(image, 'shape'):
+            self.size_out = (int(image.shape[1]), int(image.shape[0]))
+
+    def add_transfer(self, stats: Dict[str, Dict[str, Any]]) -> None:
+        """Fold in statistics collected by ImageTransfer.record()"""
+        for entry in stats.values():
+            self.bytes["encoded"] += entry.get("encoded_bytes", 0)
+            self.bytes["uploaded"] += entry.get("uploaded_bytes", 0)
+            self.bytes["downloaded"] += entry.get("downloaded_bytes", 0)
+            self.transfer_s["encode"] += entry.get("encode_s", 0.0)
+            self.transfer_s["upload"] += entry.get("upload_s", 0.0)
+            self.transfer_s["decode"] += entry.get("decode_s", 0.0)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "stage": self.name,
+            "path": self.path,
+            "wall_s": round(self.wall_s, 6),
+            "cpu_s": round(self.cpu_s, 6),
+            "size_in": self.size_in,
+            "size_out": self.size_out,
+            "bytes": dict(self.bytes),
+            "transfer_s": {k: round(v, 6) for k, v in self.transfer_s.items()}
+        }
+
+
+class PipelineTrace:
+    """
+    Per-request collection of stage measurements.
+
+    Every finished stage is also observed into the global Prometheus
+    metrics, and the whole trace can be rendered as a Server-Timing header.
+    """
+
+    def __init__(self):
+        self.stages: List[StageRecord] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, image: Any = None) -> Iterator[StageRecord]:
+        """
+        Measure a stage
+
+        Args:
+            name: Stage name
+            image: Stage input, used to record input dimensions
+        """
+        record = StageRecord(name)
+        if image is not None and hasattr(image, 'shape'):
+            record.size_in = (int(image.shape[1]), int(image.shape[0]))
+
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield record
+        finally:
+            record.wall_s = time.perf_counter() - wall_start
+            record.cpu_s = time.thread_time() - cpu_start
+            with self._lock:
+                self.stages.append(record)
+            self._observe(record)
+
+    def add(self, record: StageRecord) -> None:
+        """Record a stage measured elsewhere, e.g. in a worker process"""
+        with self._lock:
+            self.stages.append(record)
+        self._observe(record)
+
+    def mark(self, name: str, path: str) -> None:
+        """Record a stage that did not run (skipped or served from cache)"""
+        record = StageRecord(name)
+        record.path = path
+        with self._lock:
+            self.stages.append(record)
+        STAGE_RUNS.inc(stage=name, path=path)
+
+    @staticmethod
+    def _observe(record: StageRecord) -> None:
+        STAGE_RUNS.inc(stage=record.name, path=record.path)
+        STAGE_DURATION.observe(record.wall_s, stage=record.name, path=record.path)
+        STAGE_CPU.observe(record.cpu_s, stage=record.name, path=record.path)
+        for direction, size in (('in', record.size_in), ('out', record.size_out)):
+            if size:
+                STAGE_PIXELS.observe(size[0] * size[1] / 1e6, stage=record.name, direction=direction)
+        for direction, count in record.bytes.items():
+            if count:
+                STAGE_BYTES.inc(count, stage=record.name, direction=direction)
+
+    def server_timing(self) -> str:
+        """Render the stages as a Server-Timing header value"""
+        entries = []
+        with self._lock:
+            stages = list(self.stages)
+        for record in stages:
+            entries.append(f'{record.name};desc="{record.path}";dur={record.wall_s * 1000:.1f}')
+        return ', '.join(entries)
+
+    def as_dicts(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [record.as_dict() for record in self.stages]
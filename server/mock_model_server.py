@@ -0,0 +1,386 @@
+"""
+Local stand-in for the Replicate HTTP API.
+
+Implements the endpoints the pipeline uses (model predictions, prediction
+polling and cancellation, completion webhooks, file uploads and file
+downloads) with a configurable per-model
+latency, so the full pipeline can be benchmarked or developed against
+without network access or API credits. Failures and slow outliers can be
+injected per model, to exercise the processor's circuit breakers and
+hedged requests. Point the processor at it with:
+
+    REPLICATE_BASE_URL=http://127.0.0.1:5001 REPLICATE_API_TOKEN=mock python3 photo_api.py
+
+Models echo their input image back; SwinIR resizes it by the requested
+scale so downstream stages see realistic image sizes.
+"""
+import argparse
+import base64
+import email.parser
+import email.policy
+import json
+import logging
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class MockModelServer:
+    """Threaded HTTP server emulating the subset of the Replicate API used by AIPhotoProcessor"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 1.0,
+                 model_latency: Optional[Dict[str, float]] = None, jitter: float = 0.0,
+                 error_rate: float = 0.0, seed: Optional[int] = None, max_files: int = 64,
+                 model_error_rate: Optional[Dict[str, float]] = None,
+                 tail_rate: float = 0.0, tail_latency: float = 0.0):
+        """
+        Args:
+            host: Interface to bind
+            port: Port to bind (0 picks a free port)
+            latency: Seconds each prediction takes to complete
+            model_latency: Per-model overrides keyed by model name (e.g. 'swinir')
+            jitter: Uniform random extra latency in seconds
+            error_rate: Fraction of predictions that fail
+            seed: Seed for the jitter, failure and tail draws
+            max_files: Uploaded and output files kept before the oldest are dropped
+            model_error_rate: Per-model error rate overrides keyed by model name
+            tail_rate: Fraction of predictions that are slow outliers
+            tail_latency: Extra seconds an outlier takes
+        """
+        self.latency = latency
+        self.model_latency = model_latency or {}
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.model_error_rate = model_error_rate or {}
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.max_files = max_files
+        self._files: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self._predictions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.requests = 0
+        self.cancelled = 0
+
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockModelServer":
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='mock-model-server', daemon=True)
+        self._thread.start()
+        logger.info(f"Mock model server listening on {self.base_url}")
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "MockModelServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def configure(self, **settings: Any) -> None:
+        """
+        Change latency, jitter, error or tail settings while serving, e.g.
+        configure(model_error_rate={'swinir': 1.0}) to take one model down
+        """
+        with self._lock:
+            for name, value in settings.items():
+                if name not in ('latency', 'model_latency', 'jitter', 'error_rate',
+                                'model_error_rate', 'tail_rate', 'tail_latency'):
+                    raise ValueError(f"Unknown mock server setting: {name}")
+                setattr(self, name, value)
+
+    def _delay(self, model: str) -> float:
+        with self._lock:
+            extra = self._random.uniform(0, self.jitter) if self.jitter else 0.0
+            if self.tail_rate > 0 and self._random.random() < self.tail_rate:
+                extra += self.tail_latency
+            return self.model_latency.get(model, self.latency) + extra
+
+    def _should_fail(self, model: str) -> bool:
+        with self._lock:
+            rate = self.model_error_rate.get(model, self.error_rate)
+            return rate > 0 and self._random.random() < rate
+
+    def store_file(self, data: bytes, content_type: str) -> str:
+        file_id = uuid.uuid4().hex
+        with self._lock:
+            self._files[file_id] = (data, content_type)
+            while len(self._files) > self.max_files:
+                self._files.popitem(last=False)
+        return file_id
+
+    def get_file(self, file_id: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            return self._files.get(file_id)
+
+    def _read_input(self, value: str) -> bytes:
+        if value.startswith('data:'):
+            return base64.b64decode(value.split(',', 1)[1])
+        prefix = f"{self.base_url}/files/"
+        if value.startswith(prefix):
+            stored = self.get_file(value[len(prefix):])
+            if stored is None:
+                raise ValueError(f"Unknown file {value}")
+            return stored[0]
+        with urllib.request.urlopen(value, timeout=30) as response:
+            return response.read()
+
+    def _run_model(self, model: str, inputs: Dict[str, Any]) -> bytes:
+        data = self._read_input(str(inputs.get('image', '')))
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Input is not a decodable image")
+        if model == 'swinir':
+            scale = int(inputs.get('scale', 4))
+            height, width = image.shape[:2]
+            image = cv2.resize(image, (width * scale, height * scale), interpolation=cv2.INTER_CUBIC)
+        ok, encoded = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok:
+            raise ValueError("Could not encode output")
+        return encoded.tobytes()
+
+    def create_prediction(self, owner: str, name: str, inputs: Dict[str, Any],
+                          webhook: Optional[str] = None) -> Dict[str, Any]:
+        prediction_id = uuid.uuid4().hex
+        latency = self._delay(name)
+        prediction = {
+            "id": prediction_id,
+            "model": f"{owner}/{name}",
+            "version": "mock",
+            "status": "starting",
+            "input": {k: v for k, v in inputs.items() if k != 'image'},
+            "output": None,
+            "logs": "",
+            "error": None,
+            "metrics": {},
+            "created_at": _now(),
+            "started_at": None,
+            "completed_at": None,
+            "urls": {
+                "get": f"{self.base_url}/v1/predictions/{prediction_id}",
+                "cancel": f"{self.base_url}/v1/predictions/{prediction_id}/cancel"
+            },
+            "_latency": latency,
+            "_ready_at": time.monotonic() + latency,
+            "_name": name,
+            "_inputs": inputs
+        }
+        with self._lock:
+            self._predictions[prediction_id] = prediction
+            while len(self._predictions) > self.max_files * 4:
+                self._predictions.popitem(last=False)
+        if webhook:
+            timer = threading.Timer(latency, self._send_webhook, (prediction_id, webhook))
+            timer.daemon = True
+            timer.start()
+        return prediction
+
+    def _send_webhook(self, prediction_id: str, url: str) -> None:
+        prediction = self.settle(prediction_id)
+        if prediction is None or prediction['status'] == 'canceled':
+            return
+        request = urllib.request.Request(url, data=json.dumps(prediction).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+        except Exception as e:
+            logger.warning(f"Webhook for prediction {prediction_id} failed: {str(e)}")
+
+    def cancel(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            prediction = self._predictions.get(prediction_id)
+            if prediction is None:
+                return None
+            if prediction['status'] in ('starting', 'processing'):
+                prediction['status'] = 'canceled'
+                prediction['completed_at'] = _now()
+                self.cancelled += 1
+        return {k: v for k, v in prediction.items() if not k.startswith('_')}
+
+    def settle(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        """Complete a prediction whose latency has elapsed and return its public view"""
+        with self._lock:
+            prediction = self._predictions.get(prediction_id)
+            if prediction is None:
+                return None
+            run = prediction['status'] == 'starting' and time.monotonic() >= prediction['_ready_at']
+            if run:
+                prediction['status'] = 'processing'
+                prediction['started_at'] = _now()
+        if run:
+            try:
+                if self._should_fail(prediction['_name']):
+                    raise RuntimeError("Simulated model failure")
+                output = self._run_model(prediction['_name'], prediction['_inputs'])
+                file_id = self.store_file(output, 'image/png')
+                prediction['output'] = f"{self.base_url}/files/{file_id}"
+                prediction['status'] = 'succeeded'
+            except Exception as e:
+                prediction['error'] = str(e)
+                prediction['status'] = 'failed'
+            prediction['completed_at'] = _now()
+            prediction['metrics'] = {"predict_time": prediction['_latency']}
+        return {k: v for k, v in prediction.items() if not k.startswith('_')}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format: str, *args: Any) -> None:
+                logger.debug(format % args)
+
+            def _send(self, status: int, body: bytes, content_type: str = 'application/json') -> None:
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, status: int, payload: Any) -> None:
+                self._send(status, json.dumps(payload).encode('utf-8'))
+
+            def _body(self) -> bytes:
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def do_GET(self) -> None:
+                with server._lock:
+                    server.requests += 1
+                parts = self.path.strip('/').split('/')
+                if len(parts) == 2 and parts[0] == 'files':
+                    stored = server.get_file(parts[1])
+                    if stored is None:
+                        return self._json(404, {"detail": "Not found"})
+                    return self._send(200, stored[0], stored[1])
+                if len(parts) == 3 and parts[:2] == ['v1', 'predictions']:
+                    prediction = server.settle(parts[2])
+                    if prediction is None:
+                        return self._json(404, {"detail": "Not found"})
+                    return self._json(200, prediction)
+                self._json(404, {"detail": "Not found"})
+
+            def do_POST(self) -> None:
+                with server._lock:
+                    server.requests += 1
+                parts = self.path.strip('/').split('/')
+                body = self._body()
+                if parts == ['v1', 'files']:
+                    return self._create_file(body)
+                if len(parts) == 5 and parts[:2] == ['v1', 'models'] and parts[4] == 'predictions':
+                    try:
+                        request = json.loads(body or b'{}')
+                    except ValueError:
+                        return self._json(400, {"detail": "Invalid JSON"})
+                    prediction = server.create_prediction(parts[2], parts[3], request.get('input', {}),
+                                                          request.get('webhook'))
+                    # "Prefer: wait" blocks until the prediction finishes, as the real API does
+                    if self.headers.get('Prefer', '').startswith('wait'):
+                        time.sleep(max(0.0, prediction['_ready_at'] - time.monotonic()))
+                    return self._json(201, server.settle(prediction['id']))
+                if len(parts) == 4 and parts[:2] == ['v1', 'predictions'] and parts[3] == 'cancel':
+                    prediction = server.cancel(parts[2])
+                    if prediction is None:
+                        return self._json(404, {"detail": "Not found"})
+                    return self._json(200, prediction)
+                self._json(404, {"detail": "Not found"})
+
+            def _create_file(self, body: bytes) -> None:
+                header = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode('latin-1')
+                message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + body)
+                for part in message.iter_parts():
+                    if part.get_param('name', header='content-disposition') != 'content':
+                        continue
+                    data = part.get_payload(decode=True) or b''
+                    content_type = part.get_content_type()
+                    file_id = server.store_file(data, content_type)
+                    return self._json(201, {
+                        "id": file_id,
+                        "name": part.get_filename() or file_id,
+                        "content_type": content_type,
+                        "size": len(data),
+                        "etag": file_id,
+                        "checksums": {},
+                        "metadata": {},
+                        "created_at": _now(),
+                        "expires_at": None,
+                        "urls": {"get": f"{server.base_url}/files/{file_id}"}
+                    })
+                self._json(400, {"detail": "Missing file content"})
+
+        return Handler
+
+
+def _parse_per_model(values) -> Dict[str, float]:
+    settings = {}
+    for value in values or []:
+        model, _, number = value.partition('=')
+        settings[model] = float(number)
+    return settings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock Replicate API for local development and benchmarks")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency', type=float, default=1.0, help="Seconds per prediction")
+    parser.add_argument('--model-latency', action='append', metavar='MODEL=SECONDS',
+                        help="Per-model latency, e.g. swinir=4 (repeatable)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random extra seconds per prediction")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of predictions that fail")
+    parser.add_argument('--model-error-rate', action='append', metavar='MODEL=RATE',
+                        help="Per-model error rate, e.g. swinir=1 (repeatable)")
+    parser.add_argument('--tail-rate', type=float, default=0.0, help="Fraction of predictions that are slow outliers")
+    parser.add_argument('--tail-latency', type=float, default=0.0, help="Extra seconds per slow outlier")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--max-files', type=int, default=64, help="Files kept in memory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = MockModelServer(
+        host=args.host, port=args.port, latency=args.latency,
+        model_latency=_parse_per_model(args.model_latency),
+        jitter=args.jitter, error_rate=args.error_rate, seed=args.seed, max_files=args.max_files,
+        model_error_rate=_parse_per_model(args.model_error_rate),
+        tail_rate=args.tail_rate, tail_latency=args.tail_latency
+    )
+    logger.info(f"Mock model server listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
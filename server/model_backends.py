@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import glob
+import logging
+import os
+import re
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+from lazy import available, lazy_import
+from tiling import TileEngine
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+# Optional: only the ONNX backend needs it
+onnxruntime = lazy_import('onnxruntime')
+
+logger = logging.getLogger(__name__)
+
+# Backends a deployment or a request can select (PHOTO_MODEL_BACKEND / model_backend)
+BACKENDS = ('replicate', 'onnx')
+
+SWINIR_FILE = re.compile(r'swinir_x(\d)\.onnx$')
+
+
+class ModelBackend:
+    """
+    Runs the restoration models for AIPhotoProcessor.
+
+    run() takes an RGB uint8 image and the model's Replicate-style inputs
+    and returns an RGB uint8 image. It raises when the model fails, so the
+    processor can fall back to its OpenCV implementation.
+    """
+
+    name = 'base'
+    # Remote backends run under the processor's ModelGuard (deadline,
+    # circuit breaker, hedging); local ones are called directly
+    remote = False
+
+    def supports(self, model: str, inputs: Optional[Dict[str, Any]] = None) -> bool:
+        """Whether this backend can run `model` with these inputs right now"""
+        raise NotImplementedError
+
+    def run(self, model: str, image: np.ndarray, inputs: Dict[str, Any]) -> np.ndarray:
+        raise NotImplementedError
+
+    def warm_up(self) -> List[str]:
+        """Load whatever the first request would otherwise wait for; returns the models loaded"""
+        return []
+
+    def describe(self) -> Dict[str, Any]:
+        """Status for the health endpoint"""
+        return {}
+
+
+class ReplicateBackend(ModelBackend):
+    """
+    The hosted models on Replicate.
+
+    Reads the API key, transfer settings and download client from the
+    processor at call time, so they can be changed after construction.
+    """
+
+    name = 'replicate'
+    remote = True
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def supports(self, model: str, inputs: Optional[Dict[str, Any]] = None) -> bool:
+        return bool(self.processor.api_key) and model in self.processor.model_versions
+
+    def submit(self, model: str, image: np.ndarray, inputs: Dict[str, Any]) -> Future:
+        """Create the prediction and return a Future of the output image, without waiting"""
+        processor = self.processor
+        model_input = {"image": processor.transfer.prepare_input(image, model)}
+        model_input.update(inputs)
+
+        return processor.predictions.submit(
+            processor.model_versions[model], model_input,
+            lambda output: processor._download_image_from_url(str(output), stage=model)
+        )
+
+    def run(self, model: str, image: np.ndarray, inputs: Dict[str, Any]) -> np.ndarray:
+        return self.submit(model, image, inputs).result()
+
+    def describe(self) -> Dict[str, Any]:
+        return {"available": bool(self.processor.api_key)}
+
+
+class OnnxBackend(ModelBackend):
+    """
+    Compact restoration models on ONNX Runtime's CPU provider.
+
+    Models are read from `model_dir`:
+    - swinir_x2.onnx, swinir_x3.onnx, swinir_x4.onnx: SwinIR-class
+      super-resolution taking and returning NCHW float32 RGB in [0, 1].
+      Inference runs tile by tile, so memory stays bounded on large
+      images; a scale without its own file uses the nearest larger model
+      and resizes the result down
+    - ddcolor.onnx: DDColor(-tiny)-class colorization taking the gray
+      image as NCHW RGB at a fixed size and returning the LAB ab planes,
+      which are resized onto the full-resolution lightness
+
+    Sessions are created once per model file and shared by all requests;
+    ONNX Runtime sessions are safe to run from several threads.
+    CodeFormer and InstructIR are not available locally; they stay on
+    Replicate.
+    """
+
+    name = 'onnx'
+
+    def __init__(self, model_dir: str, threads: int = 0, tiles: Optional[TileEngine] = None,
+                 window: int = 8, color_size: int = 512):
+        """
+        Args:
+            model_dir: Directory holding the .onnx files
+            threads: Intra-op threads per inference (0 lets ONNX Runtime use every core)
+            tiles: Tile engine for super-resolution (defaults to 256px tiles, one at a time)
+            window: Tiles are padded to a multiple of this (the SwinIR window size)
+            color_size: Input size of the colorization model, unless the model fixes it
+        """
+        self.model_dir = model_dir
+        self.threads = max(0, threads)
+        self.tiles = tiles or TileEngine(tile_size=256, overlap=16, workers=1)
+        self.window = max(1, window)
+        self.color_size = color_size
+        self._sessions: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "OnnxBackend":
+        """Build from PHOTO_ONNX_MODEL_DIR, PHOTO_ONNX_THREADS and PHOTO_ONNX_TILE_* settings"""
+        default_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+        tile_workers = os.environ.get('PHOTO_ONNX_TILE_WORKERS')
+        return cls(
+            model_dir=os.environ.get('PHOTO_ONNX_MODEL_DIR', default_dir),
+            threads=int(os.environ.get('PHOTO_ONNX_THREADS', '0')),
+            tiles=TileEngine(
+                tile_size=int(os.environ.get('PHOTO_ONNX_TILE_SIZE', '256')),
+                overlap=int(os.environ.get('PHOTO_ONNX_TILE_OVERLAP', '16')),
+                workers=int(tile_workers) if tile_workers else 1
+            )
+        )
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Sessions are rebuilt on first use in another process
+        state = self.__dict__.copy()
+        state['_sessions'] = {}
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.model_dir, filename)
+
+    def _swinir_scales(self) -> Dict[int, str]:
+        scales = {}
+        for path in glob.glob(self._path('swinir_x*.onnx')):
+            match = SWINIR_FILE.search(path)
+            if match:
+                scales[int(match.group(1))] = path
+        return scales
+
+    def _swinir_model(self, scale: int) -> Optional[Tuple[int, str]]:
+        """(model scale, path) to reach `scale`: the exact model, else the nearest larger one"""
+        scales = self._swinir_scales()
+        candidates = sorted(s for s in scales if s >= scale)
+        if not candidates:
+            return None
+        return candidates[0], scales[candidates[0]]
+
+    def supports(self, model: str, inputs: Optional[Dict[str, Any]] = None) -> bool:
+        if not available(onnxruntime):
+            return False
+        if model == 'swinir':
+            return self._swinir_model(int((inputs or {}).get('scale', 4))) is not None
+        if model == 'ddcolor':
+            return os.path.exists(self._path('ddcolor.onnx'))
+        return False
+
+    def _session(self, path: str):
+        with self._lock:
+            session = self._sessions.get(path)
+            if session is None:
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads = self.threads
+                options.inter_op_num_threads = 1
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                session = onnxruntime.InferenceSession(path, sess_options=options,
+                                                       providers=['CPUExecutionProvider'])
+                self._sessions[path] = session
+                logger.info(f"Loaded ONNX model {os.path.basename(path)}")
+            return session
+
+    @staticmethod
+    def _fixed_size(session) -> Optional[Tuple[int, int]]:
+        """(height, width) when the model's input shape is static"""
+        shape = session.get_inputs()[0].shape
+        if len(shape) == 4 and isinstance(shape[2], int) and isinstance(shape[3], int):
+            return shape[2], shape[3]
+        return None
+
+    def run(self, model: str, image: np.ndarray, inputs: Dict[str, Any]) -> np.ndarray:
+        if model == 'swinir':
+            return self._super_resolve(image, int(inputs.get('scale', 4)))
+        if model == 'ddcolor':
+            return self._colorize(image)
+        raise ValueError(f"Model '{model}' is not available on the ONNX backend")
+
+    def _super_resolve(self, image: np.ndarray, scale: int) -> np.ndarray:
+        found = self._swinir_model(scale)
+        if found is None:
+            raise ValueError(f"No SwinIR ONNX model for scale {scale} in {self.model_dir}")
+        model_scale, path = found
+        session = self._session(path)
+        input_name = session.get_inputs()[0].name
+        fixed = self._fixed_size(session)
+        tiles = self.tiles
+        if fixed is not None and tiles.tile_size + 2 * tiles.overlap > min(fixed):
+            # A static input shape bounds the tile, margins included
+            tiles = TileEngine(tile_size=min(fixed) - 2 * tiles.overlap, overlap=tiles.overlap,
+                               workers=tiles.workers)
+
+        def upscale_tile(tile: np.ndarray) -> np.ndarray:
+            height, width = tile.shape[:2]
+            if fixed is not None:
+                pad_h, pad_w = fixed[0] - height, fixed[1] - width
+            else:
+                pad_h, pad_w = -height % self.window, -width % self.window
+            if pad_h or pad_w:
+                tile = cv2.copyMakeBorder(tile, 0, pad_h, 0, pad_w, cv2.BORDER_REFLECT_101)
+            batch = (tile.astype(np.float32) * (1.0 / 255.0)).transpose(2, 0, 1)[None]
+            output = session.run(None, {input_name: batch})[0][0]
+            output = output[:, :height * model_scale, :width * model_scale].transpose(1, 2, 0)
+            return np.clip(np.rint(output * 255.0), 0, 255).astype(np.uint8)
+
+        upscaled = tiles.map(image, upscale_tile, scale=model_scale)
+        if model_scale != scale:
+            height, width = image.shape[:2]
+            upscaled = cv2.resize(upscaled, (width * scale, height * scale), interpolation=cv2.INTER_AREA)
+        return upscaled
+
+    def _colorize(self, image: np.ndarray) -> np.ndarray:
+        session = self._session(self._path('ddcolor.onnx'))
+        input_name = session.get_inputs()[0].name
+        size = self._fixed_size(session) or (self.color_size, self.color_size)
+        height, width = image.shape[:2]
+
+        rgb = image.astype(np.float32) * (1.0 / 255.0)
+        lightness = cv2.cvtColor(rgb, cv2.COLOR_RGB2LAB)[:, :, :1]
+
+        # The model sees the lightness only, as a gray RGB image
+        small = cv2.resize(rgb, (size[1], size[0]), interpolation=cv2.INTER_AREA)
+        small_l = cv2.cvtColor(small, cv2.COLOR_RGB2LAB)[:, :, :1]
+        gray_lab = np.concatenate([small_l, np.zeros_like(small_l), np.zeros_like(small_l)], axis=2)
+        gray_rgb = cv2.cvtColor(gray_lab, cv2.COLOR_LAB2RGB)
+
+        ab = session.run(None, {input_name: gray_rgb.transpose(2, 0, 1)[None]})[0][0]
+        ab = cv2.resize(ab.transpose(1, 2, 0), (width, height), interpolation=cv2.INTER_LINEAR)
+        colorized = cv2.cvtColor(np.concatenate([lightness, ab], axis=2), cv2.COLOR_LAB2RGB)
+        return np.clip(np.rint(colorized * 255.0), 0, 255).astype(np.uint8)
+
+    def warm_up(self) -> List[str]:
+        """Create every session and run each model once on a small input"""
+        if not available(onnxruntime):
+            return []
+        warmed = []
+        sample = np.full((64, 64, 3), 128, dtype=np.uint8)
+        for scale in sorted(self._swinir_scales()):
+            self._super_resolve(sample, scale)
+            warmed.append(f'swinir_x{scale}')
+        if self.supports('ddcolor'):
+            self._colorize(sample)
+            warmed.append('ddcolor')
+        return warmed
+
+    def describe(self) -> Dict[str, Any]:
+        models = [f'swinir_x{scale}' for scale in sorted(self._swinir_scales())]
+        if os.path.exists(self._path('ddcolor.onnx')):
+            models.append('ddcolor')
+        # The runtime is only imported when there are models for it
+        runtime = onnxruntime.__version__ if models and available(onnxruntime) else None
+        return {
+            "available": runtime is not None,
+            "runtime": runtime,
+            "models": models,
+            "loaded": len(self._sessions)
+        }
@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from lazy import lazy_import
+from metrics import MODEL_CALLS, MODEL_HEDGES
+from model_slots import ModelSlots, Slot
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a model whose circuit breaker is open"""
+
+
+class ModelTimeout(Exception):
+    """Raised when a model call misses its deadline"""
+
+
+class ModelThrottled(ModelTimeout):
+    """Raised when a model's concurrency cap left no slot free in time"""
+
+
+class CircuitBreaker:
+    """
+    Failure tracking for one model.
+
+    Opens after `failure_threshold` consecutive failures; while open, calls
+    are refused so the pipeline goes straight to its fallback. After
+    `reset_timeout` seconds one trial call is let through: success closes
+    the breaker, failure opens it again for twice as long (up to
+    `max_reset_timeout`).
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 max_reset_timeout: float = 300.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max(reset_timeout, max_reset_timeout)
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._open_for = reset_timeout
+        self._trial = False
+        self.last_error: Optional[str] = None
+        self.totals = {"ok": 0, "error": 0, "timeout": 0, "rejected": 0}
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead; in half-open state only one trial at a time"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self._open_for:
+                self.state = HALF_OPEN
+                self._trial = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            self.totals["rejected"] += 1
+            return False
+
+    def trial(self) -> bool:
+        """Whether the call just allowed is the half-open trial"""
+        with self._lock:
+            return self.state == HALF_OPEN
+
+    def release_trial(self) -> None:
+        """Give back a half-open trial that never reached the model, so the next call can probe it"""
+        with self._lock:
+            self._trial = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.totals["ok"] += 1
+            self.failures = 0
+            if self.state != CLOSED:
+                logger.info("Model recovered; closing its circuit breaker")
+            self.state = CLOSED
+            self._open_for = self.reset_timeout
+            self._trial = False
+
+    def record_failure(self, error: str, outcome: str = 'error') -> None:
+        with self._lock:
+            self.totals[outcome] += 1
+            self.failures += 1
+            self.last_error = error
+            if self.state == HALF_OPEN:
+                self._open_for = min(self._open_for * 2, self.max_reset_timeout)
+                self._open(f"trial call failed: {error}")
+            elif self.state == CLOSED and self.failures >= self.failure_threshold:
+                self._open(f"{self.failures} consecutive failures, last: {error}")
+
+    def _open(self, reason: str) -> None:
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._trial = False
+        logger.warning(f"Opening circuit breaker for {self._open_for:.0f}s: {reason}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = round(max(0.0, self._open_for - (time.monotonic() - self.opened_at)), 1)
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_in_s": retry_in,
+                "last_error": self.last_error,
+                **self.totals
+            }
+
+
+class ModelGuard:
+    """
+    Deadlines, circuit breakers and hedged requests for remote model calls.
+
+    Every (backend, model) pair has its own breaker and latency history:
+    - a call that misses its deadline raises ModelTimeout; calls started
+      through `start` are cancelled, plain ones finish in the background
+    - a model with an open breaker is not called at all (CircuitOpen), so
+      the stage falls back to OpenCV without waiting
+    - with hedging on, a second identical call starts when the first has
+      run longer than the model's recent latency quantile, and whichever
+      finishes first wins
+    - each attempt holds one of the model's call slots (see ModelSlots),
+      which caps calls across all API workers; the deadline starts once
+      the first slot is taken, and a hedge is skipped when none is free
+    """
+
+    def __init__(self, timeout: float = 120.0, timeouts: Optional[Dict[str, float]] = None,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 hedge: bool = False, hedge_quantile: float = 0.95,
+                 hedge_delay: float = 10.0, min_samples: int = 10, history: int = 100,
+                 workers: int = 32, slots: Optional[ModelSlots] = None):
+        """
+        Args:
+            timeout: Deadline in seconds for one model call, hedge included
+            timeouts: Per-model deadlines keyed by model name (e.g. 'swinir')
+            failure_threshold: Consecutive failures that open a breaker
+            reset_timeout: Seconds a breaker stays open before a trial call
+            hedge: Start a second call when the first one is slow
+            hedge_quantile: Latency quantile after which the hedge starts
+            hedge_delay: Hedge delay in seconds until `min_samples`
+                successful calls of the model have been timed
+            min_samples: Timed calls needed before the quantile is used
+            history: Latencies kept per model
+            workers: Threads running model calls, abandoned ones included
+            slots: Concurrency caps per model (defaults to none)
+        """
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_delay = hedge_delay
+        self.min_samples = max(1, min_samples)
+        self.history = history
+        self.workers = workers
+        self.slots = slots or ModelSlots()
+
+        self._lock = threading.Lock()
+        self._breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+        self._latencies: Dict[Tuple[str, str], deque] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def from_env(cls) -> "ModelGuard":
+        """
+        Build from PHOTO_MODEL_TIMEOUT, PHOTO_MODEL_TIMEOUTS (e.g.
+        'swinir=180,codeformer=60'), PHOTO_BREAKER_FAILURES,
+        PHOTO_BREAKER_RESET, PHOTO_MODEL_HEDGE, PHOTO_HEDGE_QUANTILE and
+        PHOTO_HEDGE_DELAY, with caps from ModelSlots.from_env()
+        """
+        timeouts = {}
+        for entry in os.environ.get('PHOTO_MODEL_TIMEOUTS', '').split(','):
+            model, _, seconds = entry.strip().partition('=')
+            if model and seconds:
+                timeouts[model] = float(seconds)
+        return cls(
+            timeout=float(os.environ.get('PHOTO_MODEL_TIMEOUT', '120')),
+            timeouts=timeouts,
+            failure_threshold=int(os.environ.get('PHOTO_BREAKER_FAILURES', '5')),
+            reset_timeout=float(os.environ.get('PHOTO_BREAKER_RESET', '30')),
+            hedge=os.environ.get('PHOTO_MODEL_HEDGE', '0') == '1',
+            hedge_quantile=float(os.environ.get('PHOTO_HEDGE_QUANTILE', '0.95')),
+            hedge_delay=float(os.environ.get('PHOTO_HEDGE_DELAY', '10')),
+            slots=ModelSlots.from_env()
+        )
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='photo-model')
+            return self._executor
+
+    def breaker(self, backend: str, model: str) -> CircuitBreaker:
+        key = (backend, model)
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self._breakers[key] = breaker
+                self._latencies[key] = deque(maxlen=self.history)
+            return breaker
+
+    def _hedge_after(self, key: Tuple[str, str]) -> float:
+        with self._lock:
+            samples = list(self._latencies[key])
+        if len(samples) < self.min_samples:
+            return self.hedge_delay
+        return float(np.quantile(samples, self.hedge_quantile))
+
+    def _submit(self, fn: Callable[[], Any], start: Optional[Callable[[], Future]], slot: Slot) -> Future:
+        started = time.perf_counter()
+        if start is not None:
+            try:
+                future = start()
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+        else:
+            # Each attempt gets its own copy of the caller's context, so
+            # per-request state such as transfer statistics follows the call
+            context = contextvars.copy_context()
+            future = self._pool().submit(context.run, fn)
+        future.started = started
+        # Cancelled attempts give their slot back too
+        future.add_done_callback(lambda _: slot.release())
+        return future
+
+    def call(self, backend: str, model: str, fn: Callable[[], Any],
+             start: Optional[Callable[[], Future]] = None, hedge: Optional[bool] = None) -> Any:
+        """
+        Run a model call under its deadline and breaker
+
+        Args:
+            backend: Backend name
+            model: Model name (key into model_versions)
+            fn: The call; it may run more than once when hedged
+            start: Starts the call and returns a Future of its result without
+                blocking; used instead of running `fn` on a guard thread.
+                Futures of abandoned attempts are cancelled.
+            hedge: Override the guard's hedging setting for this call
+
+        Raises:
+            CircuitOpen: If the model's breaker refuses the call
+            ModelThrottled: If the model's concurrency cap left no slot free
+            ModelTimeout: If no attempt finished before the deadline
+            Exception: Whatever the last failed attempt raised
+        """
+        breaker = self.breaker(backend, model)
+        key = (backend, model)
+        if not breaker.allow():
+            MODEL_CALLS.inc(backend=backend, model=model, outcome='rejected')
+            raise CircuitOpen(f"Circuit breaker for {model} on {backend} is open")
+
+        # Waiting for upstream capacity is not the model's fault: the breaker
+        # is left alone and the deadline only starts with the call
+        slot = self.slots.acquire(model)
+        if slot is None:
+            breaker.release_trial()
+            MODEL_CALLS.inc(backend=backend, model=model, outcome='throttled')
+            raise ModelThrottled(f"{model} on {backend} is at its limit of {self.slots.limits[model]} "
+                                 f"concurrent calls; no slot came free within {self.slots.wait:.0f}s")
+
+        # A half-open trial probes the model once; hedging would double the probe
+        hedge = (self.hedge if hedge is None else hedge) and not breaker.trial()
+        deadline = time.monotonic() + self.timeouts.get(model, self.timeout)
+        pending = {self._submit(fn, start, slot)}
+        hedge_at = time.monotonic() + self._hedge_after(key) if hedge else None
+        last_error: Optional[BaseException] = None
+
+        while pending:
+            now = time.monotonic()
+            wake = deadline if hedge_at is None else min(deadline, hedge_at)
+            done, pending = wait(pending, timeout=max(0.0, wake - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    latency = time.perf_counter() - future.started
+                    with self._lock:
+                        self._latencies[key].append(latency)
+                    breaker.record_success()
+                    MODEL_CALLS.inc(backend=backend, model=model, outcome='ok')
+                    for loser in pending:
+                        loser.cancel()
+                    return future.result()
+                last_error = error
+            if done and not pending and hedge_at is not None and time.monotonic() < deadline:
+                # The first attempt failed before the hedge started; try once more now
+                hedge_at = None
+                retry_slot = self.slots.acquire(model, block=False)
+                if retry_slot is not None:
+                    pending = {self._submit(fn, start, retry_slot)}
+                    MODEL_HEDGES.inc(backend=backend, model=model)
+                    continue
+            if not done and hedge_at is not None and time.monotonic() >= hedge_at and time.monotonic() < deadline:
+                hedge_at = None
+                # At the cap, a hedge would only queue behind other calls
+                hedge_slot = self.slots.acquire(model, block=False)
+                if hedge_slot is not None:
+                    logger.info(f"{model} on {backend} is slower than usual; sending a hedged request")
+                    pending.add(self._submit(fn, start, hedge_slot))
+                    MODEL_HEDGES.inc(backend=backend, model=model)
+                continue
+            if not done and time.monotonic() >= deadline:
+                message = f"{model} on {backend} did not finish within {self.timeouts.get(model, self.timeout):.0f}s"
+                breaker.record_failure(message, 'timeout')
+                MODEL_CALLS.inc(backend=backend, model=model, outcome='timeout')
+                for abandoned in pending:
+                    abandoned.cancel()
+                raise ModelTimeout(message)
+
+        breaker.record_failure(str(last_error))
+        MODEL_CALLS.inc(backend=backend, model=model, outcome='error')
+        raise last_error
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per backend and model: breaker state, call outcomes and latency percentiles"""
+        with self._lock:
+            items = [(key, breaker, list(self._latencies[key])) for key, breaker in self._breakers.items()]
+        result: Dict[str, Dict[str, Any]] = {}
+        for (backend, model), breaker, samples in items:
+            entry = breaker.stats()
+            if samples:
+                entry["latency_p50_s"] = round(float(np.quantile(samples, 0.5)), 3)
+                entry["latency_p95_s"] = round(float(np.quantile(samples, 0.95)), 3)
+            result.setdefault(backend, {})[model] = entry
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
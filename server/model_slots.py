@@ -0,0 +1,167 @@
+import fcntl
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Slot:
+    """One held call slot; release() is idempotent and may be called from any thread"""
+
+    __slots__ = ('_owner', 'model', '_fd')
+
+    def __init__(self, owner: Optional["ModelSlots"], model: str, fd: Optional[int]):
+        self._owner = owner
+        self.model = model
+        self._fd = fd
+
+    def release(self) -> None:
+        owner, self._owner = self._owner, None
+        if owner is not None:
+            owner._release(self.model, self._fd)
+
+
+class ModelSlots:
+    """
+    Caps on concurrent calls per remote model, shared by every API worker
+    process on the host.
+
+    A model limited to N calls has N slot files in `directory`, and a call
+    holds an exclusive flock on one of them until it finishes. The lock
+    belongs to the open file, so the kernel frees the slots of a worker that
+    crashes; the workers need no other coordination. Waiters in this
+    process are woken as soon as a slot here is released, and poll for
+    slots released by other processes. Models without a cap are not
+    counted.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, directory: Optional[str] = None,
+                 wait: float = 30.0, poll_interval: float = 0.05, max_poll_interval: float = 0.5):
+        """
+        Args:
+            limits: Concurrent calls allowed per model name, across workers
+            directory: Where the slot files live; every worker that should
+                share the caps must use the same one
+            wait: Seconds a call may wait for a slot
+            poll_interval: First delay between checks for a free slot
+            max_poll_interval: Upper bound of the backed-off delay
+        """
+        self.limits = {model: limit for model, limit in (limits or {}).items() if limit > 0}
+        self.directory = directory or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'slots')
+        self.wait = wait
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(poll_interval, max_poll_interval)
+        if self.limits:
+            os.makedirs(self.directory, exist_ok=True)
+
+        self._released = threading.Condition()
+        self._held: Dict[str, int] = {}
+        self._waiting: Dict[str, int] = {}
+        self.totals: Dict[str, Dict[str, int]] = {
+            model: {"acquired": 0, "waited": 0, "throttled": 0} for model in self.limits
+        }
+
+    @classmethod
+    def from_env(cls) -> "ModelSlots":
+        """
+        Build from PHOTO_MODEL_CONCURRENCY (e.g. 'swinir=4,codeformer=8'),
+        PHOTO_SLOT_DIR and PHOTO_MODEL_SLOT_WAIT
+        """
+        limits = {}
+        for entry in os.environ.get('PHOTO_MODEL_CONCURRENCY', '').split(','):
+            model, _, limit = entry.strip().partition('=')
+            if model and limit:
+                limits[model] = int(limit)
+        return cls(
+            limits=limits,
+            directory=os.environ.get('PHOTO_SLOT_DIR') or None,
+            wait=float(os.environ.get('PHOTO_MODEL_SLOT_WAIT', '30'))
+        )
+
+    def _try(self, model: str) -> Optional[int]:
+        """Lock a free slot file of `model`; returns its descriptor"""
+        limit = self.limits[model]
+        # Starting at a random slot keeps workers from all probing slot 0 first
+        first = random.randrange(limit)
+        for i in range(limit):
+            path = os.path.join(self.directory, f"{model}.{(first + i) % limit}")
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def acquire(self, model: str, block: bool = True) -> Optional[Slot]:
+        """
+        Take a call slot for `model`
+
+        Args:
+            model: Model name
+            block: Wait up to `wait` seconds for a slot; otherwise give up
+                at once
+
+        Returns:
+            The slot (one that counts nothing for models without a cap), or
+            None when no slot came free in time
+        """
+        if model not in self.limits:
+            return Slot(None, model, None)
+
+        fd = self._try(model)
+        if fd is None and block:
+            deadline = time.monotonic() + self.wait
+            delay = self.poll_interval
+            with self._released:
+                self._waiting[model] = self._waiting.get(model, 0) + 1
+            try:
+                while fd is None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    with self._released:
+                        self._released.wait(min(delay, remaining))
+                    delay = min(delay * 2, self.max_poll_interval)
+                    fd = self._try(model)
+            finally:
+                with self._released:
+                    self._waiting[model] -= 1
+            if fd is not None:
+                with self._released:
+                    self.totals[model]["waited"] += 1
+
+        with self._released:
+            if fd is None:
+                self.totals[model]["throttled"] += 1
+                return None
+            self.totals[model]["acquired"] += 1
+            self._held[model] = self._held.get(model, 0) + 1
+        return Slot(self, model, fd)
+
+    def _release(self, model: str, fd: Optional[int]) -> None:
+        if fd is None:
+            return
+        # Closing the descriptor drops the lock
+        os.close(fd)
+        with self._released:
+            self._held[model] -= 1
+            self._released.notify_all()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per capped model: its cap, slots held and calls waiting in this worker, and lifetime counts"""
+        with self._released:
+            return {
+                model: {
+                    "limit": limit,
+                    "held": self._held.get(model, 0),
+                    "waiting": self._waiting.get(model, 0),
+                    **self.totals[model]
+                }
+                for model, limit in self.limits.items()
+            }
@@ -1,15 +1,62 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request, Depends
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 from photo_processor import AIPhotoProcessor
-import io
+from executor import WorkerPools, PoolSaturated
+from job_queue import JobStore, JobQueue, SUCCEEDED, FAILED, sse_event, stream_job_events
+from result_cache import ResultCache
+from batch import is_zip_upload, iter_zip_images, run_batch, stream_zip, stream_ndjson
+from metrics import REGISTRY, PipelineTrace, Gauge, REQUESTS, REQUEST_DURATION
+from uploads import spool_file, spool_upload, max_upload_bytes, UploadTooLarge
+from image_io import read_image
+from image_analysis import ImageAnalyzer
+from model_backends import BACKENDS
+from damage import METHODS as INPAINT_METHODS
+from resolution import ResolutionPlan, check_dpi, parse_print_size
+from single_flight import Cancelled
+import asyncio
+import os
 import logging
-from typing import Optional
+import threading
+import time
+import zipfile
+from typing import List, Optional, Tuple
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Smart Photo Reviver API - Alqudimi Technology")
+pools = WorkerPools.from_env()
+
+# What the startup warm-up loaded, for the health check
+warm_up = {}
+
+job_store = JobStore(
+    os.environ.get('PHOTO_JOB_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'jobs')),
+    lease=float(os.environ.get('PHOTO_JOB_LEASE', '60'))
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    purged = job_store.purge(float(os.environ.get('PHOTO_JOB_RETENTION_HOURS', '24')) * 3600)
+    if purged:
+        logger.info(f"Purged {purged} expired job(s)")
+    await job_queue.start()
+    # Runs before the server accepts connections, so a pod only turns ready
+    # once libraries, CPU workers and local models are loaded
+    if os.environ.get('PHOTO_WARMUP', '1') != '0':
+        started = time.perf_counter()
+        warm_up.update(await pools.io.run(processor.warm_up, os.environ.get('PHOTO_MODEL_WARMUP', '1') != '0'))
+        warm_up['seconds'] = round(time.perf_counter() - started, 3)
+        logger.info(f"Warmed up in {warm_up['seconds']}s: {len(warm_up['modules'])} module(s), "
+                    f"{warm_up['cpu_workers']} CPU worker(s), local models {warm_up['models'] or 'none'}")
+    yield
+    await job_queue.stop()
+    job_store.close()
+    processor.close()
+    pools.shutdown()
+
+app = FastAPI(title="Smart Photo Reviver API - Alqudimi Technology", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,7 +66,224 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-processor = AIPhotoProcessor()
+processor = AIPhotoProcessor(cpu_pool=pools.cpu, cache=ResultCache.from_env())
+
+job_queue = JobQueue(
+    job_store,
+    pools.io,
+    processor.process_image,
+    concurrency=int(os.environ.get('PHOTO_JOB_WORKERS', '2')),
+    preview=processor.preview_image
+)
+
+@app.exception_handler(PoolSaturated)
+async def pool_saturated_handler(request, exc: PoolSaturated):
+    logger.warning(f"Rejecting {request.url.path}: {exc}")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is busy, please retry later"},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large_handler(request, exc: UploadTooLarge):
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+@app.exception_handler(Cancelled)
+async def cancelled_handler(request, exc: Cancelled):
+    # The client has gone; the status only shows up in logs and metrics
+    logger.info(f"Client left {request.url.path} before the result was ready")
+    return JSONResponse(status_code=499, content={"detail": "Client closed request"})
+
+async def _run_until_disconnect(request: Request, fn, *args, **kwargs):
+    """
+    Run `fn` on the I/O pool with a cancel event that is set if the client disconnects
+
+    `fn` is expected to accept `cancel` and raise Cancelled when it gives up.
+    """
+    cancel = threading.Event()
+    task = asyncio.ensure_future(pools.io.run(fn, *args, cancel=cancel, **kwargs))
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=0.5)
+        if done:
+            return task.result()
+        if not cancel.is_set() and await request.is_disconnected():
+            cancel.set()
+
+def _run_single_stage(path: str, name: str, fn, trace: PipelineTrace, max_pixels: Optional[int] = None):
+    """
+    Decode a spooled upload and run one processor stage on it, measuring each step
+
+    Args:
+        max_pixels: Decode budget (defaults to the processor's input limit)
+    """
+    with trace.stage('decode') as record:
+        allocate = pools.cpu.images.empty if pools.cpu.images is not None else None
+        img_array = read_image(path, max_pixels or processor.max_input_pixels, allocate)
+        record.output(img_array)
+    
+    result_array, _ = processor.run_stage(name, fn, img_array, trace)
+    return result_array
+
+def output_settings(
+    request: Request,
+    output_format: Optional[str] = Form(None),
+    output_quality: Optional[int] = Form(None),
+    target_kb: Optional[int] = Form(None),
+    encode_budget_ms: Optional[int] = Form(None)
+) -> dict:
+    """
+    Output encoding for a request: `output_format` if given, else the best
+    image type in the Accept header, else the server default
+    """
+    try:
+        return processor.encoder.resolve({
+            "format": processor.encoder.negotiate(request.headers.get("accept"), output_format),
+            "quality": output_quality,
+            "target_kb": target_kb,
+            "budget_ms": encode_budget_ms
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _image_response(body, output: dict, filename: str, trace: PipelineTrace,
+                    resolution: Optional[ResolutionPlan] = None) -> Response:
+    """
+    Image response for encoded bytes, or for an iterator of chunks that is
+    streamed as the encoder produces them
+
+    The sizes the image was processed at go in X-Resolution, and any
+    adjustment made to the requested size in X-Resolution-Notes.
+    """
+    name, _ = os.path.splitext(filename or 'image')
+    headers = {
+        "Content-Disposition": f"attachment; filename={name}{processor.encoder.extension(output)}",
+        "Server-Timing": trace.server_timing(),
+        "Vary": "Accept"
+    }
+    if resolution is not None:
+        headers["X-Resolution"] = resolution.summary()
+        if resolution.notes:
+            headers["X-Resolution-Notes"] = "; ".join(resolution.notes)
+    media_type = processor.encoder.media_type(output)
+    if isinstance(body, bytes):
+        return Response(content=body, media_type=media_type, headers=headers)
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+async def _single_stage_response(file: UploadFile, prefix: str, name: str, fn, output: dict) -> Response:
+    """Run one stage on an upload and stream the encoded result"""
+    upload = await spool_upload(file)
+    try:
+        trace = PipelineTrace()
+        result_array = await pools.io.run(_run_single_stage, upload.path, name, fn, trace)
+    finally:
+        upload.close()
+    
+    return _image_response(processor.encoder.iter_encode(result_array, output, trace=trace),
+                           output, f"{prefix}_{file.filename}", trace)
+
+def _check_model_backend(model_backend: Optional[str]) -> None:
+    if model_backend is not None and model_backend not in BACKENDS:
+        raise HTTPException(status_code=400, detail=f"Model backend must be one of: {', '.join(BACKENDS)}")
+
+def _check_inpaint_method(inpaint_method: Optional[str]) -> None:
+    if inpaint_method is not None and inpaint_method not in INPAINT_METHODS:
+        raise HTTPException(status_code=400, detail=f"Inpaint method must be one of: {', '.join(INPAINT_METHODS)}")
+
+def _check_print_size(print_size: Optional[str], print_dpi: Optional[float]) -> None:
+    try:
+        if print_size:
+            parse_print_size(print_size)
+        if print_dpi is not None:
+            check_dpi(print_dpi)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _plan_resolution(path: str, enable_super_resolution: bool, sr_scale: int,
+                           print_size: Optional[str] = None,
+                           print_dpi: Optional[float] = None) -> Optional[ResolutionPlan]:
+    """Sizes an upload will be processed at, read from its header; a bad print size is a 400"""
+    try:
+        return await asyncio.to_thread(processor.plan_resolution, path, enable_super_resolution,
+                                       sr_scale, print_size, print_dpi)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _analyze_upload(path: str, trace: PipelineTrace) -> dict:
+    """Decode a spooled upload and run the analysis pre-pass on it"""
+    analyzer = processor.analyzer or ImageAnalyzer()
+    with trace.stage('decode') as record:
+        img_array = read_image(path, processor.max_input_pixels)
+        record.output(img_array)
+    with trace.stage('analysis', img_array):
+        analysis = analyzer.analyze(img_array)
+    return {
+        "analysis": analysis.as_dict(),
+        "skipped_stages": analyzer.skip_reasons(analysis)
+    }
+
+REGISTRY.register(Gauge(
+    'photo_pool_pending', 'Calls running or queued per worker pool', ('pool',),
+    lambda: {(name,): stats['pending'] for name, stats in pools.stats().items()}
+))
+REGISTRY.register(Gauge(
+    'photo_pool_rejected', 'Calls rejected because a worker pool was full', ('pool',),
+    lambda: {(name,): stats['rejected'] for name, stats in pools.stats().items()}
+))
+REGISTRY.register(Gauge(
+    'photo_predictions_in_flight', 'Replicate predictions created and not yet finished', (),
+    lambda: {(): processor.predictions.stats()['in_flight']}
+))
+REGISTRY.register(Gauge(
+    'photo_model_circuit_open', 'Whether a model\'s circuit breaker is open (1) or half-open (0.5)',
+    ('backend', 'model'),
+    lambda: {(backend, model): {'open': 1, 'half_open': 0.5}.get(stats['state'], 0)
+             for backend, models in processor.guard.stats().items() for model, stats in models.items()}
+))
+
+class RequestMetricsMiddleware:
+    """
+    Counts requests and measures their latency up to the response headers
+
+    Plain ASGI rather than @app.middleware("http"): the latter wraps
+    `receive` in a way that hides client disconnects from the endpoints.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        recorded = False
+        
+        def record(status: int) -> None:
+            nonlocal recorded
+            if recorded:
+                return
+            recorded = True
+            endpoint = getattr(scope.get("route"), "path", "unmatched")
+            REQUESTS.inc(endpoint=endpoint, status=str(status))
+            REQUEST_DURATION.observe(time.perf_counter() - start, endpoint=endpoint)
+        
+        async def send_recorded(message):
+            if message["type"] == "http.response.start":
+                record(message["status"])
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_recorded)
+        finally:
+            record(500)
+
+app.add_middleware(RequestMetricsMiddleware)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: per-stage latency, CPU time, bytes, image sizes and request counts"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 async def root():
@@ -37,10 +301,38 @@ async def root():
 
 @app.get("/api/health")
 async def health_check():
-    return {"status": "healthy", "technology": "Alqudimi", "ai_enabled": processor.api_key is not None}
+    return {
+        "status": "healthy",
+        "technology": "Alqudimi",
+        "ai_enabled": processor.api_key is not None,
+        "model_backend": processor.model_backend,
+        "backends": {name: backend.describe() for name, backend in processor.backends.items()},
+        "workers": pools.stats(),
+        "cache": processor.cache.stats() if processor.cache else None,
+        "coalescing": processor.flights.stats() if processor.flights else None,
+        "models": processor.guard.stats(),
+        "model_slots": processor.guard.slots.stats(),
+        "predictions": processor.predictions.stats(),
+        "warm_up": warm_up or None
+    }
+
+@app.post("/api/predictions/webhook")
+async def prediction_webhook(request: Request):
+    """
+    Completion callback for Replicate predictions (set PHOTO_WEBHOOK_URL to
+    this endpoint's public URL). The payload is only used for its id: the
+    prediction is fetched from Replicate before its output is used.
+    """
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    prediction_id = payload.get("id") if isinstance(payload, dict) else None
+    return {"tracked": processor.predictions.notify(prediction_id)}
 
 @app.post("/api/restore")
 async def restore_photo(
+    request: Request,
     file: UploadFile = File(...),
     instruction: Optional[str] = Form(None),
     enable_super_resolution: bool = Form(True),
@@ -48,7 +340,13 @@ async def restore_photo(
     enable_colorization: bool = Form(True),
     enable_inpainting: bool = Form(True),
     sr_scale: int = Form(2),
-    face_fidelity: float = Form(0.5)
+    face_fidelity: float = Form(0.5),
+    face_regions: Optional[bool] = Form(None),
+    model_backend: Optional[str] = Form(None),
+    inpaint_method: Optional[str] = Form(None),
+    print_size: Optional[str] = Form(None),
+    print_dpi: Optional[float] = Form(None),
+    output: dict = Depends(output_settings)
 ):
     """
     Alqudimi Technology photo restoration with multiple models:
@@ -67,62 +365,153 @@ async def restore_photo(
         enable_inpainting: Apply basic inpainting for damage removal
         sr_scale: Super-resolution scale (2, 3, or 4)
         face_fidelity: CodeFormer fidelity (0-1, lower = more enhancement, 0.5 recommended)
+        face_regions: Enhance only the detected faces, concurrently with the
+            other stages (default: PHOTO_FACE_REGIONS)
+        model_backend: 'replicate' or 'onnx' (default: PHOTO_MODEL_BACKEND)
+        inpaint_method: 'telea', 'ns', 'bilateral' or 'median' (default:
+            PHOTO_INPAINT_METHOD)
+        print_size: Print size the result should cover, e.g. '8x10' (inches)
+            or '20x25cm'; replaces sr_scale
+        print_dpi: Print resolution for print_size (default 300)
+        output_format: 'jpeg', 'webp', 'avif' or 'png' (default: the Accept
+            header, then PHOTO_OUTPUT_FORMAT)
+        output_quality: Quality of lossy formats (1-100)
+        target_kb: Encode at the highest quality that fits this size
+        encode_budget_ms: Pick the encoder effort expected to finish in this time
     """
+    upload = None
     try:
         if not file.content_type or not file.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="File must be an image")
+        _check_model_backend(model_backend)
+        _check_inpaint_method(inpaint_method)
         
-        contents = await file.read()
-        
-        max_size = 10 * 1024 * 1024
-        if len(contents) > max_size:
-            raise HTTPException(status_code=400, detail="File size must be less than 10MB")
+        upload = await spool_upload(file)
+        resolution = await _plan_resolution(upload.path, enable_super_resolution, min(max(sr_scale, 2), 4),
+                                            print_size, print_dpi)
         
-        logger.info(f"Processing image: {file.filename}, size: {len(contents)} bytes")
+        logger.info(f"Processing image: {file.filename}, size: {upload.size} bytes")
         logger.info(f"Options: SR={enable_super_resolution}(x{sr_scale}), Face={enable_face_enhancement}, Color={enable_colorization}, Inpaint={enable_inpainting}")
         if instruction:
             logger.info(f"Instruction: {instruction}")
         
-        processed_image_bytes = processor.process_image(
-            contents,
+        trace = PipelineTrace()
+        processed_image_bytes = await _run_until_disconnect(
+            request,
+            processor.process_image,
+            upload.path,
+            trace=trace,
+            input_digest=upload.digest,
             enable_super_resolution=enable_super_resolution,
             enable_face_enhancement=enable_face_enhancement,
             enable_colorization=enable_colorization,
             enable_inpainting=enable_inpainting,
             instruction=instruction,
             sr_scale=min(max(sr_scale, 2), 4),
-            face_fidelity=max(0.0, min(1.0, face_fidelity))
+            face_fidelity=max(0.0, min(1.0, face_fidelity)),
+            face_regions=face_regions,
+            model_backend=model_backend,
+            inpaint_method=inpaint_method,
+            print_size=print_size,
+            print_dpi=print_dpi,
+            output=output
         )
         
         logger.info("Image processing completed successfully")
         
-        return StreamingResponse(
-            io.BytesIO(processed_image_bytes),
-            media_type="image/jpeg",
-            headers={
-                "Content-Disposition": f"attachment; filename=restored_{file.filename}"
-            }
-        )
+        return _image_response(processed_image_bytes, output, f"restored_{file.filename}", trace, resolution)
     
+    except (HTTPException, PoolSaturated, UploadTooLarge, Cancelled):
+        raise
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+    finally:
+        if upload is not None:
+            upload.close()
+
+@app.post("/api/restore/plan")
+async def plan_restoration(
+    file: UploadFile = File(...),
+    instruction: Optional[str] = Form(None),
+    enable_super_resolution: bool = Form(True),
+    enable_face_enhancement: bool = Form(True),
+    enable_colorization: bool = Form(True),
+    enable_inpainting: bool = Form(True),
+    sr_scale: int = Form(2),
+    face_fidelity: float = Form(0.5),
+    face_regions: Optional[bool] = Form(None),
+    model_backend: Optional[str] = Form(None),
+    inpaint_method: Optional[str] = Form(None),
+    print_size: Optional[str] = Form(None),
+    print_dpi: Optional[float] = Form(None),
+    output: dict = Depends(output_settings)
+):
+    """
+    Dry run of /api/restore: how the pipeline would process this image,
+    without running any stage. Takes the same parameters.
+    """
+    upload = None
+    try:
+        if not file.content_type or not file.content_type.startswith("image/"):
+            raise HTTPException(status_code=400, detail="File must be an image")
+        _check_model_backend(model_backend)
+        _check_inpaint_method(inpaint_method)
+        
+        upload = await spool_upload(file)
+        await _plan_resolution(upload.path, enable_super_resolution, min(max(sr_scale, 2), 4),
+                               print_size, print_dpi)
+        
+        trace = PipelineTrace()
+        plan = await pools.io.run(
+            processor.plan_image,
+            upload.path,
+            trace=trace,
+            input_digest=upload.digest,
+            enable_super_resolution=enable_super_resolution,
+            enable_face_enhancement=enable_face_enhancement,
+            enable_colorization=enable_colorization,
+            enable_inpainting=enable_inpainting,
+            instruction=instruction,
+            sr_scale=min(max(sr_scale, 2), 4),
+            face_fidelity=max(0.0, min(1.0, face_fidelity)),
+            face_regions=face_regions,
+            model_backend=model_backend,
+            inpaint_method=inpaint_method,
+            print_size=print_size,
+            print_dpi=print_dpi,
+            output=output
+        )
+        
+        return JSONResponse(content=plan.as_dict(), headers={"Server-Timing": trace.server_timing()})
+    
+    except (HTTPException, PoolSaturated, UploadTooLarge):
+        raise
+    except Exception as e:
+        logger.error(f"Error planning restoration: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    finally:
+        if upload is not None:
+            upload.close()
 
 @app.post("/api/restore-step")
 async def restore_photo_with_steps(
+    request: Request,
     file: UploadFile = File(...),
     step: str = Form("all"),
-    instruction: Optional[str] = Form(None)
+    instruction: Optional[str] = Form(None),
+    output: dict = Depends(output_settings)
 ):
     """
     Restore photo with specific processing step
     Options: super_resolution, face_enhancement, colorization, inpainting, instruction, all
     """
+    upload = None
     try:
         if not file.content_type or not file.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="File must be an image")
         
-        contents = await file.read()
+        upload = await spool_upload(file)
         
         enable_sr = step in ["super_resolution", "all"]
         enable_face = step in ["face_enhancement", "all"]
@@ -131,100 +520,97 @@ async def restore_photo_with_steps(
         
         use_instruction = instruction if step in ["instruction", "all"] else None
         
-        processed_image_bytes = processor.process_image(
-            contents,
+        trace = PipelineTrace()
+        processed_image_bytes = await _run_until_disconnect(
+            request,
+            processor.process_image,
+            upload.path,
+            trace=trace,
+            input_digest=upload.digest,
             enable_super_resolution=enable_sr,
             enable_face_enhancement=enable_face,
             enable_colorization=enable_color,
             enable_inpainting=enable_inpaint,
-            instruction=use_instruction
+            instruction=use_instruction,
+            output=output
         )
         
-        return StreamingResponse(
-            io.BytesIO(processed_image_bytes),
-            media_type="image/jpeg",
-            headers={
-                "Content-Disposition": f"attachment; filename=restored_{file.filename}"
-            }
-        )
+        return _image_response(processed_image_bytes, output, f"restored_{file.filename}", trace)
     
+    except (HTTPException, PoolSaturated, UploadTooLarge, Cancelled):
+        raise
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+    finally:
+        if upload is not None:
+            upload.close()
 
 @app.post("/api/super-resolution")
 async def apply_super_resolution(
     file: UploadFile = File(...),
-    scale: int = Form(4)
+    scale: int = Form(4),
+    model_backend: Optional[str] = Form(None),
+    print_size: Optional[str] = Form(None),
+    print_dpi: Optional[float] = Form(None),
+    output: dict = Depends(output_settings)
 ):
-    """Apply SwinIR super-resolution only"""
+    """
+    Apply SwinIR super-resolution only
+    
+    The output is the input times `scale`, or the print size at
+    `print_dpi`, within PHOTO_MAX_OUTPUT_MEGAPIXELS. Large inputs are
+    downscaled first so that one model pass reaches it (see X-Resolution).
+    """
+    upload = None
     try:
         if not file.content_type or not file.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="File must be an image")
-        
-        contents = await file.read()
-        
-        from PIL import Image
-        import numpy as np
-        
-        image = Image.open(io.BytesIO(contents))
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-        img_array = np.array(image)
-        
-        result_array = processor.super_resolution(img_array, scale=min(max(scale, 2), 4))
-        
-        result_image = Image.fromarray(result_array)
-        output_buffer = io.BytesIO()
-        result_image.save(output_buffer, format='JPEG', quality=95)
-        output_buffer.seek(0)
-        
-        return StreamingResponse(
-            output_buffer,
-            media_type="image/jpeg",
-            headers={
-                "Content-Disposition": f"attachment; filename=sr_{file.filename}"
-            }
-        )
+        _check_model_backend(model_backend)
+        scale = min(max(scale, 2), 4)
+        
+        upload = await spool_upload(file)
+        resolution = await _plan_resolution(upload.path, True, scale, print_size, print_dpi)
+        if resolution is not None:
+            fn = lambda img: processor.upscale(img, resolution, backend=model_backend)
+        else:
+            fn = lambda img: processor.super_resolution(img, scale=scale, backend=model_backend)
+        trace = PipelineTrace()
+        result_array = await pools.io.run(_run_single_stage, upload.path, 'super_resolution', fn, trace,
+                                          resolution.working_pixels if resolution is not None else None)
+        
+        return _image_response(processor.encoder.iter_encode(result_array, output, trace=trace),
+                               output, f"sr_{file.filename}", trace, resolution)
     
+    except (HTTPException, PoolSaturated, UploadTooLarge):
+        raise
     except Exception as e:
         logger.error(f"Error in super-resolution: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    finally:
+        if upload is not None:
+            upload.close()
 
 @app.post("/api/colorize")
 async def apply_colorization(
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    model_backend: Optional[str] = Form(None),
+    output: dict = Depends(output_settings)
 ):
     """Apply DDColor colorization only"""
     try:
         if not file.content_type or not file.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="File must be an image")
+        _check_model_backend(model_backend)
         
-        contents = await file.read()
-        
-        from PIL import Image
-        import numpy as np
-        
-        image = Image.open(io.BytesIO(contents))
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-        img_array = np.array(image)
-        
-        result_array = processor.colorize_photo(img_array)
-        
-        result_image = Image.fromarray(result_array)
-        output_buffer = io.BytesIO()
-        result_image.save(output_buffer, format='JPEG', quality=95)
-        output_buffer.seek(0)
-        
-        return StreamingResponse(
-            output_buffer,
-            media_type="image/jpeg",
-            headers={
-                "Content-Disposition": f"attachment; filename=colorized_{file.filename}"
-            }
+        return await _single_stage_response(
+            file, 'colorized', 'colorization',
+            lambda img: processor.colorize_photo(img, backend=model_backend),
+            output
         )
     
+    except (HTTPException, PoolSaturated, UploadTooLarge):
+        raise
     except Exception as e:
         logger.error(f"Error in colorization: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
@@ -232,38 +618,22 @@ async def apply_colorization(
 @app.post("/api/face-enhance")
 async def apply_face_enhancement(
     file: UploadFile = File(...),
-    fidelity: float = Form(0.5)
+    fidelity: float = Form(0.5),
+    output: dict = Depends(output_settings)
 ):
     """Apply CodeFormer face enhancement only"""
     try:
         if not file.content_type or not file.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="File must be an image")
         
-        contents = await file.read()
-        
-        from PIL import Image
-        import numpy as np
-        
-        image = Image.open(io.BytesIO(contents))
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-        img_array = np.array(image)
-        
-        result_array = processor.face_enhancement(img_array, fidelity=max(0.0, min(1.0, fidelity)))
-        
-        result_image = Image.fromarray(result_array)
-        output_buffer = io.BytesIO()
-        result_image.save(output_buffer, format='JPEG', quality=95)
-        output_buffer.seek(0)
-        
-        return StreamingResponse(
-            output_buffer,
-            media_type="image/jpeg",
-            headers={
-                "Content-Disposition": f"attachment; filename=face_enhanced_{file.filename}"
-            }
+        return await _single_stage_response(
+            file, 'face_enhanced', 'face_enhancement',
+            lambda img: processor.face_enhancement(img, fidelity=max(0.0, min(1.0, fidelity))),
+            output
         )
     
+    except (HTTPException, PoolSaturated, UploadTooLarge):
+        raise
     except Exception as e:
         logger.error(f"Error in face enhancement: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
@@ -271,7 +641,8 @@ async def apply_face_enhancement(
 @app.post("/api/instruct")
 async def apply_instructional_restoration(
     file: UploadFile = File(...),
-    instruction: str = Form(...)
+    instruction: str = Form(...),
+    output: dict = Depends(output_settings)
 ):
     """Apply InstructIR with natural language instruction"""
     try:
@@ -281,35 +652,357 @@ async def apply_instructional_restoration(
         if not instruction:
             raise HTTPException(status_code=400, detail="Instruction is required")
         
-        contents = await file.read()
-        
-        from PIL import Image
-        import numpy as np
-        
-        image = Image.open(io.BytesIO(contents))
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-        img_array = np.array(image)
+        return await _single_stage_response(
+            file, 'instructed', 'instruction',
+            lambda img: processor.instruct_restore(img, instruction),
+            output
+        )
+    
+    except (HTTPException, PoolSaturated, UploadTooLarge):
+        raise
+    except Exception as e:
+        logger.error(f"Error in instructional restoration: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+@app.post("/api/analyze")
+async def analyze_photo(
+    file: UploadFile = File(...)
+):
+    """Report what the analysis pre-pass finds in an image and which stages it would skip"""
+    upload = None
+    try:
+        if not file.content_type or not file.content_type.startswith("image/"):
+            raise HTTPException(status_code=400, detail="File must be an image")
         
-        result_array = processor.instruct_restore(img_array, instruction)
+        upload = await spool_upload(file)
         
-        result_image = Image.fromarray(result_array)
-        output_buffer = io.BytesIO()
-        result_image.save(output_buffer, format='JPEG', quality=95)
-        output_buffer.seek(0)
+        trace = PipelineTrace()
+        result = await pools.io.run(_analyze_upload, upload.path, trace)
         
-        return StreamingResponse(
-            output_buffer,
-            media_type="image/jpeg",
-            headers={
-                "Content-Disposition": f"attachment; filename=instructed_{file.filename}"
-            }
-        )
+        return JSONResponse(content=result, headers={"Server-Timing": trace.server_timing()})
     
+    except (HTTPException, PoolSaturated, UploadTooLarge):
+        raise
     except Exception as e:
-        logger.error(f"Error in instructional restoration: {str(e)}")
+        logger.error(f"Error analyzing image: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    finally:
+        if upload is not None:
+            upload.close()
+
+@app.post("/api/restore/batch")
+async def restore_batch(
+    files: List[UploadFile] = File(...),
+    instruction: Optional[str] = Form(None),
+    enable_super_resolution: bool = Form(True),
+    enable_face_enhancement: bool = Form(True),
+    enable_colorization: bool = Form(True),
+    enable_inpainting: bool = Form(True),
+    sr_scale: int = Form(2),
+    face_fidelity: float = Form(0.5),
+    face_regions: Optional[bool] = Form(None),
+    model_backend: Optional[str] = Form(None),
+    inpaint_method: Optional[str] = Form(None),
+    print_size: Optional[str] = Form(None),
+    print_dpi: Optional[float] = Form(None),
+    parallelism: int = Form(4),
+    output: str = Form("zip"),
+    output_format: Optional[str] = Form(None),
+    output_quality: Optional[int] = Form(None),
+    target_kb: Optional[int] = Form(None),
+    encode_budget_ms: Optional[int] = Form(None)
+):
+    """
+    Restore a whole album in one request.
+    
+    Accepts several image files and/or ZIP archives of images, with the same
+    options as /api/restore applied to every image. Results are streamed back
+    as each image finishes, either as a ZIP archive (ending with
+    manifest.ndjson) or as NDJSON lines with base64-encoded images. Failed
+    images are reported in the manifest without aborting the batch.
+    
+    Args:
+        parallelism: Number of images processed at the same time
+        output: 'zip' or 'ndjson'
+        output_format: Image format of the results (default: PHOTO_OUTPUT_FORMAT)
+    """
+    if output not in ("zip", "ndjson"):
+        raise HTTPException(status_code=400, detail="Output must be 'zip' or 'ndjson'")
+    _check_model_backend(model_backend)
+    _check_inpaint_method(inpaint_method)
+    _check_print_size(print_size, print_dpi)
+    try:
+        encoding = processor.encoder.resolve({
+            "format": output_format,
+            "quality": output_quality,
+            "target_kb": target_kb,
+            "budget_ms": encode_budget_ms
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    items = []
+    for upload in files:
+        if is_zip_upload(upload.filename, upload.content_type):
+            try:
+                items.extend(iter_zip_images(zipfile.ZipFile(upload.file), max_upload_bytes()))
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail=f"{upload.filename} is not a valid ZIP archive")
+        elif upload.content_type and upload.content_type.startswith("image/"):
+            # Spooled when its turn comes, like the single-image endpoints do
+            items.append((upload.filename, lambda upload=upload: spool_file(upload.file, upload.filename)))
+        else:
+            raise HTTPException(status_code=400, detail=f"{upload.filename} must be an image or a ZIP archive")
+    
+    if not items:
+        raise HTTPException(status_code=400, detail="No images found in the upload")
+    
+    max_files = int(os.environ.get('PHOTO_BATCH_MAX_FILES', '2000'))
+    if len(items) > max_files:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {max_files} images")
+    
+    params = {
+        "enable_super_resolution": enable_super_resolution,
+        "enable_face_enhancement": enable_face_enhancement,
+        "enable_colorization": enable_colorization,
+        "enable_inpainting": enable_inpainting,
+        "instruction": instruction,
+        "sr_scale": min(max(sr_scale, 2), 4),
+        "face_fidelity": max(0.0, min(1.0, face_fidelity)),
+        "face_regions": face_regions,
+        "model_backend": model_backend,
+        "inpaint_method": inpaint_method,
+        "print_size": print_size,
+        "print_dpi": print_dpi,
+        "output": encoding
+    }
+    parallelism = min(max(parallelism, 1), pools.io.max_workers)
+    logger.info(f"Processing batch of {len(items)} images with parallelism {parallelism}")
+    
+    results = run_batch(items, processor.process_image, pools.io, parallelism,
+                        max_file_size=max_upload_bytes(), params=params)
+    
+    extension = processor.encoder.extension(encoding)
+    if output == "ndjson":
+        return StreamingResponse(stream_ndjson(results, extension), media_type="application/x-ndjson")
+    
+    return StreamingResponse(
+        stream_zip(results, extension),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=restored_batch.zip"}
+    )
+
+async def _submit_job(file: UploadFile, params: dict, preview: bool) -> Tuple[str, Optional[ResolutionPlan]]:
+    """Validate and spool an upload, then queue it as a restoration job; returns its ID and planned sizes"""
+    if not file.content_type or not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    _check_model_backend(params["model_backend"])
+    _check_inpaint_method(params["inpaint_method"])
+    
+    upload = await spool_upload(file)
+    try:
+        resolution = await _plan_resolution(upload.path, params["enable_super_resolution"], params["sr_scale"],
+                                            params["print_size"], params["print_dpi"])
+    except HTTPException:
+        upload.close()
+        raise
+    
+    stages = AIPhotoProcessor.pipeline_stages(
+        enable_super_resolution=params["enable_super_resolution"],
+        enable_face_enhancement=params["enable_face_enhancement"],
+        enable_colorization=params["enable_colorization"],
+        enable_inpainting=params["enable_inpainting"],
+        instruction=params["instruction"]
+    )
+    
+    with upload:
+        job_id = job_queue.submit(upload.path, file.filename, params, stages, preview=preview)
+    logger.info(f"Queued job {job_id} for {file.filename}")
+    return job_id, resolution
+
+def _job_links(job_id: str, preview: bool) -> dict:
+    links = {
+        "status_url": f"/api/jobs/{job_id}",
+        "events_url": f"/api/jobs/{job_id}/events",
+        "result_url": f"/api/jobs/{job_id}/result"
+    }
+    if preview:
+        links["preview_url"] = f"/api/jobs/{job_id}/preview"
+    return links
+
+def _event_stream(body) -> StreamingResponse:
+    return StreamingResponse(
+        body,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/jobs", status_code=202)
+async def create_restore_job(
+    file: UploadFile = File(...),
+    instruction: Optional[str] = Form(None),
+    enable_super_resolution: bool = Form(True),
+    enable_face_enhancement: bool = Form(True),
+    enable_colorization: bool = Form(True),
+    enable_inpainting: bool = Form(True),
+    sr_scale: int = Form(2),
+    face_fidelity: float = Form(0.5),
+    face_regions: Optional[bool] = Form(None),
+    model_backend: Optional[str] = Form(None),
+    inpaint_method: Optional[str] = Form(None),
+    print_size: Optional[str] = Form(None),
+    print_dpi: Optional[float] = Form(None),
+    preview: bool = Form(False),
+    output: dict = Depends(output_settings)
+):
+    """
+    Queue a full restoration and return immediately with a job ID.
+    Accepts the same options as /api/restore; poll /api/jobs/{job_id} (or
+    follow /api/jobs/{job_id}/events) for progress and fetch the image from
+    /api/jobs/{job_id}/result. `resolution` in the response gives the sizes
+    the image will be processed at, with notes on any adjustment made to
+    the requested size.
+    
+    Args:
+        preview: Also render a quick low-resolution preview right away,
+            served from /api/jobs/{job_id}/preview
+    """
+    params = {
+        "enable_super_resolution": enable_super_resolution,
+        "enable_face_enhancement": enable_face_enhancement,
+        "enable_colorization": enable_colorization,
+        "enable_inpainting": enable_inpainting,
+        "instruction": instruction,
+        "sr_scale": min(max(sr_scale, 2), 4),
+        "face_fidelity": max(0.0, min(1.0, face_fidelity)),
+        "face_regions": face_regions,
+        "model_backend": model_backend,
+        "inpaint_method": inpaint_method,
+        "print_size": print_size,
+        "print_dpi": print_dpi,
+        "output": output
+    }
+    job_id, resolution = await _submit_job(file, params, preview)
+    
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "resolution": resolution.as_dict() if resolution is not None else None,
+        **_job_links(job_id, preview)
+    }
+
+@app.post("/api/restore/stream")
+async def restore_photo_stream(
+    file: UploadFile = File(...),
+    instruction: Optional[str] = Form(None),
+    enable_super_resolution: bool = Form(True),
+    enable_face_enhancement: bool = Form(True),
+    enable_colorization: bool = Form(True),
+    enable_inpainting: bool = Form(True),
+    sr_scale: int = Form(2),
+    face_fidelity: float = Form(0.5),
+    face_regions: Optional[bool] = Form(None),
+    model_backend: Optional[str] = Form(None),
+    inpaint_method: Optional[str] = Form(None),
+    print_size: Optional[str] = Form(None),
+    print_dpi: Optional[float] = Form(None),
+    output: dict = Depends(output_settings)
+):
+    """
+    Progressive restoration over Server-Sent Events.
+    
+    Takes the same options as /api/restore. The response is an event
+    stream: a `job` event with the job's URLs, a `preview` event with a
+    quick low-resolution result (usually within a second), `progress`
+    events as each stage runs, and finally `done` with the URL of the
+    full-resolution image (or `failed`).
+    """
+    params = {
+        "enable_super_resolution": enable_super_resolution,
+        "enable_face_enhancement": enable_face_enhancement,
+        "enable_colorization": enable_colorization,
+        "enable_inpainting": enable_inpainting,
+        "instruction": instruction,
+        "sr_scale": min(max(sr_scale, 2), 4),
+        "face_fidelity": max(0.0, min(1.0, face_fidelity)),
+        "face_regions": face_regions,
+        "model_backend": model_backend,
+        "inpaint_method": inpaint_method,
+        "print_size": print_size,
+        "print_dpi": print_dpi,
+        "output": output
+    }
+    job_id, resolution = await _submit_job(file, params, preview=True)
+    
+    async def events():
+        yield sse_event('job', {"job_id": job_id, "resolution": resolution.as_dict() if resolution is not None else None,
+                                **_job_links(job_id, True)})
+        async for event in stream_job_events(job_store, job_id):
+            yield event
+    
+    return _event_stream(events())
+
+@app.get("/api/jobs/{job_id}")
+async def get_restore_job(job_id: str):
+    """Get the status and per-stage progress of a restoration job"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"]
+    }
+
+@app.get("/api/jobs/{job_id}/events")
+async def get_restore_job_events(job_id: str):
+    """Follow a job over Server-Sent Events: status, progress, preview, then done or failed"""
+    if job_store.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _event_stream(stream_job_events(job_store, job_id))
+
+@app.get("/api/jobs/{job_id}/preview")
+async def get_restore_job_preview(job_id: str):
+    """Download the quick low-resolution preview of a job queued with preview=true"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    path = job_store.preview_path(job_id)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=409, detail="Preview is not ready")
+    
+    return FileResponse(path, media_type="image/jpeg", filename=f"preview_{job['filename']}")
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_restore_job_result(job_id: str):
+    """Download the restored image of a finished job"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] == FAILED:
+        raise HTTPException(status_code=500, detail=f"Error processing image: {job['error']}")
+    if job["status"] != SUCCEEDED:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    
+    # Jobs queued before output formats existed have no "output" and are JPEG
+    output = job["params"].get("output") or {}
+    name, _ = os.path.splitext(job['filename'] or 'image')
+    return FileResponse(
+        job_store.result_path(job_id),
+        media_type=processor.encoder.media_type(output),
+        filename=f"restored_{name}{processor.encoder.extension(output)}"
+    )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker is a separate process with its own pools and memory cache;
+    # they share the disk cache, job store and model call caps
+    workers = int(os.environ.get('PHOTO_API_WORKERS', '1'))
+    if workers > 1:
+        uvicorn.run("photo_api:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,16 +1,67 @@
-import cv2
-import numpy as np
-from PIL import Image
-import io
+from __future__ import annotations
+
 import os
-import replicate
-import base64
 import asyncio
-from typing import Optional, Dict, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable, List
 import logging
+from result_cache import ResultCache, image_digest, file_digest, array_digest, chain_key
+from image_io import ImageSource, image_size, read_image
+from image_analysis import ImageAnalysis, ImageAnalyzer, is_grayscale
+from image_transfer import ImageTransfer
+from image_encoder import OutputEncoder
+from tint import TintColorizer
+from damage import METHODS as INPAINT_METHODS, DamageMask, DamageRepair
+from http_client import DownloadClient
+from tiling import TileEngine
+from metrics import PipelineTrace, StageRecord, COALESCED
+from pipeline import ColorContext, Plan, PlanStep, PipelinePlanner, StageSpec
+from regions import RegionJob, crop, region_boxes
+from model_backends import BACKENDS, ModelBackend, OnnxBackend, ReplicateBackend
+from model_guard import ModelGuard
+from predictions import PredictionTracker
+from resolution import ResolutionPlan, ResolutionPolicy
+from single_flight import Cancelled, Flight, SingleFlight
+from lazy import lazy_import, preload
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
 
 logger = logging.getLogger(__name__)
 
+# Stages that call a remote model and have a local fallback
+REMOTE_STAGES = ('instruction', 'colorization', 'face_enhancement', 'super_resolution')
+
+# Rough costs the planner uses to rank stage orders and estimate plans:
+# seconds per model call, seconds per megapixel sent to or read back from
+# a model, and seconds per megapixel of the local OpenCV implementations
+# (per output megapixel for super-resolution)
+REMOTE_CALL_S = 5.0
+REMOTE_TRANSFER_S_PER_MP = 0.3
+LOCAL_S_PER_MP = {
+    'colorization': 0.08,
+    'super_resolution': 0.025,
+    'resize': 0.01
+}
+# ONNX Runtime CPU inference: colorization runs at a fixed model size,
+# super-resolution is priced per output megapixel
+ONNX_COSTS = {
+    'colorization': {'fixed_s': 0.5, 'per_mp_in_s': 0.1},
+    'super_resolution': {'per_mp_out_s': 3.0}
+}
+
+# Previews are small and shown briefly, so a fast mid-quality JPEG will do
+PREVIEW_OUTPUT = {'format': 'jpeg', 'quality': 80, 'progressive': False, 'budget_ms': None, 'target_kb': None}
+
+
+def _warm_worker() -> Dict[str, float]:
+    # Sent to CPU pool workers: unpickling it imports this module, which
+    # declares every lazy module the stages use, before they are loaded
+    return preload()
+
+
 class AIPhotoProcessor:
     """
     Alqudimi Technology - Advanced photo restoration using state-of-the-art models:
@@ -20,12 +71,98 @@ class AIPhotoProcessor:
     - InstructIR: Text-based instruction control
     """
     
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(self, api_key: Optional[str] = None, cpu_pool=None,
+                 cache: Optional[ResultCache] = None,
+                 transfer: Optional[ImageTransfer] = None,
+                 http: Optional[DownloadClient] = None,
+                 tiles: Optional[TileEngine] = None,
+                 max_input_pixels: Optional[int] = None,
+                 analyzer: Optional[ImageAnalyzer] = None,
+                 planner: Optional[PipelinePlanner] = None,
+                 face_regions: Optional[bool] = None,
+                 region_workers: Optional[int] = None,
+                 backends: Optional[Dict[str, ModelBackend]] = None,
+                 model_backend: Optional[str] = None,
+                 preview_side: Optional[int] = None,
+                 coalesce: Optional[bool] = None,
+                 encoder: Optional[OutputEncoder] = None,
+                 guard: Optional[ModelGuard] = None,
+                 predictions: Optional[PredictionTracker] = None,
+                 tint: Optional[TintColorizer] = None,
+                 damage: Optional[DamageRepair] = None,
+                 resolution: Optional[ResolutionPolicy] = None):
         """
         Initialize the AI Photo Processor
         Args:
             api_key: Replicate API key (falls back to REPLICATE_API_TOKEN env var)
+            cpu_pool: Optional executor.WorkerPool used for CPU-bound OpenCV stages
+            cache: Optional ResultCache for final and per-stage outputs
+            transfer: How images are sent to and read back from the models
+            http: Shared connection-pooled client for model output downloads
+            tiles: Tile engine used by the OpenCV fallback stages
+            max_input_pixels: Inputs above this many pixels are downscaled while
+                decoding (defaults to PHOTO_MAX_INPUT_MEGAPIXELS; 0 disables)
+            analyzer: Pre-pass deciding which stages an image needs
+                (defaults to ImageAnalyzer.from_env(); None when PHOTO_ANALYSIS=0)
+            planner: Orders, skips and fuses stages (defaults to
+                PipelinePlanner.from_env())
+            face_regions: Send only detected face crops to CodeFormer, in
+                parallel with colorization and super-resolution of the full
+                frame (defaults to PHOTO_FACE_REGIONS)
+            region_workers: Face crops enhanced at once across requests
+                (defaults to PHOTO_REGION_WORKERS or 4)
+            backends: Model backends by name (defaults to Replicate plus
+                OnnxBackend.from_env())
+            model_backend: Backend tried first for each model, 'replicate'
+                or 'onnx' (defaults to PHOTO_MODEL_BACKEND); models it
+                cannot run go to Replicate
+            preview_side: Longest side of preview_image results (defaults
+                to PHOTO_PREVIEW_SIDE or 512)
+            coalesce: Let identical process_image calls that overlap share
+                one run (defaults to PHOTO_COALESCE, on unless set to 0)
+            encoder: Output encoder for results and previews (defaults to
+                OutputEncoder.from_env())
+            guard: Deadlines, circuit breakers and hedging for remote
+                model calls (defaults to ModelGuard.from_env())
+            predictions: Creates Replicate predictions and completes them
+                from webhooks or polling (defaults to
+                PredictionTracker.from_env())
+            tint: Lookup-table colorizer used when no colorization model
+                is available (defaults to TintColorizer.from_env())
+            damage: Scratch and dust detection and repair for the inpainting
+                stage (defaults to DamageRepair.from_env())
+            resolution: Picks the working size, super-resolution scale and
+                output size of each restoration (defaults to
+                ResolutionPolicy.from_env())
         """
+        self.cpu_pool = cpu_pool
+        self.cache = cache
+        self.transfer = transfer or ImageTransfer.from_env()
+        self.http = http or DownloadClient.from_env()
+        self.tiles = tiles or TileEngine.from_env()
+        self.analyzer = analyzer or ImageAnalyzer.from_env()
+        self.planner = planner or PipelinePlanner.from_env()
+        self._local = threading.local()
+        if face_regions is None:
+            face_regions = os.environ.get('PHOTO_FACE_REGIONS', '0') == '1'
+        self.face_regions = face_regions
+        self.region_workers = region_workers or int(os.environ.get('PHOTO_REGION_WORKERS', '4'))
+        self._region_pool: Optional[ThreadPoolExecutor] = None
+        self._region_lock = threading.Lock()
+        self._warned_regions = False
+        if max_input_pixels is None:
+            max_input_pixels = int(float(os.environ.get('PHOTO_MAX_INPUT_MEGAPIXELS', '64')) * 1_000_000)
+        self.max_input_pixels = max_input_pixels
+        self.preview_side = preview_side or int(os.environ.get('PHOTO_PREVIEW_SIDE', '512'))
+        if coalesce is None:
+            coalesce = os.environ.get('PHOTO_COALESCE', '1') != '0'
+        self.flights = SingleFlight() if coalesce else None
+        self.encoder = encoder or OutputEncoder.from_env()
+        self.guard = guard or ModelGuard.from_env()
+        self.predictions = predictions or PredictionTracker.from_env()
+        self.tint = tint or TintColorizer.from_env()
+        self.damage = damage or DamageRepair.from_env()
+        self.resolution = resolution or ResolutionPolicy.from_env()
         self.api_key = api_key or os.environ.get('REPLICATE_API_TOKEN')
         if self.api_key:
             os.environ['REPLICATE_API_TOKEN'] = self.api_key
@@ -36,35 +173,165 @@ class AIPhotoProcessor:
             'ddcolor': 'piddnad/ddcolor',
             'instructir': 'mv-lab/instructir'
         }
+        
+        self.backends = backends or {
+            'replicate': ReplicateBackend(self),
+            'onnx': OnnxBackend.from_env()
+        }
+        model_backend = model_backend or os.environ.get('PHOTO_MODEL_BACKEND', 'replicate')
+        if model_backend not in BACKENDS:
+            logger.warning(f"Unknown model backend '{model_backend}', using Replicate")
+            model_backend = 'replicate'
+        self.model_backend = model_backend
     
-    def _image_to_data_uri(self, image: np.ndarray) -> str:
-        """Convert numpy array to data URI for API"""
-        if len(image.shape) == 2:
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    def __getstate__(self) -> Dict[str, Any]:
+        # Worker processes run CPU stages inline; the pool itself is not picklable
+        state = self.__dict__.copy()
+        state['cpu_pool'] = None
+        state['cache'] = None
+        state['transfer'] = None
+        state['http'] = None
+        state['_local'] = None
+        state['_region_pool'] = None
+        state['_region_lock'] = None
+        state['flights'] = None
+        state['encoder'] = None
+        state['guard'] = None
+        state['predictions'] = None
+        return state
+    
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._region_lock = threading.Lock()
+    
+    def close(self) -> None:
+        """Release pooled connections, region and model worker threads and the cache index, and cancel open predictions"""
+        self.predictions.close()
+        self.http.close()
+        self.guard.close()
+        if self.cache is not None:
+            self.cache.close()
+        with self._region_lock:
+            pool, self._region_pool = self._region_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _regions(self) -> ThreadPoolExecutor:
+        with self._region_lock:
+            if self._region_pool is None:
+                self._region_pool = ThreadPoolExecutor(max_workers=self.region_workers,
+                                                       thread_name_prefix='photo-region')
+            return self._region_pool
+    
+    def _mark_fallback(self) -> None:
+        """Record that a remote model failed and the current stage used a fallback"""
+        self._local.fell_back = True
+    
+    def _take_fallback_flag(self) -> bool:
+        fell_back = getattr(self._local, 'fell_back', False)
+        self._local.fell_back = False
+        return fell_back
+    
+    def _take_backend_used(self) -> Optional[str]:
+        """Name of the backend the current stage called last, if any"""
+        used = getattr(self._local, 'backend', None)
+        self._local.backend = None
+        return used
+    
+    def warm_up(self, models: bool = True) -> Dict[str, Any]:
+        """
+        Do the one-off work of a first request ahead of time: import the
+        libraries that load lazily, start the CPU pool's workers (importing
+        them there too), probe the output formats and load local models
+
+        Args:
+            models: Also load and run the local models
+
+        Returns:
+            'modules' (seconds spent importing each), 'cpu_workers' started,
+            'formats' and 'models' (local models warmed, by backend)
+
+        Raises:
+            ValueError: If the configured output format cannot be written
+        """
+        warmed: Dict[str, Any] = {'modules': preload()}
+        warmed['cpu_workers'] = self.cpu_pool.warm_up(_warm_worker) if self.cpu_pool is not None else 0
+        warmed['formats'] = list(self.encoder.formats)
+        warmed['models'] = {}
+        for name, backend in self.backends.items() if models else ():
+            try:
+                loaded = backend.warm_up()
+            except Exception as e:
+                logger.error(f"Warm-up of the {name} backend failed: {str(e)}")
+                continue
+            if loaded:
+                warmed['models'][name] = loaded
+        return warmed
+    
+    def _backend(self, model: str, backend: Optional[str] = None,
+                 inputs: Optional[Dict[str, Any]] = None) -> Optional[ModelBackend]:
+        """
+        Backend that runs `model` for a request
         
-        pil_image = Image.fromarray(image)
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format='PNG')
-        buffer.seek(0)
+        Args:
+            model: Key into model_versions
+            backend: Requested backend name (defaults to model_backend)
+            inputs: Model inputs, for backends that only cover some of them
         
-        base64_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return f"data:image/png;base64,{base64_data}"
+        Returns:
+            The requested backend if it can run the model, else Replicate if
+            it can, else None (only the local fallback is left)
+        """
+        for name in (backend or self.model_backend, 'replicate'):
+            candidate = self.backends.get(name)
+            if candidate is not None and candidate.supports(model, inputs):
+                return candidate
+        return None
     
-    def _download_image_from_url(self, url: str) -> np.ndarray:
+    def _image_buffer(self) -> Optional[Callable]:
+        """Allocator for decoded inputs: shared buffers when CPU stages run in worker processes"""
+        images = self.cpu_pool.images if self.cpu_pool is not None else None
+        return images.empty if images is not None else None
+    
+    def _run_cpu(self, fn: Callable, *args: Any) -> Any:
+        """Run a CPU-bound stage on the CPU pool, or inline when no pool is attached"""
+        if self.cpu_pool is None:
+            return fn(*args)
+        return self.cpu_pool.call(fn, *args)
+    
+    def _download_image_from_url(self, url: str, stage: str = 'download') -> np.ndarray:
         """Download image from URL and convert to numpy array"""
-        import requests
-        response = requests.get(url)
-        response.raise_for_status()
+        return self.transfer.decode(self.http.fetch(url), stage)
+    
+    def _run_model(self, model: str, image: np.ndarray, inputs: Dict[str, Any],
+                   backend: Optional[ModelBackend] = None) -> np.ndarray:
+        """
+        Run a model on an image and return its output image
         
-        image = Image.open(io.BytesIO(response.content))
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
+        Args:
+            model: Key into model_versions
+            image: Input image as numpy array
+            inputs: Model inputs other than the image
+            backend: Backend to run it on (defaults to Replicate)
         
-        return np.array(image)
+        Raises:
+            CircuitOpen: If the model has been failing and is being skipped
+            ModelTimeout: If a remote model misses its deadline, or
+                (ModelThrottled) its concurrency cap left no slot free
+        """
+        backend = backend or self.backends['replicate']
+        self._local.backend = backend.name
+        if not backend.remote:
+            return backend.run(model, image, inputs)
+        start = None
+        if hasattr(backend, 'submit'):
+            # Waits on the prediction's Future instead of a guard thread
+            start = lambda: backend.submit(model, image, inputs)
+        return self.guard.call(backend.name, model, lambda: backend.run(model, image, inputs), start)
     
-    def super_resolution(self, image: np.ndarray, scale: int = 4, task: str = 'real_sr') -> np.ndarray:
+    def super_resolution(self, image: np.ndarray, scale: int = 4, task: str = 'real_sr',
+                         backend: Optional[str] = None) -> np.ndarray:
         """
         Enhance image quality using SwinIR super-resolution
         
@@ -72,42 +339,50 @@ class AIPhotoProcessor:
             image: Input image as numpy array
             scale: Upscaling factor (2, 3, 4, or 8)
             task: 'real_sr' (real-world), 'classical_sr', 'gray_dn', 'color_dn', or 'jpeg_car'
+            backend: Model backend to try first (defaults to model_backend)
         
         Returns:
             Enhanced image as numpy array
         """
-        if not self.api_key:
+        model_backend = self._backend('swinir', backend, {"scale": scale})
+        if model_backend is None:
             logger.warning("No Replicate API key found. Falling back to basic upscaling.")
-            return self._fallback_super_resolution(image, scale)
+            return self._run_cpu(self._fallback_super_resolution, image, scale)
         
         try:
-            logger.info(f"Running SwinIR super-resolution: scale={scale}, task={task}")
-            
-            data_uri = self._image_to_data_uri(image)
-            
-            output = replicate.run(
-                self.model_versions['swinir'],
-                input={
-                    "image": data_uri,
-                    "task": task,
-                    "scale": scale
-                }
-            )
+            logger.info(f"Running SwinIR super-resolution on {model_backend.name}: scale={scale}, task={task}")
             
-            if isinstance(output, str):
-                result = self._download_image_from_url(output)
-            else:
-                result = self._download_image_from_url(str(output))
+            result = self._run_model('swinir', image, {
+                "task": task,
+                "scale": scale
+            }, model_backend)
             
             logger.info("SwinIR processing completed successfully")
             return result
             
         except Exception as e:
             logger.error(f"SwinIR processing failed: {str(e)}")
-            return self._fallback_super_resolution(image, scale)
+            self._mark_fallback()
+            return self._run_cpu(self._fallback_super_resolution, image, scale)
+    
+    def upscale(self, image: np.ndarray, resolution: ResolutionPlan,
+                backend: Optional[str] = None) -> np.ndarray:
+        """
+        Bring an image at the planned working size to the planned output size:
+        one super-resolution pass at the planned scale, then an exact resize
+        
+        Args:
+            image: Input image at resolution.working_size
+            resolution: Plan from plan_resolution()
+            backend: Model backend to try first (defaults to model_backend)
+        """
+        if resolution.sr_scale:
+            image = self.super_resolution(image, scale=resolution.sr_scale, backend=backend)
+        return self._run_cpu(self._resize, image, resolution.output_size)
     
     def face_enhancement(self, image: np.ndarray, fidelity: float = 0.5, 
-                        upscale: int = 2, face_upsample: bool = True) -> np.ndarray:
+                        upscale: int = 2, face_upsample: bool = True,
+                        backend: Optional[str] = None) -> np.ndarray:
         """
         Enhance faces using CodeFormer
         
@@ -116,270 +391,963 @@ class AIPhotoProcessor:
             fidelity: Balance between quality (0) and fidelity (1). 0.5 is recommended.
             upscale: Upscaling factor (1, 2, 3, or 4)
             face_upsample: Whether to upsample faces separately
+            backend: Model backend to try first (defaults to model_backend)
         
         Returns:
             Face-enhanced image as numpy array
         """
-        if not self.api_key:
+        model_backend = self._backend('codeformer', backend)
+        if model_backend is None:
             logger.warning("No Replicate API key found. Skipping face enhancement.")
             return image
         
         try:
             logger.info(f"Running CodeFormer face enhancement: fidelity={fidelity}, upscale={upscale}")
             
-            data_uri = self._image_to_data_uri(image)
-            
-            output = replicate.run(
-                self.model_versions['codeformer'],
-                input={
-                    "image": data_uri,
-                    "codeformer_fidelity": fidelity,
-                    "upscale": upscale,
-                    "face_upsample": face_upsample,
-                    "background_enhance": True
-                }
-            )
-            
-            if isinstance(output, str):
-                result = self._download_image_from_url(output)
-            else:
-                result = self._download_image_from_url(str(output))
+            result = self._run_model('codeformer', image, {
+                "codeformer_fidelity": fidelity,
+                "upscale": upscale,
+                "face_upsample": face_upsample,
+                "background_enhance": True
+            }, model_backend)
             
             logger.info("CodeFormer processing completed successfully")
             return result
             
         except Exception as e:
             logger.error(f"CodeFormer processing failed: {str(e)}")
+            self._mark_fallback()
             return image
     
-    def colorize_photo(self, image: np.ndarray, model_name: str = 'ddcolor_modelscope') -> np.ndarray:
+    def colorize_photo(self, image: np.ndarray, model_name: str = 'ddcolor_modelscope',
+                       monochrome: Optional[bool] = None,
+                       backend: Optional[str] = None) -> np.ndarray:
         """
         Colorize black-and-white photos using DDColor
         
         Args:
             image: Input image as numpy array
             model_name: 'ddcolor_paper', 'ddcolor_modelscope', 'ddcolor_artistic', or 'ddcolor_paper_tiny'
+            monochrome: Whether the image is gray or toned, if already known;
+                the fallback checks a sample of the image otherwise
+            backend: Model backend to try first (defaults to model_backend)
         
         Returns:
             Colorized image as numpy array
         """
-        if not self.api_key:
+        model_backend = self._backend('ddcolor', backend)
+        if model_backend is None:
             logger.warning("No Replicate API key found. Falling back to basic colorization.")
-            return self._fallback_colorization(image)
+            return self._fallback_colorization(image, monochrome)
         
         try:
-            logger.info(f"Running DDColor colorization: model={model_name}")
-            
-            data_uri = self._image_to_data_uri(image)
-            
-            output = replicate.run(
-                self.model_versions['ddcolor'],
-                input={
-                    "image": data_uri,
-                    "model_name": model_name
-                }
-            )
+            logger.info(f"Running DDColor colorization on {model_backend.name}: model={model_name}")
             
-            if isinstance(output, str):
-                result = self._download_image_from_url(output)
-            else:
-                result = self._download_image_from_url(str(output))
+            result = self._run_model('ddcolor', image, {
+                "model_name": model_name
+            }, model_backend)
             
             logger.info("DDColor processing completed successfully")
             return result
             
         except Exception as e:
             logger.error(f"DDColor processing failed: {str(e)}")
-            return self._fallback_colorization(image)
+            self._mark_fallback()
+            return self._fallback_colorization(image, monochrome)
     
-    def instruct_restore(self, image: np.ndarray, instruction: str) -> np.ndarray:
+    def instruct_restore(self, image: np.ndarray, instruction: str,
+                         backend: Optional[str] = None) -> np.ndarray:
         """
         Restore image using natural language instructions with InstructIR
         
         Args:
             image: Input image as numpy array
             instruction: Natural language instruction (e.g., "Remove noise and enhance details")
+            backend: Model backend to try first (defaults to model_backend)
         
         Returns:
             Restored image as numpy array
         """
-        if not self.api_key:
+        model_backend = self._backend('instructir', backend)
+        if model_backend is None:
             logger.warning("No Replicate API key found. Skipping instructional restoration.")
             return image
         
         try:
             logger.info(f"Running InstructIR with instruction: '{instruction}'")
             
-            data_uri = self._image_to_data_uri(image)
-            
-            output = replicate.run(
-                self.model_versions['instructir'],
-                input={
-                    "image": data_uri,
-                    "prompt": instruction
-                }
-            )
-            
-            if isinstance(output, str):
-                result = self._download_image_from_url(output)
-            else:
-                result = self._download_image_from_url(str(output))
+            result = self._run_model('instructir', image, {
+                "prompt": instruction
+            }, model_backend)
             
             logger.info("InstructIR processing completed successfully")
             return result
             
         except Exception as e:
             logger.error(f"InstructIR processing failed: {str(e)}")
+            self._mark_fallback()
             return image
     
-    def _fallback_super_resolution(self, image: np.ndarray, scale: int) -> np.ndarray:
-        """Fallback super-resolution using OpenCV"""
-        height, width = image.shape[:2]
-        new_width = int(width * scale)
-        new_height = int(height * scale)
+    def _fallback_super_resolution(self, image: np.ndarray, scale: int,
+                                   context: Optional[ColorContext] = None) -> np.ndarray:
+        """
+        Fallback super-resolution using OpenCV
         
-        upscaled = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_CUBIC)
+        Upscaling runs tile by tile; CLAHE still sees the whole L plane so
+        its 8x8 grid matches the untiled result exactly. Every conversion is
+        of the upscaled image, so `context` has nothing to offer here.
+        """
+        height, width = image.shape[:2]
         
-        lab = cv2.cvtColor(upscaled, cv2.COLOR_RGB2LAB)
-        l, a, b = cv2.split(lab)
+        if scale != int(scale):
+            new_width = int(width * scale)
+            new_height = int(height * scale)
+            upscaled = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_CUBIC)
+            lab = cv2.cvtColor(upscaled, cv2.COLOR_RGB2LAB)
+        else:
+            scale = int(scale)
+            
+            def upscale_tile(tile: np.ndarray) -> np.ndarray:
+                tile_height, tile_width = tile.shape[:2]
+                upscaled = cv2.resize(tile, (tile_width * scale, tile_height * scale),
+                                      interpolation=cv2.INTER_CUBIC)
+                return cv2.cvtColor(upscaled, cv2.COLOR_RGB2LAB)
+            
+            lab = self.tiles.map(image, upscale_tile, scale=scale)
         
         clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        l = clahe.apply(l)
-        
-        lab = cv2.merge([l, a, b])
-        enhanced = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+        lab[:, :, 0] = clahe.apply(np.ascontiguousarray(lab[:, :, 0]))
         
-        return enhanced
+        return self.tiles.map_rows(lab, lambda band: cv2.cvtColor(band, cv2.COLOR_LAB2RGB), out=lab)
     
-    def _fallback_colorization(self, image: np.ndarray) -> np.ndarray:
-        """Fallback colorization using OpenCV"""
+    @staticmethod
+    def _resize(image: np.ndarray, size: tuple, context: Optional[ColorContext] = None) -> np.ndarray:
+        """Resize to exactly `size` (width, height); area averaging when shrinking"""
+        height, width = image.shape[:2]
+        if (width, height) == tuple(size):
+            return image
+        shrinking = size[0] * size[1] < width * height
+        return cv2.resize(image, tuple(size), interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_CUBIC)
+    
+    def _fallback_colorization(self, image: np.ndarray, monochrome: Optional[bool] = None,
+                               context: Optional[ColorContext] = None) -> np.ndarray:
+        """Fallback colorization using OpenCV: a lightness-dependent tint (see TintColorizer)"""
         if len(image.shape) == 2:
-            gray = image
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-        else:
-            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+            return self.tint.colorize(image)
         
-        is_grayscale = np.allclose(image[:,:,0], image[:,:,1]) and np.allclose(image[:,:,1], image[:,:,2])
+        if monochrome is None:
+            monochrome = self._is_grayscale(image)
         
-        if is_grayscale:
-            lab = cv2.cvtColor(image, cv2.COLOR_RGB2LAB)
-            l_channel = lab[:,:,0]
-            
-            a_variation = (l_channel.astype(float) - 128) * 0.15
-            b_variation = (l_channel.astype(float) - 128) * 0.12
-            
-            a_channel = np.clip(128 + a_variation, 0, 255).astype(np.uint8)
-            b_channel = np.clip(128 + b_variation, 0, 255).astype(np.uint8)
-            
-            sepia_factor = (l_channel / 255.0) ** 0.8
-            a_channel = np.clip(a_channel + sepia_factor * 20, 0, 255).astype(np.uint8)
-            b_channel = np.clip(b_channel + sepia_factor * 15, 0, 255).astype(np.uint8)
-            
-            lab[:,:,1] = a_channel
-            lab[:,:,2] = b_channel
-            
-            colorized = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
-            return colorized
+        if monochrome:
+            # The LAB planes are rewritten, so take them from the context
+            lab = context.take('lab') if context is not None else None
+            return self.tint.colorize(image, lab)
         
         return image
     
-    def process_image(self, image_bytes: bytes, 
+    def run_stage(self, name: str, fn: Callable[[np.ndarray], Optional[np.ndarray]],
+                  image: np.ndarray, trace: PipelineTrace) -> tuple:
+        """
+        Run one pipeline stage under measurement
+        
+        Args:
+            name: Stage name
+            fn: Stage function; returns the new image, or None when it had nothing to do
+            image: Stage input
+            trace: Trace receiving the stage record
+        
+        Returns:
+            (result, fell_back) where fell_back tells whether a remote model
+            failed and the local fallback produced the result
+        """
+        self._take_fallback_flag()
+        self._take_backend_used()
+        with trace.stage(name, image) as record, self.transfer.record() as transfer_stats:
+            result = fn(image)
+            fell_back = self._take_fallback_flag()
+            backend = self._take_backend_used()
+            if name not in REMOTE_STAGES:
+                record.path = 'local'
+            elif fell_back or backend is None:
+                record.path = 'fallback'
+            else:
+                record.path = 'remote' if backend == 'replicate' else backend
+            if result is None:
+                record.path = 'skipped'
+            record.output(result if result is not None else image)
+            record.add_transfer(transfer_stats)
+        
+        for model, stats in transfer_stats.items():
+            logger.info(
+                f"Transfer {model}: encode={stats['encode_s']:.3f}s upload={stats['upload_s']:.3f}s "
+                f"decode={stats['decode_s']:.3f}s sent={stats['uploaded_bytes']}B "
+                f"received={stats['downloaded_bytes']}B reused={stats['reused']}"
+            )
+        return result, fell_back
+    
+    @staticmethod
+    def pipeline_stages(enable_super_resolution: bool = True,
+                        enable_face_enhancement: bool = True,
+                        enable_colorization: bool = True,
+                        enable_inpainting: bool = True,
+                        instruction: Optional[str] = None) -> list:
+        """List the stage names process_image will go through for these options"""
+        stages = []
+        if instruction:
+            stages.append('instruction')
+        if enable_inpainting:
+            stages.append('inpainting')
+        if enable_colorization:
+            stages.append('colorization')
+        if enable_face_enhancement:
+            stages.append('face_enhancement')
+        if enable_super_resolution:
+            stages.append('super_resolution')
+        stages.append('encode')
+        return stages
+    
+    def stage_specs(self, enable_super_resolution: bool = True,
+                    enable_face_enhancement: bool = True,
+                    enable_colorization: bool = True,
+                    enable_inpainting: bool = True,
+                    instruction: Optional[str] = None,
+                    sr_scale: int = 2,
+                    face_fidelity: float = 0.5,
+                    face_regions: bool = False,
+                    model_backend: Optional[str] = None,
+                    inpaint_method: Optional[str] = None,
+                    resolution: Optional[ResolutionPlan] = None,
+                    analysis: Optional[ImageAnalysis] = None) -> List[StageSpec]:
+        """
+        Declare the stage graph for these options
+        
+        Args:
+            model_backend: Backend tried first for each model (defaults to model_backend)
+            inpaint_method: How damage is repaired, one of damage.METHODS
+                (defaults to the DamageRepair's method)
+            face_regions: Enhance detected face crops concurrently with the
+                full-frame stages (see _use_face_regions)
+            resolution: Sizes from plan_resolution(); sets the
+                super-resolution scale (or skips it) and adds a final
+                'resize' stage onto the output size. Without one,
+                super-resolution runs at `sr_scale`
+            analysis: Analysis of the input, once known; without it
+                colorization checks a sample of the image when it runs
+        
+        Returns:
+            StageSpecs in the declared order; the planner picks the order they run in
+        
+        Raises:
+            ValueError: For an unknown inpaint_method
+        """
+        if inpaint_method is not None and inpaint_method not in INPAINT_METHODS:
+            raise ValueError(f"Inpaint method must be one of: {', '.join(INPAINT_METHODS)}")
+        remote = bool(self.api_key)
+        monochrome = analysis.monochrome if analysis is not None else None
+        # The resolution plan picks the model scale, or finds no upscaling is needed
+        sr_skip = None
+        if resolution is not None:
+            sr_scale = resolution.sr_scale or 1
+            if not resolution.sr_scale:
+                sr_skip = "the working size already covers the output size"
+        remote_costs = {'fixed_s': REMOTE_CALL_S, 'per_mp_in_s': REMOTE_TRANSFER_S_PER_MP,
+                        'per_mp_out_s': REMOTE_TRANSFER_S_PER_MP}
+        specs = []
+        
+        def backend_for(model: str, inputs: Optional[Dict[str, Any]] = None) -> Optional[str]:
+            found = self._backend(model, model_backend, inputs)
+            return found.name if found is not None else None
+        
+        if instruction:
+            specs.append(StageSpec(
+                'instruction', {'instruction': instruction},
+                lambda img: self.instruct_restore(img, instruction, backend=model_backend),
+                path='remote', **remote_costs,
+                skip_reason=None if remote else "no API key; InstructIR has no local fallback"
+            ))
+        
+        if enable_inpainting:
+            method = inpaint_method or self.damage.method
+            # NL-means is most of the old stage's cost; only noisy photos need it
+            denoise = analysis is None or self.analyzer is None or analysis.noise_sigma >= self.analyzer.noise_threshold
+            damaged = analysis.scratch_density + analysis.dust_density if analysis is not None else None
+            kwargs = {'method': method, 'denoise': denoise}
+            specs.append(StageSpec(
+                'inpainting', {**kwargs, 'detect': self.damage.key},
+                lambda img: self._inpaint(img, method, denoise),
+                after=('instruction',),
+                local_call=('_apply_basic_inpainting', kwargs),
+                per_mp_in_s=self.damage.estimate(1.0, damaged, method, denoise)
+            ))
+        
+        if enable_colorization:
+            def colorize(img: np.ndarray) -> Optional[np.ndarray]:
+                if not (monochrome if monochrome is not None else self._is_grayscale(img)):
+                    return None
+                logger.info("Detected grayscale image, applying colorization")
+                return self.colorize_photo(img, monochrome=True, backend=model_backend)
+            
+            backend = backend_for('ddcolor')
+            params = {}
+            if backend == 'onnx':
+                params = {'backend': backend}
+                costs = ONNX_COSTS['colorization']
+            elif backend is not None:
+                costs = remote_costs
+            else:
+                # Only fusable once the analysis has said the image needs it
+                params = {'tint': self.tint.key}
+                costs = {'per_mp_in_s': LOCAL_S_PER_MP['colorization'],
+                         'local_call': ('_fallback_colorization', {'monochrome': True}) if monochrome else None}
+            specs.append(StageSpec(
+                'colorization', params, colorize,
+                after=('instruction', 'inpainting'),
+                path=self._stage_path(backend), **costs
+            ))
+        
+        if enable_face_enhancement and face_regions and remote:
+            # CodeFormer upscales the crops itself so they come back at the
+            # final resolution; colorized frames only take their lightness
+            upscale = sr_scale if enable_super_resolution else 1
+            luminance_only = bool(enable_colorization and monochrome)
+            specs.append(StageSpec(
+                'face_enhancement', {'fidelity': face_fidelity, 'upscale': upscale, 'regions': True},
+                lambda img: self._launch_face_regions(img, analysis, face_fidelity, upscale, luminance_only),
+                after=('instruction', 'inpainting'),
+                path='remote', concurrent=True, **remote_costs
+            ))
+        elif enable_face_enhancement:
+            specs.append(StageSpec(
+                'face_enhancement', {'fidelity': face_fidelity, 'upscale': 1},
+                lambda img: self.face_enhancement(img, fidelity=face_fidelity, upscale=1, backend=model_backend),
+                after=('instruction', 'inpainting', 'colorization'),
+                path='remote', **remote_costs,
+                skip_reason=None if remote else "no API key; CodeFormer has no local fallback"
+            ))
+        
+        if enable_super_resolution:
+            backend = backend_for('swinir', {'scale': sr_scale})
+            params = {'scale': sr_scale}
+            if backend == 'onnx':
+                params['backend'] = backend
+                costs = ONNX_COSTS['super_resolution']
+            elif backend is not None:
+                costs = remote_costs
+            else:
+                costs = {'per_mp_out_s': LOCAL_S_PER_MP['super_resolution'],
+                         'local_call': ('_fallback_super_resolution', {'scale': sr_scale})}
+            specs.append(StageSpec(
+                'super_resolution', params,
+                lambda img: self.super_resolution(img, scale=sr_scale, backend=model_backend),
+                after=('instruction',), scale=sr_scale,
+                path=self._stage_path(backend), skip_reason=sr_skip, **costs
+            ))
+        
+        if resolution is not None and resolution.resize:
+            # Lands the result on the planned output size, after every other stage
+            size = resolution.output_size
+            upscaled = resolution.working_size[0] * (resolution.sr_scale or 1)
+            specs.append(StageSpec(
+                'resize', {'size': list(size)},
+                lambda img: self._run_cpu(self._resize, img, size),
+                after=('instruction', 'inpainting', 'colorization', 'face_enhancement', 'super_resolution'),
+                scale=size[0] / upscaled,
+                local_call=('_resize', {'size': size}),
+                per_mp_out_s=LOCAL_S_PER_MP['resize']
+            ))
+        
+        return specs
+    
+    @staticmethod
+    def _stage_path(backend: Optional[str]) -> str:
+        """StageSpec path for a model stage run on `backend` (None: the OpenCV fallback)"""
+        if backend is None:
+            return 'local'
+        return 'remote' if backend == 'replicate' else backend
+    
+    def _stage_keys(self, order: List[StageSpec], input_digest: str,
+                    output: Dict[str, Any], resolution: Optional[ResolutionPlan] = None) -> tuple:
+        """
+        Cache keys (analysis, per stage, final output) for stages run in this
+        order on an input decoded for `resolution`, and encoded with `output`
+        """
+        analyzer = self.analyzer
+        key = chain_key(input_digest, 'input', {
+            'models': self.model_versions,
+            'backend': 'replicate' if self.api_key else 'fallback',
+            'max_pixels': self._decode_pixels(resolution),
+            'analysis': analyzer.settings() if analyzer is not None else None
+        })
+        analysis_key = chain_key(key, 'analysis')
+        stage_keys = []
+        for spec in order:
+            key = chain_key(key, spec.name, spec.params)
+            stage_keys.append(key)
+        output_key = chain_key(key, 'encode', output)
+        return analysis_key, stage_keys, output_key
+    
+    def _use_face_regions(self, face_regions: Optional[bool] = None) -> bool:
+        """
+        Whether a request runs face enhancement on face crops
+        
+        Needs the remote model (the fallback has nothing to crop for) and a
+        face detector; otherwise the full frame is enhanced as before.
+        """
+        if face_regions is None:
+            face_regions = self.face_regions
+        if not face_regions or not self.api_key:
+            return False
+        if self.analyzer is None or not self.analyzer.settings()['faces']:
+            if not self._warned_regions:
+                logger.warning("Face region mode needs face detection (PHOTO_ANALYSIS=1 and an OpenCV "
+                               "build with CascadeClassifier); enhancing the full frame instead")
+                self._warned_regions = True
+            return False
+        return True
+    
+    def _launch_face_regions(self, image: np.ndarray, analysis: Optional[ImageAnalysis],
+                             fidelity: float, upscale: int, luminance_only: bool) -> RegionJob:
+        """Send padded face crops to CodeFormer in parallel and return without waiting"""
+        height, width = image.shape[:2]
+        if analysis is not None:
+            factor = width / analysis.width
+            faces = [[int(round(v * factor)) for v in face] for face in analysis.face_boxes or []]
+        else:
+            # Resumed without a cached analysis: no boxes, so send the whole frame
+            faces = [(0, 0, width, height)]
+        boxes = region_boxes(faces, width, height)
+        
+        pool = self._regions()
+        futures = [pool.submit(self._enhance_region, crop(image, box), fidelity, upscale) for box in boxes]
+        share = sum(w * h for _, _, w, h in boxes) / float(width * height)
+        logger.info(f"Enhancing {len(boxes)} face region(s) covering {share:.1%} of the frame "
+                    f"alongside the full-frame stages")
+        return RegionJob('face_enhancement', boxes, futures, (width, height), luminance_only)
+    
+    def _enhance_region(self, region: np.ndarray, fidelity: float, upscale: int) -> tuple:
+        """Enhance one face crop; runs on a region worker thread"""
+        self._take_fallback_flag()
+        cpu_start = time.thread_time()
+        with self.transfer.record() as transfer_stats:
+            patch = self.face_enhancement(region, fidelity=fidelity, upscale=upscale)
+        return (patch, self._take_fallback_flag(), transfer_stats,
+                time.thread_time() - cpu_start, time.perf_counter())
+    
+    def _analyze(self, image: np.ndarray, analysis_key: Optional[str],
+                 trace: PipelineTrace) -> Optional[ImageAnalysis]:
+        """Run the analysis pre-pass, or reuse its cached result"""
+        if self.analyzer is None:
+            return None
+        if analysis_key is not None:
+            cached_analysis = self.cache.get(analysis_key)
+            if cached_analysis is not None:
+                return ImageAnalysis.from_bytes(cached_analysis)
+        if image is None:
+            return None
+        with trace.stage('analysis', image):
+            analysis = self.analyzer.analyze(image)
+        if analysis_key is not None:
+            self.cache.put(analysis_key, analysis.to_bytes())
+        return analysis
+    
+    def plan_image(self, source: ImageSource, input_digest: Optional[str] = None,
+                   trace: Optional[PipelineTrace] = None, output: Optional[Dict[str, Any]] = None,
+                   **options: Any) -> Plan:
+        """
+        Plan a process_image call without running any stage
+        
+        The input is decoded and analyzed (unless the analysis is cached), so
+        the plan shows the stages that would be skipped, served from the
+        cache, fused or run, in order, with sizes and rough time estimates.
+        
+        Args:
+            source: Input image as encoded bytes, a file path, or a decoded array
+            input_digest: Content hash of the source, if already known
+            trace: Optional PipelineTrace receiving the decode and analysis timings
+            output: Output encoding options, as for process_image
+            **options: process_image stage options
+        
+        Raises:
+            ValueError: For an unknown inpaint_method, a malformed
+                print_size or an out-of-range print_dpi
+        """
+        if trace is None:
+            trace = PipelineTrace()
+        resolution = self.plan_resolution(source, options.get('enable_super_resolution', True),
+                                          options.get('sr_scale', 2), options.pop('print_size', None),
+                                          options.pop('print_dpi', None))
+        options['resolution'] = resolution
+        order = self.planner.order(self.stage_specs(**options))
+        
+        cached = 0
+        analysis_key = None
+        if self.cache is not None:
+            if input_digest is None:
+                input_digest = self._source_digest(source)
+            analysis_key, stage_keys, output_key = self._stage_keys(order, input_digest,
+                                                                    self.encoder.resolve(output), resolution)
+            if self.cache.contains(output_key):
+                cached = len(order)
+            else:
+                cached = next((i + 1 for i in range(len(order) - 1, -1, -1)
+                               if self.cache.contains(stage_keys[i])), 0)
+        
+        analysis = self._analyze(None, analysis_key, trace)
+        if analysis is None:
+            with trace.stage('decode') as record:
+                image = read_image(source, self._decode_pixels(resolution))
+                record.output(image)
+            analysis = self._analyze(image, analysis_key, trace)
+            size = (image.shape[1], image.shape[0])
+            del image
+        else:
+            size = (analysis.width, analysis.height)
+        
+        skip = self.analyzer.skip_reasons(analysis) if analysis is not None else {}
+        specs = {spec.name: spec for spec in self.stage_specs(analysis=analysis, **options)}
+        return self.planner.plan([specs[spec.name] for spec in order], size, skip=skip, cached=cached,
+                                 analysis=analysis.as_dict() if analysis is not None else None,
+                                 resolution=resolution.as_dict() if resolution is not None else None)
+    
+    def plan_resolution(self, source: ImageSource, enable_super_resolution: bool = True,
+                        sr_scale: int = 2, print_size: Optional[str] = None,
+                        print_dpi: Optional[float] = None) -> Optional[ResolutionPlan]:
+        """
+        Working size, super-resolution scale and output size for an input
+        
+        Reads only the image header. Returns None when the header cannot be
+        read; the input is then processed at its decoded size with
+        super-resolution at `sr_scale`, as without a policy.
+        
+        Raises:
+            ValueError: For a malformed print_size or an out-of-range print_dpi
+        """
+        size = image_size(source, self.max_input_pixels)
+        if size is None:
+            if print_size:
+                raise ValueError("Could not read the image size for the print size")
+            return None
+        resolution = self.resolution.plan(size, enable_super_resolution, sr_scale, print_size, print_dpi)
+        for note in resolution.notes:
+            logger.info(f"Resolution: {note}")
+        return resolution
+    
+    def _decode_pixels(self, resolution: Optional[ResolutionPlan]) -> int:
+        """Pixel budget inputs are decoded at: the working size when planned"""
+        return resolution.working_pixels if resolution is not None else self.max_input_pixels
+    
+    def preview_image(self, source: ImageSource,
+                      enable_colorization: bool = True,
+                      enable_inpainting: bool = True,
+                      trace: Optional[PipelineTrace] = None,
+                      **options: Any) -> bytes:
+        """
+        Quick local-only restoration of a downscaled proxy of the input
+        
+        Shown while process_image runs: no model calls, just a light
+        denoise and the fallback colorization on an image of at most
+        preview_side pixels per side, which takes well under a second.
+        
+        Args:
+            source: Input image as encoded bytes, a file path, or a decoded array
+            enable_colorization: Colorize gray or toned photos
+            enable_inpainting: Apply a light edge-preserving denoise
+            trace: Optional PipelineTrace receiving the measurements
+            **options: Other process_image options, ignored
+        
+        Returns:
+            Preview image as JPEG bytes
+        """
+        if trace is None:
+            trace = PipelineTrace()
+        side = self.preview_side
+        
+        with trace.stage('decode') as record:
+            # JPEG decodes straight at a reduced scale
+            image = read_image(source, side * side)
+            record.output(image)
+        
+        with trace.stage('preview', image) as record:
+            height, width = image.shape[:2]
+            factor = side / max(height, width)
+            if factor < 1:
+                image = cv2.resize(image, (max(1, round(width * factor)), max(1, round(height * factor))),
+                                   interpolation=cv2.INTER_AREA)
+            if enable_inpainting:
+                image = cv2.bilateralFilter(image, 5, 25, 5)
+            if enable_colorization:
+                image = self._fallback_colorization(image)
+            record.output(image)
+        
+        with trace.stage('encode', image) as record:
+            output_bytes = self.encoder.encode(image, PREVIEW_OUTPUT)
+            record.bytes['encoded'] = len(output_bytes)
+        return output_bytes
+    
+    def _run_local_chain(self, calls: List[tuple], image: np.ndarray) -> tuple:
+        """
+        Run fused local stages back to back, sharing one ColorContext
+        
+        Runs on the CPU pool, so the image crosses to a worker process once
+        for the whole chain rather than once per stage.
+        
+        Args:
+            calls: (stage name, (processor method, kwargs)) in execution order
+            image: Input of the first stage
+        
+        Returns:
+            (output image, StageRecords measured in the worker)
+        """
+        context = ColorContext(image, self.tiles)
+        records = []
+        for name, (method, kwargs) in calls:
+            record = StageRecord(name)
+            record.size_in = (int(image.shape[1]), int(image.shape[0]))
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+            image = getattr(self, method)(image, context=context, **kwargs)
+            record.wall_s = time.perf_counter() - wall_start
+            record.cpu_s = time.thread_time() - cpu_start
+            record.output(image)
+            records.append(record)
+            context = context.advance(image)
+        logger.info(f"Fused stages {[name for name, _ in calls]}: "
+                    f"{context.converted} color conversion(s), {context.reused} reused")
+        return image, records
+    
+    def process_image(self, source: ImageSource, 
                      enable_super_resolution: bool = True,
                      enable_face_enhancement: bool = True,
                      enable_colorization: bool = True,
                      enable_inpainting: bool = True,
                      instruction: Optional[str] = None,
                      sr_scale: int = 2,
-                     face_fidelity: float = 0.5) -> bytes:
+                     face_fidelity: float = 0.5,
+                     face_regions: Optional[bool] = None,
+                     model_backend: Optional[str] = None,
+                     inpaint_method: Optional[str] = None,
+                     print_size: Optional[str] = None,
+                     print_dpi: Optional[float] = None,
+                     output: Optional[Dict[str, Any]] = None,
+                     progress_callback: Optional[Callable[[str, str], None]] = None,
+                     trace: Optional[PipelineTrace] = None,
+                     input_digest: Optional[str] = None,
+                     cancel: Optional[threading.Event] = None) -> bytes:
         """
         Complete Alqudimi Technology image processing pipeline
         
         Args:
-            image_bytes: Input image as bytes
+            source: Input image as encoded bytes, a file path, or a decoded array;
+                files are decoded straight from disk
             enable_super_resolution: Apply SwinIR super-resolution
             enable_face_enhancement: Apply CodeFormer face enhancement
             enable_colorization: Apply DDColor colorization
             enable_inpainting: Apply basic inpainting for damage removal
             instruction: Optional natural language instruction for InstructIR
-            sr_scale: Super-resolution scale factor (2, 3, or 4)
+            sr_scale: Requested upscaling (2, 3, or 4); the resolution policy
+                may cap it, and picks the model scale from the working size
             face_fidelity: CodeFormer fidelity (0-1, lower = more enhancement)
+            face_regions: Enhance only the detected faces, concurrently with
+                the other stages; None uses PHOTO_FACE_REGIONS
+            model_backend: 'replicate' or 'onnx' for this request; None uses
+                PHOTO_MODEL_BACKEND
+            inpaint_method: 'telea', 'ns', 'bilateral' or 'median'; None uses
+                PHOTO_INPAINT_METHOD
+            print_size: Print size the output should cover, e.g. '8x10' or
+                '20x25cm'; replaces sr_scale
+            print_dpi: Print resolution for print_size (default 300)
+            output: Output encoding options (see OutputEncoder.resolve);
+                None uses the encoder's defaults
+            progress_callback: Called as callback(stage, state) with state
+                'running', 'completed', 'skipped' or 'cached'
+            trace: Optional PipelineTrace receiving per-stage measurements
+            input_digest: Content hash of the source, if already known
+            cancel: Set by the caller when it no longer wants the result
+        
+        Identical calls (same image content and options) that overlap share
+        one run: later callers wait for it and receive the same bytes, with
+        progress replayed to their callbacks. The run stops early only once
+        every caller has set its `cancel` event; callers without one always
+        keep it going.
         
         Returns:
-            Processed image as bytes (JPEG format)
+            Processed image as bytes, in the format `output` selects
+        
+        Raises:
+            Cancelled: If `cancel` was set before the result was ready
+            ValueError: For an unknown inpaint_method, a malformed
+                print_size or an out-of-range print_dpi
         """
-        image = Image.open(io.BytesIO(image_bytes))
+        if trace is None:
+            trace = PipelineTrace()
         
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
+        resolution = self.plan_resolution(source, enable_super_resolution, sr_scale, print_size, print_dpi)
+        options = {
+            'enable_super_resolution': enable_super_resolution,
+            'enable_face_enhancement': enable_face_enhancement,
+            'enable_colorization': enable_colorization,
+            'enable_inpainting': enable_inpainting,
+            'instruction': instruction,
+            'sr_scale': sr_scale,
+            'face_fidelity': face_fidelity,
+            'face_regions': self._use_face_regions(face_regions),
+            'model_backend': model_backend or self.model_backend,
+            'inpaint_method': inpaint_method or self.damage.method,
+            'resolution': resolution
+        }
+        order = self.planner.order(self.stage_specs(**options))
+        output = self.encoder.resolve(output)
         
-        img_array = np.array(image)
+        if self.cache is None and self.flights is None:
+            return self._restore(source, order, options, output, None, trace, progress_callback)
         
-        logger.info("Starting Alqudimi photo restoration pipeline")
+        if input_digest is None:
+            input_digest = self._source_digest(source)
+        keys = self._stage_keys(order, input_digest, output, resolution)
+        if self.flights is None:
+            return self._restore(source, order, options, output, keys, trace, progress_callback)
         
-        if instruction:
-            logger.info(f"Using InstructIR with instruction: {instruction}")
-            img_array = self.instruct_restore(img_array, instruction)
+        led = []
         
-        if enable_inpainting:
-            logger.info("Applying inpainting for damage removal")
-            img_array = self._apply_basic_inpainting(img_array)
+        def lead(flight: Flight) -> bytes:
+            led.append(flight)
+            return self._restore(source, order, options, output, keys, trace, flight.publish, flight)
         
-        if enable_colorization:
-            is_grayscale = self._is_grayscale(img_array)
-            if is_grayscale:
-                logger.info("Detected grayscale image, applying colorization")
-                img_array = self.colorize_photo(img_array)
+        try:
+            output_bytes = self.flights.do(keys[2], lead, cancel=cancel, listener=progress_callback)
+        except Cancelled:
+            COALESCED.inc(outcome='abandoned' if led else 'cancelled')
+            raise
+        if not led:
+            logger.info("Served by an identical restoration already in flight")
+            trace.mark('coalesced', 'coalesced')
+            COALESCED.inc(outcome='joined')
+        return output_bytes
+    
+    def _restore(self, source: ImageSource, order: List[StageSpec], options: Dict[str, Any],
+                 output: Dict[str, Any], keys: Optional[tuple], trace: PipelineTrace,
+                 progress_callback: Optional[Callable[[str, str], None]] = None,
+                 flight: Optional[Flight] = None) -> bytes:
+        """
+        Run the pipeline for process_image
         
-        if enable_face_enhancement:
-            logger.info("Applying face enhancement")
-            img_array = self.face_enhancement(img_array, fidelity=face_fidelity, upscale=1)
+        Args:
+            order: Stages in planner order, built from `options`
+            output: Resolved output encoding settings
+            keys: Cache keys from _stage_keys(), or None without a cache
+            progress_callback: Receives (stage, state) updates
+            flight: The shared run this is, checked between stages so work
+                stops once every caller has gone
+        """
+        def report(stage: str, state: str) -> None:
+            if state == 'cached':
+                trace.mark(stage, state)
+            if progress_callback is not None:
+                progress_callback(stage, state)
         
-        if enable_super_resolution:
-            logger.info(f"Applying super-resolution (scale={sr_scale})")
-            img_array = self.super_resolution(img_array, scale=sr_scale)
+        def check_abandoned() -> None:
+            if flight is not None and flight.abandoned():
+                logger.info("Stopping restoration: every caller has gone")
+                raise Cancelled("Every caller cancelled the restoration")
         
-        result_image = Image.fromarray(img_array)
+        cache = self.cache
+        stage_keys = []
+        analysis_key = None
+        output_key = None
+        start = 0
+        img_array = None
         
-        output_buffer = io.BytesIO()
-        result_image.save(output_buffer, format='JPEG', quality=95)
-        output_buffer.seek(0)
+        if cache is not None:
+            analysis_key, stage_keys, output_key = keys
+            
+            with trace.stage('cache_lookup') as record:
+                record.path = 'cache'
+                cached_output = cache.get(output_key)
+            if cached_output is not None:
+                logger.info("Returning cached restoration result")
+                for spec in order:
+                    report(spec.name, 'cached')
+                report('encode', 'cached')
+                return cached_output
+            
+            # Resume after the deepest stage whose output is already cached
+            for i in range(len(order) - 1, -1, -1):
+                if cache.contains(stage_keys[i]):
+                    with trace.stage('cache_lookup') as record:
+                        record.path = 'cache'
+                        img_array = cache.get(stage_keys[i])
+                    if img_array is not None:
+                        start = i + 1
+                        logger.info(f"Reusing cached output of stage '{order[i].name}'")
+                        break
         
-        logger.info("Photo restoration pipeline completed successfully")
-        return output_buffer.getvalue()
-    
-    def _apply_basic_inpainting(self, image: np.ndarray) -> np.ndarray:
-        """Apply basic inpainting for damage and scratch removal"""
-        if len(image.shape) == 2:
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        if img_array is None:
+            with trace.stage('decode') as record:
+                img_array = read_image(source, self._decode_pixels(options['resolution']), self._image_buffer())
+                record.output(img_array)
         
-        denoised = cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 21)
+        # Analysis describes the input, so a run resumed from a stage output
+        # without it runs its remaining stages unconditionally
+        analysis = None
+        if start < len(order):
+            analysis = self._analyze(img_array if start == 0 else None, analysis_key, trace)
+        skip = {}
+        if analysis is not None:
+            logger.info(f"Image analysis: {analysis.as_dict()}")
+            skip = self.analyzer.skip_reasons(analysis)
         
-        gray = cv2.cvtColor(denoised, cv2.COLOR_RGB2GRAY)
+        specs = {spec.name: spec for spec in self.stage_specs(analysis=analysis, **options)}
+        plan = self.planner.plan([specs[spec.name] for spec in order],
+                                 (img_array.shape[1], img_array.shape[0]), skip=skip, cached=start)
+        logger.info("Starting Alqudimi photo restoration pipeline: "
+                    f"{[(step.name, step.action) for step in plan.steps]}")
         
-        mean_brightness = np.mean(gray)
-        threshold_value = max(200, min(250, int(mean_brightness * 0.95)))
-        _, bright_mask = cv2.threshold(gray, threshold_value, 255, cv2.THRESH_BINARY)
+        for step in plan.steps[:start]:
+            report(step.name, 'cached')
         
-        edges = cv2.Canny(gray, 50, 150)
-        kernel = np.ones((2,2), np.uint8)
-        edge_mask = cv2.dilate(edges, kernel, iterations=1)
+        # Outputs derived from a fallback result are never cached, so a
+        # transient model failure does not pin a low-quality result
+        cacheable = cache is not None
+        # Once a concurrent stage is in flight, stage outputs lack its result
+        # and are not cached as intermediates
+        intermediate = True
+        pending = []
         
-        combined_mask = cv2.bitwise_or(bright_mask, edge_mask)
-        combined_mask = cv2.erode(combined_mask, kernel, iterations=1)
+        for unit in plan.units():
+            check_abandoned()
+            step = unit[-1]
+            i = plan.steps.index(step)
+            if step.action == 'run' and step.spec.concurrent:
+                logger.info(f"Starting stage '{step.name}' {step.spec.params} alongside the stages after it")
+                report(step.name, 'running')
+                pending.append((step, step.spec.run(img_array)))
+                intermediate = False
+                continue
+            if len(unit) > 1 or step.group is not None:
+                img_array = self._run_fused(unit, img_array, trace, report)
+            elif step.action == 'skip':
+                logger.info(f"Skipping stage '{step.name}': {step.reason}")
+                trace.mark(step.name, 'skipped')
+                report(step.name, 'skipped')
+            else:
+                logger.info(f"Running stage '{step.name}' {step.spec.params}")
+                report(step.name, 'running')
+                result, fell_back = self.run_stage(step.name, step.spec.run, img_array, trace)
+                if result is None:
+                    report(step.name, 'skipped')
+                else:
+                    img_array = result
+                    report(step.name, 'completed')
+                if fell_back:
+                    cacheable = False
+            
+            if cacheable and intermediate:
+                cache.put(stage_keys[i], img_array)
         
-        if np.sum(combined_mask > 0) > 0:
-            inpainted = cv2.inpaint(denoised, combined_mask, 3, cv2.INPAINT_TELEA)
-            return inpainted
+        for step, job in pending:
+            check_abandoned()
+            img_array, fell_back = job.finish(img_array, trace)
+            report(step.name, 'completed')
+            if fell_back:
+                cacheable = False
         
-        return denoised
+        report('encode', 'running')
+        with trace.stage('encode', img_array) as record:
+            output_bytes = self.encoder.encode(img_array, output)
+            record.bytes['encoded'] = len(output_bytes)
+        report('encode', 'completed')
+        
+        if cacheable:
+            cache.put(output_key, output_bytes)
+        
+        logger.info("Photo restoration pipeline completed successfully")
+        return output_bytes
     
-    def _is_grayscale(self, image: np.ndarray) -> bool:
-        """Check if image is grayscale"""
+    def _run_fused(self, unit: List[PlanStep], image: np.ndarray, trace: PipelineTrace,
+                   report: Callable[[str, str], None]) -> np.ndarray:
+        """Run a fused group of local stages as one CPU pool call and record each stage"""
+        calls = [(step.name, step.spec.local_call) for step in unit if step.action == 'run']
+        if calls and calls[0][0] == 'inpainting':
+            # The chain's input is the inpainting input, so its damage mask
+            # can come from (and go to) the cache
+            method, kwargs = calls[0][1]
+            calls[0] = ('inpainting', (method, {**kwargs, 'damage': self._damage_mask(image)}))
+        logger.info(f"Running fused stages {[name for name, _ in calls]}")
+        for name, _ in calls:
+            report(name, 'running')
+        image, records = self._run_cpu(self._run_local_chain, calls, image)
+        
+        measured = {record.name: record for record in records}
+        for step in unit:
+            if step.action == 'skip':
+                logger.info(f"Skipping stage '{step.name}': {step.reason}")
+                trace.mark(step.name, 'skipped')
+                report(step.name, 'skipped')
+            else:
+                trace.add(measured[step.name])
+                report(step.name, 'completed')
+        return image
+    
+    @staticmethod
+    def _source_digest(source: ImageSource) -> str:
+        if isinstance(source, np.ndarray):
+            return array_digest(source)
+        if isinstance(source, (str, os.PathLike)):
+            return file_digest(os.fspath(source))
+        return image_digest(source)
+    
+    def _damage_mask(self, image: np.ndarray) -> DamageMask:
+        """Scratch and dust mask of an image, cached by its content hash"""
+        key = None
+        if self.cache is not None:
+            key = chain_key(array_digest(image), 'damage', self.damage.settings())
+            cached = self.cache.get(key)
+            damage = DamageMask.from_bytes(cached) if cached is not None else None
+            if damage is not None:
+                return damage
+        damage = self._run_cpu(self.damage.detect, image)
+        logger.info(f"Damage mask: {damage.as_dict()}")
+        if key is not None:
+            self.cache.put(key, damage.to_bytes())
+        return damage
+    
+    def _inpaint(self, image: np.ndarray, method: Optional[str] = None, denoise: bool = True) -> np.ndarray:
+        """Inpainting stage run on its own: cached mask, then denoise and repair on the CPU pool"""
+        damage = self._damage_mask(image)
+        return self._run_cpu(self._apply_basic_inpainting, image, None, damage, method, denoise)
+    
+    def _apply_basic_inpainting(self, image: np.ndarray,
+                                context: Optional[ColorContext] = None,
+                                damage: Optional[DamageMask] = None,
+                                method: Optional[str] = None,
+                                denoise: bool = True) -> np.ndarray:
+        """
+        Apply basic inpainting for damage and scratch removal
+        
+        Scratches and dust are found on the input (see DamageRepair), then
+        repaired on the optionally denoised image, region by region, so
+        untouched pixels and real edges are left as they are.
+        
+        Args:
+            context: Conversions of the input; its gray plane feeds detection
+            damage: Mask of the input, if already detected
+            method: Repair method, one of damage.METHODS
+            denoise: Run tiled NL-means denoising before the repair
+        """
+        if damage is None:
+            damage = self.damage.detect(context.gray() if context is not None and image.ndim == 3 else image)
         if len(image.shape) == 2:
-            return True
-        return np.allclose(image[:,:,0], image[:,:,1]) and np.allclose(image[:,:,1], image[:,:,2])
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        
+        if denoise:
+            image = self.tiles.map(
+                image, lambda tile: cv2.fastNlMeansDenoisingColored(tile, None, 10, 10, 7, 21)
+            )
+        
+        return self.damage.repair(image, damage, method)
+    
+    def _is_grayscale(self, image: np.ndarray) -> bool:
+        """Check if image is grayscale, on a strided sample of its pixels"""
+        return is_grayscale(image)
 
 
 PhotoProcessor = AIPhotoProcessor
@@ -0,0 +1,379 @@
+from __future__ import annotations
+
+import itertools
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+# Conversions from RGB a stage can ask the ColorContext for
+CONVERSIONS = {
+    'gray': 'COLOR_RGB2GRAY',
+    'lab': 'COLOR_RGB2LAB',
+}
+
+# Beyond this many stages the planner keeps the declared order instead of
+# searching all valid orders
+MAX_SEARCH_STAGES = 8
+
+
+class ColorContext:
+    """
+    Colour-space views of one image, each converted at most once.
+
+    Stages that run back to back on the same image (and the steps inside a
+    stage) ask the context instead of calling cvtColor themselves, so a
+    gray or LAB plane is computed once however many consumers it has. A
+    stage that already holds a conversion of its output can hand it on
+    with put(). Conversions are per-pixel, so they run in row bands on
+    the tile engine when one is given.
+    """
+
+    def __init__(self, image: np.ndarray, tiles=None):
+        self.image = image
+        self.tiles = tiles
+        self._views: Dict[str, np.ndarray] = {}
+        self.converted = 0
+        self.reused = 0
+
+    def get(self, space: str) -> np.ndarray:
+        """The image in `space` ('rgb', 'gray' or 'lab'), converting on first use"""
+        if space == 'rgb':
+            return self.image
+        view = self._views.get(space)
+        if view is not None:
+            self.reused += 1
+            return view
+        code = getattr(cv2, CONVERSIONS[space])
+        if self.tiles is not None:
+            view = self.tiles.map_rows(self.image, lambda band: cv2.cvtColor(band, code))
+        else:
+            view = cv2.cvtColor(self.image, code)
+        self.converted += 1
+        self._views[space] = view
+        return view
+
+    def gray(self) -> np.ndarray:
+        return self.get('gray')
+
+    def lab(self) -> np.ndarray:
+        return self.get('lab')
+
+    def take(self, space: str) -> np.ndarray:
+        """Like get(), for a consumer that modifies the view in place; the context drops it"""
+        view = self.get(space)
+        self._views.pop(space, None)
+        return view
+
+    def put(self, space: str, view: np.ndarray) -> None:
+        """Offer a conversion of this image that was computed anyway"""
+        self._views[space] = view
+
+    def advance(self, image: Optional[np.ndarray]) -> "ColorContext":
+        """Context for the next stage; views carry over only if the image did not change"""
+        if image is None or image is self.image:
+            return self
+        following = ColorContext(image, self.tiles)
+        following.converted = self.converted
+        following.reused = self.reused
+        return following
+
+
+class StageSpec:
+    """
+    One node of the stage graph.
+
+    Declares what the planner needs to order, skip, fuse and cost a stage
+    without running it: which stages must come first, how much it grows
+    the image, where it runs and what it roughly costs.
+    """
+
+    def __init__(self, name: str, params: Dict[str, Any],
+                 run: Callable[[np.ndarray], Optional[np.ndarray]],
+                 after: Sequence[str] = (), scale: float = 1.0,
+                 path: str = 'local', local_call: Optional[Tuple[str, Dict[str, Any]]] = None,
+                 fixed_s: float = 0.0, per_mp_in_s: float = 0.0, per_mp_out_s: float = 0.0,
+                 skip_reason: Optional[str] = None, concurrent: bool = False):
+        """
+        Args:
+            name: Stage name (also its cache key component)
+            params: Parameters that change the stage output
+            run: Stage function; returns the new image, or None when it had nothing to do
+            after: Stages that must run before this one when both are present
+            scale: Output/input size ratio per side
+            path: 'local' (OpenCV in this process or the CPU pool), 'remote'
+                (Replicate) or 'onnx' (ONNX Runtime in this process)
+            local_call: (processor method, kwargs) that runs the stage on the
+                CPU pool; local stages with one can be fused with their neighbours
+            fixed_s: Estimated seconds per call
+            per_mp_in_s: Estimated seconds per input megapixel
+            per_mp_out_s: Estimated seconds per output megapixel
+            skip_reason: Set when the stage is known to do nothing for this request
+            concurrent: The stage works on a snapshot of its input while the
+                stages after it run; run() starts it and returns a handle
+                whose finish(frame, trace) blends its result into the final
+                frame and returns (frame, fell_back)
+        """
+        self.name = name
+        self.params = params
+        self.run = run
+        self.after = tuple(after)
+        self.scale = scale
+        self.path = path
+        self.local_call = local_call
+        self.fixed_s = fixed_s
+        self.per_mp_in_s = per_mp_in_s
+        self.per_mp_out_s = per_mp_out_s
+        self.skip_reason = skip_reason
+        self.concurrent = concurrent
+
+    @property
+    def fusable(self) -> bool:
+        return self.path == 'local' and self.local_call is not None
+
+    def cost(self, pixels: float) -> float:
+        """Estimated seconds for an input of `pixels` pixels"""
+        megapixels = pixels / 1e6
+        return self.fixed_s + self.per_mp_in_s * megapixels + self.per_mp_out_s * megapixels * self.scale ** 2
+
+
+class PlanStep:
+    """A stage as the plan will execute it"""
+
+    def __init__(self, spec: StageSpec, action: str, reason: Optional[str] = None):
+        self.spec = spec
+        self.action = action
+        self.reason = reason
+        self.group: Optional[int] = None
+        self.size_in: Optional[Tuple[int, int]] = None
+        self.size_out: Optional[Tuple[int, int]] = None
+        self.estimate_s = 0.0
+
+    @property
+    def name(self) -> str:
+        return self.spec.name
+
+    def as_dict(self) -> Dict[str, Any]:
+        entry = {
+            "stage": self.name,
+            "action": self.action,
+            "path": self.spec.path,
+            "params": self.spec.params,
+            "size_in": self.size_in,
+            "size_out": self.size_out,
+            "estimate_s": round(self.estimate_s, 3)
+        }
+        if self.reason:
+            entry["reason"] = self.reason
+        if self.group is not None:
+            entry["group"] = self.group
+        if self.spec.concurrent:
+            entry["concurrent"] = True
+        return entry
+
+
+class Plan:
+    """Ordered, annotated stages for one request"""
+
+    def __init__(self, steps: List[PlanStep], analysis: Optional[Dict[str, Any]] = None,
+                 resolution: Optional[Dict[str, Any]] = None):
+        self.steps = steps
+        self.analysis = analysis
+        self.resolution = resolution
+
+    def units(self) -> List[List[PlanStep]]:
+        """
+        The steps after the cached prefix, split into execution units
+
+        A fused unit holds consecutive local steps (and any skipped steps
+        between them) run as one CPU pool call; every other step is a unit
+        of its own. Fused units always end with a step that runs.
+        """
+        units: List[List[PlanStep]] = []
+        for step in self.steps:
+            if step.action == 'cached':
+                continue
+            if units and step.group is not None and units[-1][-1].group == step.group:
+                units[-1].append(step)
+            else:
+                units.append([step])
+        return units
+
+    def fused(self) -> List[List[str]]:
+        """Stages sharing a CPU pool call, for units that fuse more than one"""
+        fused = []
+        for unit in self.units():
+            names = [step.name for step in unit if step.action == 'run']
+            if len(names) > 1:
+                fused.append(names)
+        return fused
+
+    @property
+    def estimate_s(self) -> float:
+        """Estimated time along the critical path; concurrent steps overlap the steps after them"""
+        total = 0.0
+        overlap = 0.0
+        for step in reversed(self.steps):
+            if step.spec.concurrent:
+                total += max(0.0, step.estimate_s - overlap)
+            else:
+                total += step.estimate_s
+                overlap += step.estimate_s
+        return total
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "stages": [step.as_dict() for step in self.steps],
+            "fused": self.fused(),
+            "estimate_s": round(self.estimate_s, 3),
+            "analysis": self.analysis,
+            "resolution": self.resolution
+        }
+
+
+class PipelinePlanner:
+    """
+    Turns a set of StageSpecs into an executable Plan.
+
+    - order: the cheapest order allowed by every stage's `after`
+      constraints, pricing each stage at the size it would see (so stages
+      that enlarge the image are pushed as late as allowed); ties keep
+      the declared order. Concurrent stages start as soon as the stages
+      they depend on have run
+    - skip: stages the analysis or the configuration rule out
+    - resume: stages whose output is already cached
+    - fuse: adjacent local stages run as one CPU pool call sharing one
+      ColorContext, so the image crosses to a worker process once
+    """
+
+    def __init__(self, fuse: bool = True):
+        """
+        Args:
+            fuse: Run adjacent local stages as one CPU pool call
+        """
+        self.fuse = fuse
+
+    @classmethod
+    def from_env(cls) -> "PipelinePlanner":
+        """Build from PHOTO_FUSE_STAGES (default 1)"""
+        return cls(fuse=os.environ.get('PHOTO_FUSE_STAGES', '1') != '0')
+
+    @staticmethod
+    def _valid(order: Sequence[StageSpec]) -> bool:
+        seen = set()
+        present = {spec.name for spec in order}
+        for spec in order:
+            if any(dep in present and dep not in seen for dep in spec.after):
+                return False
+            seen.add(spec.name)
+        return True
+
+    @staticmethod
+    def _cost(order: Sequence[StageSpec], pixels: float) -> float:
+        total = 0.0
+        for spec in order:
+            if spec.skip_reason:
+                continue
+            total += spec.cost(pixels)
+            pixels *= spec.scale ** 2
+        return total
+
+    def order(self, specs: Sequence[StageSpec], size: Tuple[int, int] = (1024, 1024)) -> List[StageSpec]:
+        """
+        Cheapest valid order of `specs` for an input of `size` (width, height)
+
+        Raises:
+            ValueError: If the `after` constraints form a cycle
+        """
+        concurrent = [spec for spec in specs if spec.concurrent]
+        specs = [spec for spec in specs if not spec.concurrent]
+        pixels = float(size[0] * size[1])
+        if len(specs) > MAX_SEARCH_STAGES:
+            if not self._valid(specs):
+                raise ValueError("Declared stage order violates its own constraints")
+            return self._insert_concurrent(specs, concurrent)
+
+        best, best_cost = None, None
+        # permutations() yields the declared order first, so ties keep it
+        for order in itertools.permutations(specs):
+            if not self._valid(order):
+                continue
+            cost = self._cost(order, pixels)
+            if best_cost is None or cost < best_cost - 1e-9:
+                best, best_cost = list(order), cost
+        if best is None:
+            raise ValueError("Stage constraints form a cycle")
+        return self._insert_concurrent(best, concurrent)
+
+    @staticmethod
+    def _insert_concurrent(order: List[StageSpec], concurrent: List[StageSpec]) -> List[StageSpec]:
+        """Place each concurrent stage right after the last of its dependencies"""
+        order = list(order)
+        for spec in concurrent:
+            names = [member.name for member in order]
+            position = max((names.index(dep) + 1 for dep in spec.after if dep in names), default=0)
+            order.insert(position, spec)
+        return order
+
+    def plan(self, order: Sequence[StageSpec], size: Tuple[int, int],
+             skip: Optional[Dict[str, str]] = None, cached: int = 0,
+             analysis: Optional[Dict[str, Any]] = None,
+             resolution: Optional[Dict[str, Any]] = None) -> Plan:
+        """
+        Annotate an ordered list of stages
+
+        Args:
+            order: Stages in execution order (from order())
+            size: Input (width, height)
+            skip: Stage name -> reason, from the analysis pre-pass
+            cached: Number of leading stages served from the cache
+            analysis: Analysis results to include in the plan
+            resolution: Resolution plan to include in the plan
+        """
+        skip = skip or {}
+        steps = []
+        width, height = size
+        for index, spec in enumerate(order):
+            reason = spec.skip_reason or skip.get(spec.name)
+            if index < cached:
+                steps.append(PlanStep(spec, 'cached'))
+                continue
+            step = PlanStep(spec, 'skip', reason) if reason else PlanStep(spec, 'run')
+            step.size_in = (width, height)
+            if step.action == 'run':
+                step.estimate_s = spec.cost(width * height)
+                width, height = int(width * spec.scale), int(height * spec.scale)
+            step.size_out = (width, height)
+            steps.append(step)
+
+        if self.fuse:
+            self._fuse(steps)
+        return Plan(steps, analysis, resolution)
+
+    @staticmethod
+    def _fuse(steps: List[PlanStep]) -> None:
+        """Give each chain of fusable steps a group id; skipped steps inside a chain join it"""
+        group = 0
+        chain: List[PlanStep] = []
+        for step in steps + [None]:
+            if step is not None and step.action == 'skip':
+                if chain:
+                    chain.append(step)
+                continue
+            if step is not None and step.action == 'run' and step.spec.fusable:
+                if not chain:
+                    group += 1
+                chain.append(step)
+                continue
+            # Chain ends: trailing skips run as units of their own
+            while chain and chain[-1].action == 'skip':
+                chain.pop()
+            for member in chain:
+                member.group = group
+            chain = []
@@ -0,0 +1,338 @@
+from __future__ import annotations
+
+import contextvars
+import heapq
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from lazy import lazy_import
+
+replicate = lazy_import('replicate')
+
+logger = logging.getLogger(__name__)
+
+TERMINAL = ('succeeded', 'failed', 'canceled')
+
+
+class PredictionFailed(Exception):
+    """Raised when a prediction ends in 'failed' or 'canceled'"""
+
+
+class _Pending:
+    __slots__ = ('id', 'ref', 'future', 'finish', 'context', 'interval', 'created')
+
+    def __init__(self, prediction_id: str, ref: str, future: Future, finish: Callable[[Any], Any],
+                 context: contextvars.Context, interval: float):
+        self.id = prediction_id
+        self.ref = ref
+        self.future = future
+        self.finish = finish
+        self.context = context
+        self.interval = interval
+        self.created = time.monotonic()
+
+
+class PredictionTracker:
+    """
+    Runs Replicate models without holding a thread per call.
+
+    submit() creates the prediction and returns a Future at once. A single
+    poller thread checks every prediction in flight, backing off from
+    `poll_interval` to `max_poll_interval` as it runs. With a webhook URL
+    configured, Replicate calls the API back on completion and the poller
+    only acts as a slow safety net. Webhooks are not trusted as such: they
+    make the poller fetch the prediction right away. Cancelling a Future
+    cancels its prediction upstream.
+
+    Behind several API worker processes, the webhook may reach a worker
+    other than the one that created the prediction. That worker leaves a
+    marker file in `relay_dir`, which the owner picks up within
+    `relay_interval` and treats as its own webhook.
+    """
+
+    def __init__(self, client=None, webhook_url: Optional[str] = None,
+                 poll_interval: float = 0.5, max_poll_interval: float = 5.0,
+                 backoff: float = 1.5, webhook_poll_interval: float = 30.0, workers: int = 8,
+                 relay_dir: Optional[str] = None, relay_interval: float = 0.5, relay_ttl: float = 600.0):
+        """
+        Args:
+            client: Replicate client (defaults to the module client)
+            webhook_url: Public URL of /api/predictions/webhook; polling only when None
+            poll_interval: Seconds before a new prediction is first checked
+            max_poll_interval: Upper bound of the backed-off poll interval
+            backoff: Factor the poll interval grows by after each check
+            webhook_poll_interval: Poll interval while webhooks are expected
+            workers: Threads fetching prediction status and running `finish` callbacks
+            relay_dir: Directory shared by the workers for passing on
+                webhooks of each other's predictions (None: no relaying)
+            relay_interval: Seconds between checks for relayed webhooks
+            relay_ttl: Seconds after which an unclaimed relay marker is deleted
+        """
+        self.client = client
+        self.webhook_url = webhook_url
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(poll_interval, max_poll_interval)
+        self.backoff = backoff
+        self.webhook_poll_interval = webhook_poll_interval
+        self.workers = workers
+        self.relay_dir = relay_dir if webhook_url else None
+        self.relay_interval = relay_interval
+        self.relay_ttl = relay_ttl
+        if self.relay_dir:
+            os.makedirs(self.relay_dir, exist_ok=True)
+
+        self._lock = threading.Condition()
+        self._pending: Dict[str, _Pending] = {}
+        self._schedule: List[Tuple[float, str]] = []
+        self._poller: Optional[threading.Thread] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._relay: Optional[threading.Thread] = None
+        # Separate from the poller's condition, whose notify() must reach the poller
+        self._relay_stop = threading.Event()
+        self._closed = False
+        self.totals = {"created": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "polls": 0, "webhooks": 0,
+                       "relayed": 0}
+
+    @classmethod
+    def from_env(cls) -> "PredictionTracker":
+        """
+        Build from PHOTO_WEBHOOK_URL, PHOTO_POLL_INTERVAL, PHOTO_POLL_MAX_INTERVAL
+        and PHOTO_WEBHOOK_RELAY_DIR (empty disables relaying)
+        """
+        default_relay = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'webhooks')
+        return cls(
+            webhook_url=os.environ.get('PHOTO_WEBHOOK_URL') or None,
+            poll_interval=float(os.environ.get('PHOTO_POLL_INTERVAL', '0.5')),
+            max_poll_interval=float(os.environ.get('PHOTO_POLL_MAX_INTERVAL', '5')),
+            relay_dir=os.environ.get('PHOTO_WEBHOOK_RELAY_DIR', default_relay) or None
+        )
+
+    def _client(self):
+        return self.client if self.client is not None else replicate.default_client
+
+    def _start(self) -> ThreadPoolExecutor:
+        # Called with the lock held
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='photo-predictions')
+        if self._poller is None:
+            self._poller = threading.Thread(target=self._poll_loop, name='photo-prediction-poller', daemon=True)
+            self._poller.start()
+        if self._relay is None and self.relay_dir:
+            self._relay = threading.Thread(target=self._relay_loop, name='photo-webhook-relay', daemon=True)
+            self._relay.start()
+        return self._pool
+
+    def _create(self, ref: str, inputs: Dict[str, Any]):
+        params: Dict[str, Any] = {}
+        if self.webhook_url:
+            params = {"webhook": self.webhook_url, "webhook_events_filter": ["completed"]}
+        client = self._client()
+        model, _, version = ref.partition(':')
+        if version:
+            return client.predictions.create(version=version, input=inputs, **params)
+        return client.models.predictions.create(model=model, input=inputs, **params)
+
+    def submit(self, ref: str, inputs: Dict[str, Any], finish: Callable[[Any], Any] = lambda output: output) -> Future:
+        """
+        Create a prediction and return a Future of its finished result
+
+        Args:
+            ref: Model reference, 'owner/name' or 'owner/name:version'
+            inputs: Model inputs
+            finish: Turns the prediction output into the Future's result
+                (e.g. downloads it); runs on a worker thread in the
+                caller's context
+
+        Raises:
+            Exception: If the prediction cannot be created
+        """
+        prediction = self._create(ref, inputs)
+        future: Future = Future()
+        interval = self.webhook_poll_interval if self.webhook_url else self.poll_interval
+        pending = _Pending(prediction.id, ref, future, finish, contextvars.copy_context(), interval)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Prediction tracker is closed")
+            self._start()
+            self.totals["created"] += 1
+            self._pending[prediction.id] = pending
+        future.add_done_callback(lambda f: self._on_done(pending) if f.cancelled() else None)
+        if prediction.status in TERMINAL:
+            self._settle(pending, prediction.status, prediction.output, prediction.error)
+        else:
+            self._schedule_poll(prediction.id, interval)
+        return future
+
+    def _schedule_poll(self, prediction_id: str, delay: float) -> None:
+        with self._lock:
+            heapq.heappush(self._schedule, (time.monotonic() + delay, prediction_id))
+            self._lock.notify()
+
+    def notify(self, prediction_id: Optional[str]) -> bool:
+        """
+        Webhook hook: check this prediction now; False if it is not ours or
+        already done, in which case it is relayed to the other workers
+        """
+        with self._lock:
+            ours = prediction_id in self._pending
+            if ours:
+                self.totals["webhooks"] += 1
+        if ours:
+            self._schedule_poll(prediction_id, 0.0)
+        elif self.relay_dir and isinstance(prediction_id, str) and prediction_id.isascii() \
+                and prediction_id.isalnum() and len(prediction_id) <= 64:
+            # The ID becomes a file name, hence the check above
+            try:
+                with open(os.path.join(self.relay_dir, prediction_id), 'w'):
+                    pass
+            except OSError as e:
+                logger.warning(f"Could not relay webhook for prediction {prediction_id}: {str(e)}")
+            else:
+                with self._lock:
+                    self.totals["relayed"] += 1
+        return ours
+
+    def _relay_loop(self) -> None:
+        cleaned = time.monotonic()
+        while not self._relay_stop.wait(self.relay_interval):
+            with self._lock:
+                pending = set(self._pending)
+            if not pending and time.monotonic() - cleaned < self.relay_ttl:
+                continue
+            try:
+                names = os.listdir(self.relay_dir)
+            except OSError as e:
+                logger.warning(f"Could not read webhook relay directory: {str(e)}")
+                continue
+            for name in names:
+                if name not in pending:
+                    continue
+                try:
+                    os.remove(os.path.join(self.relay_dir, name))
+                except FileNotFoundError:
+                    continue
+                # Also covers a webhook that arrived here before submit() registered the prediction
+                with self._lock:
+                    if name not in self._pending:
+                        continue
+                    self.totals["webhooks"] += 1
+                self._schedule_poll(name, 0.0)
+            if time.monotonic() - cleaned >= self.relay_ttl:
+                cleaned = time.monotonic()
+                self._clean_relay(names, pending)
+
+    def _clean_relay(self, names: List[str], pending: Set[str]) -> None:
+        """Delete markers no worker claimed, e.g. for predictions that had already finished"""
+        expired = time.time() - self.relay_ttl
+        for name in names:
+            path = os.path.join(self.relay_dir, name)
+            try:
+                if name not in pending and os.stat(path).st_mtime < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _poll_loop(self) -> None:
+        while True:
+            with self._lock:
+                while not self._closed and (not self._schedule or self._schedule[0][0] > time.monotonic()):
+                    timeout = self._schedule[0][0] - time.monotonic() if self._schedule else None
+                    self._lock.wait(timeout)
+                if self._closed:
+                    return
+                _, prediction_id = heapq.heappop(self._schedule)
+                pending = self._pending.get(prediction_id)
+                if pending is None:
+                    continue
+                self.totals["polls"] += 1
+                pool = self._pool
+            pool.submit(self._poll, pending)
+
+    def _poll(self, pending: _Pending) -> None:
+        try:
+            prediction = self._client().predictions.get(pending.id)
+        except Exception as e:
+            logger.warning(f"Could not check prediction {pending.id}: {str(e)}")
+            prediction = None
+        if prediction is not None and prediction.status in TERMINAL:
+            self._settle(pending, prediction.status, prediction.output, prediction.error)
+            return
+        with self._lock:
+            if pending.id not in self._pending:
+                return
+            if not self.webhook_url:
+                pending.interval = min(pending.interval * self.backoff, self.max_poll_interval)
+        self._schedule_poll(pending.id, pending.interval)
+
+    def _settle(self, pending: _Pending, status: str, output: Any, error: Any) -> None:
+        with self._lock:
+            if self._pending.pop(pending.id, None) is None:
+                return
+            self.totals["succeeded" if status == 'succeeded' else "failed"] += 1
+            pool = self._pool
+        if status != 'succeeded':
+            self._resolve(pending.future, error=PredictionFailed(
+                f"Prediction {pending.id} for {pending.ref} {status}: {error or 'no error given'}"))
+            return
+        pool.submit(self._finish, pending, output)
+
+    def _finish(self, pending: _Pending, output: Any) -> None:
+        try:
+            result = pending.context.run(pending.finish, output)
+        except Exception as e:
+            self._resolve(pending.future, error=e)
+            return
+        self._resolve(pending.future, result=result)
+
+    @staticmethod
+    def _resolve(future: Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+        if not future.set_running_or_notify_cancel():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _on_done(self, pending: _Pending) -> None:
+        # The caller gave up (deadline, lost hedge or shutdown): stop the prediction upstream
+        with self._lock:
+            if self._pending.pop(pending.id, None) is None:
+                return
+            self.totals["cancelled"] += 1
+            pool = self._pool
+        if pool is not None:
+            pool.submit(self._cancel, pending.id)
+
+    def _cancel(self, prediction_id: str) -> None:
+        try:
+            self._client().predictions.cancel(prediction_id)
+        except Exception as e:
+            logger.warning(f"Could not cancel prediction {prediction_id}: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            oldest = min((p.created for p in self._pending.values()), default=None)
+            return {
+                "in_flight": len(self._pending),
+                "oldest_s": round(time.monotonic() - oldest, 1) if oldest is not None else None,
+                "mode": "webhook" if self.webhook_url else "poll",
+                **self.totals
+            }
+
+    def close(self) -> None:
+        """Stop polling and cancel every prediction still in flight"""
+        with self._lock:
+            self._closed = True
+            pending = list(self._pending.values())
+            self._lock.notify_all()
+        self._relay_stop.set()
+        for entry in pending:
+            entry.future.cancel()
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
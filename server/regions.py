@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import logging
+import time
+from typing import List, Sequence, Tuple
+
+from lazy import lazy_import
+from metrics import StageRecord
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[int, int, int, int]
+
+
+def expand_box(box: Box, width: int, height: int, margin: float = 0.5) -> Box:
+    """
+    Grow an (x, y, w, h) box by `margin` of its size on every side, clamped to the image
+
+    Face detectors return tight boxes; restoration models need the hair,
+    jaw and some background around them, and the feathered edge of the
+    composite needs room outside the face itself.
+    """
+    x, y, w, h = box
+    pad_x, pad_y = int(w * margin), int(h * margin)
+    x0, y0 = max(0, x - pad_x), max(0, y - pad_y)
+    x1, y1 = min(width, x + w + pad_x), min(height, y + h + pad_y)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def merge_boxes(boxes: Sequence[Box]) -> List[Box]:
+    """Union overlapping boxes so no pixel is composited twice"""
+    merged: List[Box] = []
+    for box in sorted(boxes):
+        x, y, w, h = box
+        for i, (mx, my, mw, mh) in enumerate(merged):
+            if x < mx + mw and mx < x + w and y < my + mh and my < y + h:
+                x0, y0 = min(x, mx), min(y, my)
+                x1, y1 = max(x + w, mx + mw), max(y + h, my + mh)
+                merged[i] = (x0, y0, x1 - x0, y1 - y0)
+                break
+        else:
+            merged.append(box)
+    if len(merged) < len(boxes):
+        # A union can grow into a box it did not overlap before
+        return merge_boxes(merged) if len(merged) > 1 else merged
+    return merged
+
+
+def region_boxes(faces: Sequence[Box], width: int, height: int, margin: float = 0.5,
+                 min_side: int = 32) -> List[Box]:
+    """Padded, merged crop boxes for detected faces"""
+    boxes = [expand_box(face, width, height, margin) for face in faces]
+    return [box for box in merge_boxes(boxes) if box[2] >= min_side and box[3] >= min_side]
+
+
+def feather_mask(height: int, width: int, feather: int) -> np.ndarray:
+    """Float32 weights that are 1 inside and ramp linearly to 0 over `feather` pixels at the edges"""
+    feather = max(1, min(feather, height // 2, width // 2))
+    ramp_y = np.minimum(np.arange(height), np.arange(height)[::-1]).astype(np.float32)
+    ramp_x = np.minimum(np.arange(width), np.arange(width)[::-1]).astype(np.float32)
+    ramp_y = np.clip((ramp_y + 0.5) / feather, 0.0, 1.0)
+    ramp_x = np.clip((ramp_x + 0.5) / feather, 0.0, 1.0)
+    return np.minimum(ramp_y[:, None], ramp_x[None, :])
+
+
+def composite_regions(frame: np.ndarray, patches: Sequence[Tuple[Box, np.ndarray]],
+                      scale: float = 1.0, luminance_only: bool = False,
+                      feather: float = 0.15) -> np.ndarray:
+    """
+    Blend restored patches into a frame
+
+    Args:
+        frame: RGB frame the patches go into (not modified)
+        patches: ((x, y, w, h) in input coordinates, RGB patch) pairs
+        scale: Frame size / input size, e.g. the super-resolution factor
+        luminance_only: Take only lightness from the patches and keep the
+            frame's colour, for frames colorized after the crops were taken
+        feather: Width of the blend ramp as a fraction of the shorter side
+
+    Returns:
+        A new frame with every patch blended in
+    """
+    if not patches:
+        return frame
+    out = frame.copy()
+    frame_height, frame_width = frame.shape[:2]
+    for (x, y, w, h), patch in patches:
+        x0, y0 = int(round(x * scale)), int(round(y * scale))
+        x1 = min(frame_width, int(round((x + w) * scale)))
+        y1 = min(frame_height, int(round((y + h) * scale)))
+        if x1 <= x0 or y1 <= y0:
+            continue
+        width, height = x1 - x0, y1 - y0
+        if patch.shape[:2] != (height, width):
+            interpolation = cv2.INTER_AREA if patch.shape[0] > height else cv2.INTER_CUBIC
+            patch = cv2.resize(patch, (width, height), interpolation=interpolation)
+
+        mask = feather_mask(height, width, int(min(width, height) * feather))
+        region = out[y0:y1, x0:x1]
+        if luminance_only:
+            lab = cv2.cvtColor(region, cv2.COLOR_RGB2LAB)
+            lightness = cv2.cvtColor(patch, cv2.COLOR_RGB2LAB)[:, :, 0]
+            mixed = lab[:, :, 0] * (1.0 - mask) + lightness * mask
+            lab[:, :, 0] = np.clip(np.rint(mixed), 0, 255).astype(np.uint8)
+            out[y0:y1, x0:x1] = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+        else:
+            weight = mask[:, :, None]
+            mixed = region * (1.0 - weight) + patch * weight
+            out[y0:y1, x0:x1] = np.clip(np.rint(mixed), 0, 255).astype(np.uint8)
+    return out
+
+
+def crop(image: np.ndarray, box: Box) -> np.ndarray:
+    """Contiguous copy of an (x, y, w, h) region"""
+    x, y, w, h = box
+    return np.ascontiguousarray(image[y:y + h, x:x + w])
+
+
+class RegionJob:
+    """
+    Face crops in flight to the restoration model.
+
+    Each crop is a separate future, so crops are enhanced in parallel with
+    each other and with whatever the pipeline runs on the full frame in
+    the meantime. finish() waits for them and blends the results into the
+    final frame.
+    """
+
+    def __init__(self, name: str, boxes: List[Box], futures: list,
+                 input_size: Tuple[int, int], luminance_only: bool):
+        """
+        Args:
+            name: Stage name used for the trace record
+            boxes: Crop boxes in input coordinates
+            futures: One future per box resolving to (patch, fell_back, transfer stats, cpu seconds, end time)
+            input_size: (width, height) of the image the crops were taken from
+            luminance_only: Blend lightness only (the frame is colorized after the crops were taken)
+        """
+        self.name = name
+        self.boxes = boxes
+        self.futures = futures
+        self.input_size = input_size
+        self.luminance_only = luminance_only
+        self.started = time.perf_counter()
+
+    def finish(self, frame: np.ndarray, trace) -> Tuple[np.ndarray, bool]:
+        """
+        Wait for every crop and composite the ones that succeeded
+
+        Returns:
+            (composited frame, whether any crop fell back)
+        """
+        record = StageRecord(self.name)
+        record.path = 'remote'
+        record.size_in = self.input_size
+        patches = []
+        fell_back = False
+        ended = self.started
+        for box, future in zip(self.boxes, self.futures):
+            patch, crop_fell_back, transfer_stats, cpu_s, end = future.result()
+            record.cpu_s += cpu_s
+            record.add_transfer(transfer_stats)
+            ended = max(ended, end)
+            if crop_fell_back:
+                fell_back = True
+                continue
+            patches.append((box, patch))
+        record.wall_s = ended - self.started
+        if fell_back:
+            record.path = 'fallback'
+        record.output(frame)
+        trace.add(record)
+
+        with trace.stage('composite', frame) as composite:
+            scale = frame.shape[1] / self.input_size[0]
+            frame = composite_regions(frame, patches, scale=scale, luminance_only=self.luminance_only)
+            composite.output(frame)
+        logger.info(f"Composited {len(patches)} of {len(self.boxes)} face region(s) at {scale:.2f}x")
+        return frame, fell_back
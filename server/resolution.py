@@ -0,0 +1,202 @@
+import logging
+import math
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Scales the super-resolution models run at
+SR_SCALES = (2, 3, 4)
+
+# Accepted print resolutions; outside this a DPI is almost certainly a typo
+MIN_DPI, MAX_DPI = 50.0, 1200.0
+
+# Printed sizes, inches per unit
+UNITS = {'in': 1.0, '': 1.0, 'cm': 1 / 2.54, 'mm': 1 / 25.4}
+
+_PRINT_SIZE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*[x×]\s*(\d+(?:\.\d+)?)\s*(in|cm|mm)?\s*$', re.IGNORECASE)
+
+
+def parse_print_size(value: str) -> Tuple[float, float]:
+    """
+    Parse a print size such as '8x10', '8x10in' or '20x25cm'
+
+    Returns:
+        (width, height) in inches
+
+    Raises:
+        ValueError: If the size is malformed or not positive
+    """
+    match = _PRINT_SIZE.match(value or '')
+    if not match:
+        raise ValueError(f"Print size must look like '8x10', '8x10in' or '20x25cm', not '{value}'")
+    factor = UNITS[(match.group(3) or '').lower()]
+    width, height = float(match.group(1)) * factor, float(match.group(2)) * factor
+    if width <= 0 or height <= 0:
+        raise ValueError("Print size must be positive")
+    return width, height
+
+
+def check_dpi(dpi: float) -> float:
+    """Validate a print resolution; returns it unchanged"""
+    if not MIN_DPI <= dpi <= MAX_DPI:
+        raise ValueError(f"Print DPI must be between {MIN_DPI:g} and {MAX_DPI:g}")
+    return dpi
+
+
+class ResolutionPlan:
+    """The sizes one restoration runs at, and why they differ from the request"""
+
+    def __init__(self, input_size: Tuple[int, int], working_size: Tuple[int, int],
+                 sr_scale: Optional[int], output_size: Tuple[int, int],
+                 notes: List[str], print_size: Optional[Tuple[float, float]] = None,
+                 dpi: Optional[float] = None):
+        """
+        Args:
+            input_size: (width, height) of the decoded input
+            working_size: (width, height) the stages before super-resolution run at
+            sr_scale: Model scale super-resolution runs at; None when it is not needed
+            output_size: (width, height) of the result
+            notes: Adjustments made to the request, for the client
+            print_size: Requested print (width, height) in inches, if any
+            dpi: Print resolution the output size was computed for
+        """
+        self.input_size = input_size
+        self.working_size = working_size
+        self.sr_scale = sr_scale
+        self.output_size = output_size
+        self.notes = notes
+        self.print_size = print_size
+        self.dpi = dpi
+
+    @property
+    def working_pixels(self) -> int:
+        return self.working_size[0] * self.working_size[1]
+
+    @property
+    def resize(self) -> bool:
+        """Whether the result needs a final resize to land on output_size"""
+        scale = self.sr_scale or 1
+        upscaled = (self.working_size[0] * scale, self.working_size[1] * scale)
+        return upscaled != self.output_size or self.working_size != self.input_size
+
+    def summary(self) -> str:
+        """One-line description, e.g. for a response header"""
+        def size(value: Tuple[int, int]) -> str:
+            return f"{value[0]}x{value[1]}"
+        return (f"input={size(self.input_size)}; working={size(self.working_size)}; "
+                f"sr_scale={self.sr_scale or 'none'}; output={size(self.output_size)}")
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "input_size": list(self.input_size),
+            "working_size": list(self.working_size),
+            "sr_scale": self.sr_scale,
+            "output_size": list(self.output_size),
+            "print": {"size_in": [round(v, 2) for v in self.print_size], "dpi": self.dpi} if self.print_size else None,
+            "notes": self.notes
+        }
+
+
+class ResolutionPolicy:
+    """
+    Picks the working and output size of each restoration.
+
+    The output is the requested print size at its DPI, or the input times
+    `sr_scale`, capped at `max_output_pixels`. The model stages cost
+    roughly per pixel and super-resolution makes up for a smaller input,
+    so an input above `working_pixels` is downscaled while decoding to the
+    output size divided by the smallest model scale that fits that budget.
+    Super-resolution then runs once, at the smallest model scale that
+    reaches the output from the working size, and a final resize lands on
+    the output size exactly. Without upscaling, the stages run at the
+    output size.
+    """
+
+    def __init__(self, working_pixels: int = 4_000_000, max_output_pixels: int = 32_000_000,
+                 scales: Sequence[int] = SR_SCALES):
+        """
+        Args:
+            working_pixels: Pixel budget of the stages before super-resolution (0: no limit)
+            max_output_pixels: Largest output in pixels (0: no limit)
+            scales: Scales the super-resolution model supports
+        """
+        self.working_pixels = working_pixels
+        self.max_output_pixels = max_output_pixels
+        self.scales = tuple(sorted(scales))
+
+    @classmethod
+    def from_env(cls) -> "ResolutionPolicy":
+        """Build from PHOTO_WORKING_MEGAPIXELS (default 4) and PHOTO_MAX_OUTPUT_MEGAPIXELS (default 32)"""
+        return cls(
+            working_pixels=int(float(os.environ.get('PHOTO_WORKING_MEGAPIXELS', '4')) * 1_000_000),
+            max_output_pixels=int(float(os.environ.get('PHOTO_MAX_OUTPUT_MEGAPIXELS', '32')) * 1_000_000)
+        )
+
+    def settings(self) -> Dict[str, Any]:
+        """What the plans depend on besides the request, for cache keys"""
+        return {'working_pixels': self.working_pixels, 'max_output_pixels': self.max_output_pixels,
+                'scales': list(self.scales)}
+
+    def plan(self, size: Tuple[int, int], super_resolution: bool = True, sr_scale: int = 2,
+             print_size: Optional[str] = None, dpi: Optional[float] = None) -> ResolutionPlan:
+        """
+        Plan the sizes for an input of `size` (width, height)
+
+        Args:
+            super_resolution: Whether the request enables super-resolution
+            sr_scale: Requested upscaling, used when no print size is given
+            print_size: Print size the output should cover, e.g. '8x10' (see parse_print_size)
+            dpi: Print resolution (default 300)
+
+        Raises:
+            ValueError: For a malformed print size or an out-of-range DPI
+        """
+        width, height = size
+        pixels = width * height
+        notes = []
+        inches = None
+        if print_size:
+            dpi = check_dpi(dpi if dpi is not None else 300.0)
+            inches = parse_print_size(print_size)
+            # Match the print's orientation to the photo's
+            if (inches[0] >= inches[1]) != (width >= height):
+                inches = (inches[1], inches[0])
+            # Cover the whole print; the other side may come out longer
+            scale = max(inches[0] * dpi / width, inches[1] * dpi / height)
+        else:
+            dpi = None
+            scale = float(sr_scale) if super_resolution else 1.0
+
+        if scale > 1 and not super_resolution:
+            notes.append(f"Super-resolution is disabled, so the output stays at the input size "
+                         f"instead of {scale:.2f}x")
+            scale = 1.0
+        if scale > self.scales[-1]:
+            notes.append(f"Output limited to {self.scales[-1]}x the input ({scale:.2f}x requested)")
+            scale = float(self.scales[-1])
+        if self.max_output_pixels and pixels * scale * scale > self.max_output_pixels:
+            capped = math.sqrt(self.max_output_pixels / pixels)
+            notes.append(f"Output limited to {self.max_output_pixels / 1e6:g} MP "
+                         f"({pixels * scale * scale / 1e6:.1f} MP requested)")
+            scale = capped
+        output = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+        if scale <= 1:
+            # Nothing to gain from a larger working size than the output
+            if super_resolution:
+                notes.append("The input already covers the output size; super-resolution is skipped")
+            return ResolutionPlan(size, output, None, output, notes, inches, dpi)
+
+        if not self.working_pixels or pixels <= self.working_pixels:
+            working = size
+        else:
+            # Shrink to the output size divided by the smallest model scale
+            # that fits the budget, so that one pass lands on the output
+            sr = next((s for s in self.scales if output[0] * output[1] / (s * s) <= self.working_pixels),
+                      self.scales[-1])
+            working = (min(width, math.ceil(output[0] / sr)), min(height, math.ceil(output[1] / sr)))
+        needed = max(output[0] / working[0], output[1] / working[1])
+        sr = next((s for s in self.scales if s >= needed), self.scales[-1])
+        return ResolutionPlan(size, working, sr, output, notes, inches, dpi)
@@ -0,0 +1,345 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+
+def image_digest(image_bytes: bytes) -> str:
+    """Content hash of an uploaded image"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Content hash of an image file; equal to image_digest() of its bytes"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def array_digest(image: np.ndarray) -> str:
+    """Content hash of a decoded image"""
+    hasher = hashlib.sha256(str((image.shape, image.dtype.str)).encode('ascii'))
+    hasher.update(memoryview(np.ascontiguousarray(image)).cast('B'))
+    return hasher.hexdigest()
+
+
+def chain_key(parent: str, stage: str, params: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Derive the cache key of a stage output from the key of its input.
+
+    Keys form a chain (input -> stage 1 -> stage 2 ...), so two requests
+    that share a prefix of stages and parameters share those entries.
+    """
+    payload = json.dumps([parent, stage, params or {}], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class DiskIndex:
+    """
+    Sizes and last use of the disk tier's entries, in SQLite next to them.
+
+    Every API worker process on the host opens the same index, so they see
+    each other's entries and evict from one shared budget. The files
+    themselves remain the source of truth: an entry whose file has gone
+    is dropped when it is next read.
+    """
+
+    def __init__(self, directory: str, capacity: int):
+        """
+        Args:
+            directory: The disk tier's directory
+            capacity: Bytes the entries may take up in total
+        """
+        self.directory = directory
+        self.capacity = capacity
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(directory, 'index.sqlite3'),
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=30
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Losing the last few updates in a power cut only costs cache entries
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+        self._import_files()
+
+    def _import_files(self) -> None:
+        """Index files cached before the index existed, by modification time"""
+        with self._transaction():
+            if self._conn.execute("SELECT 1 FROM entries LIMIT 1").fetchone():
+                return
+            rows = []
+            for name in os.listdir(self.directory):
+                subdir = os.path.join(self.directory, name)
+                if len(name) != 2 or not os.path.isdir(subdir):
+                    continue
+                for key in os.listdir(subdir):
+                    if key.endswith('.tmp'):
+                        continue
+                    stat = os.stat(os.path.join(subdir, key))
+                    rows.append((key, stat.st_size, stat.st_mtime))
+            self._conn.executemany("INSERT OR IGNORE INTO entries (key, size, used) VALUES (?, ?, ?)", rows)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # Write lock up front, so concurrent evictions do not interleave
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def touch(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+
+    def add(self, key: str, size: int) -> List[str]:
+        """Record an entry; returns the keys evicted to make room, oldest first"""
+        evicted = []
+        with self._transaction():
+            self._conn.execute("INSERT OR REPLACE INTO entries (key, size, used) VALUES (?, ?, ?)",
+                               (key, size, time.time()))
+            used = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if used > self.capacity:
+                for old_key, old_size in self._conn.execute(
+                        "SELECT key, size FROM entries WHERE key != ? ORDER BY used", (key,)):
+                    evicted.append(old_key)
+                    used -= old_size
+                    if used <= self.capacity:
+                        break
+                self._conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in evicted])
+        return evicted
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def totals(self) -> Tuple[int, int]:
+        """(entries, bytes) across all workers"""
+        with self._lock:
+            count, used = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return count, used
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ResultCache:
+    """
+    Two-tier content-addressed cache for pipeline outputs.
+
+    - memory tier: LRU over decoded arrays and encoded bytes, capped in bytes
+    - disk tier: one file per entry, capped in bytes, least recently used
+      entries evicted; its DiskIndex is shared by every worker process
+      using the same directory, so they serve each other's results
+
+    Values are either bytes (final encoded images) or numpy arrays (stage
+    outputs). Cached arrays are shared, so callers must not modify them in
+    place. Arrays in memory-mapped buffers (see shared_images) are copied
+    on the way in, so an entry never keeps a buffer file mapped or aliases
+    memory a worker process may write to.
+    """
+
+    def __init__(self, memory_bytes: int = 256 * 1024 * 1024,
+                 disk_dir: Optional[str] = None,
+                 disk_bytes: int = 2 * 1024 * 1024 * 1024):
+        """
+        Args:
+            memory_bytes: Capacity of the in-memory tier (0 disables it)
+            disk_dir: Directory for the disk tier (None disables it)
+            disk_bytes: Capacity of the disk tier
+        """
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._memory_used = 0
+        self._hits = {"memory": 0, "disk": 0}
+        self._misses = 0
+
+        self._disk_index: Optional[DiskIndex] = None
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_index = DiskIndex(disk_dir, disk_bytes)
+
+    @classmethod
+    def from_env(cls) -> Optional["ResultCache"]:
+        """
+        Build the cache from PHOTO_CACHE, PHOTO_CACHE_MEMORY_MB,
+        PHOTO_CACHE_DIR and PHOTO_CACHE_DISK_MB; returns None when disabled
+        """
+        if os.environ.get('PHOTO_CACHE', '1') == '0':
+            return None
+        default_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cache')
+        disk_dir = os.environ.get('PHOTO_CACHE_DIR', default_dir) or None
+        return cls(
+            memory_bytes=int(os.environ.get('PHOTO_CACHE_MEMORY_MB', '256')) * 1024 * 1024,
+            disk_dir=disk_dir,
+            disk_bytes=int(os.environ.get('PHOTO_CACHE_DISK_MB', '2048')) * 1024 * 1024
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        """Look up an entry, promoting disk hits into memory"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._hits["memory"] += 1
+                return self._memory[key]
+
+        if self._disk_index is not None and self._disk_index.contains(key):
+            value = self._read_disk(key)
+            if value is not None:
+                with self._lock:
+                    self._hits["disk"] += 1
+                self._put_memory(key, value)
+                return value
+
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            if key in self._memory:
+                return True
+        return self._disk_index is not None and self._disk_index.contains(key)
+
+    def put(self, key: str, value: Any) -> None:
+        """Store bytes or a numpy array in both tiers"""
+        if not isinstance(value, (bytes, np.ndarray)):
+            raise TypeError(f"Unsupported cache value: {type(value).__name__}")
+        if isinstance(value, np.ndarray) and self._is_mapped(value):
+            value = np.array(value, copy=True)
+        self._put_memory(key, value)
+        if self.disk_dir:
+            try:
+                self._write_disk(key, value)
+            except OSError as e:
+                logger.warning(f"Could not write cache entry {key[:12]}: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Memory tier and hit counts of this worker; the disk tier is shared"""
+        disk_entries, disk_used = self._disk_index.totals() if self._disk_index is not None else (0, 0)
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "disk_entries": disk_entries,
+                "disk_bytes": disk_used,
+                "hits": dict(self._hits),
+                "misses": self._misses
+            }
+
+    def close(self) -> None:
+        if self._disk_index is not None:
+            self._disk_index.close()
+
+    @staticmethod
+    def _is_mapped(array: np.ndarray) -> bool:
+        base = array.base
+        while isinstance(base, np.ndarray):
+            base = base.base
+        return isinstance(base, mmap.mmap)
+
+    @staticmethod
+    def _sizeof(value: Any) -> int:
+        return value.nbytes if isinstance(value, np.ndarray) else len(value)
+
+    def _put_memory(self, key: str, value: Any) -> None:
+        size = self._sizeof(value)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_used -= self._sizeof(self._memory.pop(key))
+            self._memory[key] = value
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= self._sizeof(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _read_disk(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                kind = f.read(1)
+                data = f.read()
+        except OSError:
+            # Evicted by another worker since the index was read
+            self._disk_index.remove(key)
+            return None
+        self._disk_index.touch(key)
+
+        if kind == b'a':
+            return np.load(io.BytesIO(data), allow_pickle=False)
+        return data
+
+    def _write_disk(self, key: str, value: Any) -> None:
+        if isinstance(value, np.ndarray):
+            buffer = io.BytesIO()
+            np.save(buffer, value, allow_pickle=False)
+            kind, data = b'a', buffer.getvalue()
+        else:
+            kind, data = b'b', value
+
+        size = len(data) + 1
+        if size > self.disk_bytes:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique per writer: another thread or worker may store the same key
+        temp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(temp, 'wb') as f:
+                f.write(kind)
+                f.write(data)
+            os.replace(temp, path)
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+        for old_key in self._disk_index.add(key, size):
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
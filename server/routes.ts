@@ -1,30 +1,74 @@
-import type { Express } from "express";
+import type { Express, Request, Response, NextFunction } from "express";
 import { createServer, type Server } from "http";
 import { storage } from "./storage";
 import multer from "multer";
 import fetch from "node-fetch";
 import FormData from "form-data";
+import fs from "fs";
+import os from "os";
 
+const MAX_UPLOAD_MB = Number(process.env.PHOTO_MAX_UPLOAD_MB || 100);
+
+// Uploads are spooled to disk and streamed on to the Python API, so large
+// scans never sit in memory
 const upload = multer({ 
-  storage: multer.memoryStorage(),
-  limits: { fileSize: 10 * 1024 * 1024 }
+  storage: multer.diskStorage({ destination: os.tmpdir() }),
+  limits: { fileSize: MAX_UPLOAD_MB * 1024 * 1024 }
 });
 
+function singleUpload(field: string) {
+  const handler = upload.single(field);
+  return (req: Request, res: Response, next: NextFunction) => {
+    handler(req, res, (err: any) => {
+      if (err?.code === "LIMIT_FILE_SIZE") {
+        return res.status(413).json({ error: `File size must be less than ${MAX_UPLOAD_MB}MB` });
+      }
+      next(err);
+    });
+  };
+}
+
+function removeUpload(file?: Request["file"]) {
+  if (file) {
+    fs.unlink(file.path, () => {});
+  }
+}
+
 const PYTHON_API_URL = process.env.PYTHON_API_URL || "http://localhost:8000";
 
+// Server-Sent Events are piped through as they arrive: no timeout, headers
+// flushed at once, and the upstream request ends when the client goes away
+async function pipeEventStream(res: Response, url: string, init: Record<string, any> = {}) {
+  const controller = new AbortController();
+  res.on("close", () => controller.abort());
+
+  const response = await fetch(url, { ...init, signal: controller.signal });
+  res.status(response.status);
+  res.set("Content-Type", response.headers.get("content-type") || "text/event-stream");
+  res.set("Cache-Control", "no-cache");
+  res.set("X-Accel-Buffering", "no");
+  res.flushHeaders();
+  response.body.on("error", () => res.end());
+  response.body.pipe(res);
+}
+
 export async function registerRoutes(app: Express): Promise<Server> {
   
-  app.post("/api/restore", upload.single("file"), async (req, res) => {
+  app.post("/api/restore", singleUpload("file"), async (req, res) => {
     try {
       if (!req.file) {
         return res.status(400).json({ error: "No file uploaded" });
       }
 
       const formData = new FormData();
-      formData.append("file", req.file.buffer, {
+      formData.append("file", fs.createReadStream(req.file.path), {
         filename: req.file.originalname,
         contentType: req.file.mimetype,
+        knownLength: req.file.size,
       });
+      for (const [key, value] of Object.entries(req.body || {})) {
+        formData.append(key, String(value));
+      }
 
       const controller = new AbortController();
       const timeout = setTimeout(() => controller.abort(), 60000);
@@ -33,7 +77,7 @@ export async function registerRoutes(app: Express): Promise<Server> {
         const response = await fetch(`${PYTHON_API_URL}/api/restore`, {
           method: "POST",
           body: formData as any,
-          headers: formData.getHeaders(),
+          headers: { ...formData.getHeaders(), accept: req.headers.accept || "image/jpeg" },
           signal: controller.signal,
         });
 
@@ -48,10 +92,22 @@ export async function registerRoutes(app: Express): Promise<Server> {
           });
         }
 
-        const imageBuffer = await response.buffer();
-        res.set("Content-Type", "image/jpeg");
-        res.set("Content-Disposition", `attachment; filename="restored_${req.file.originalname}"`);
-        res.send(imageBuffer);
+        // The Python API picks the format from output_format or Accept
+        res.set("Content-Type", response.headers.get("content-type") || "image/jpeg");
+        res.set("Content-Disposition", response.headers.get("content-disposition") ||
+          `attachment; filename="restored_${req.file.originalname}"`);
+        res.set("Vary", "Accept");
+        const serverTiming = response.headers.get("server-timing");
+        if (serverTiming) {
+          res.set("Server-Timing", serverTiming);
+        }
+        for (const header of ["x-resolution", "x-resolution-notes"]) {
+          const value = response.headers.get(header);
+          if (value) {
+            res.set(header, value);
+          }
+        }
+        res.send(await response.buffer());
       } catch (fetchError: any) {
         clearTimeout(timeout);
         if (fetchError.name === 'AbortError') {
@@ -68,6 +124,144 @@ export async function registerRoutes(app: Express): Promise<Server> {
         error: "Failed to process image",
         message: error.message 
       });
+    } finally {
+      removeUpload(req.file);
+    }
+  });
+
+  // Albums can be far larger than the single-image limit, so the request
+  // and the streamed response are piped through without buffering
+  app.post("/api/restore/batch", async (req, res) => {
+    try {
+      const response = await fetch(`${PYTHON_API_URL}/api/restore/batch`, {
+        method: "POST",
+        body: req as any,
+        headers: { "content-type": req.headers["content-type"] || "" },
+      });
+
+      res.status(response.status);
+      res.set("Content-Type", response.headers.get("content-type") || "application/octet-stream");
+      const disposition = response.headers.get("content-disposition");
+      if (disposition) {
+        res.set("Content-Disposition", disposition);
+      }
+      response.body.pipe(res);
+    } catch (error: any) {
+      if (error.code === 'ECONNREFUSED') {
+        return res.status(503).json({ error: "AI service unavailable - please ensure Python API is running" });
+      }
+      console.error("Error processing batch:", error);
+      res.status(500).json({ error: "Failed to process batch", message: error.message });
+    }
+  });
+
+  // Progressive restoration: a job with a preview, answered with its event stream
+  app.post("/api/restore/stream", async (req, res) => {
+    try {
+      await pipeEventStream(res, `${PYTHON_API_URL}/api/restore/stream`, {
+        method: "POST",
+        body: req as any,
+        headers: { "content-type": req.headers["content-type"] || "" },
+      });
+    } catch (error: any) {
+      if (res.headersSent) {
+        return res.end();
+      }
+      if (error.code === 'ECONNREFUSED') {
+        return res.status(503).json({ error: "AI service unavailable - please ensure Python API is running" });
+      }
+      console.error("Error streaming restoration:", error);
+      res.status(500).json({ error: "Failed to stream restoration", message: error.message });
+    }
+  });
+
+  app.post("/api/jobs", singleUpload("file"), async (req, res) => {
+    try {
+      if (!req.file) {
+        return res.status(400).json({ error: "No file uploaded" });
+      }
+
+      const formData = new FormData();
+      formData.append("file", fs.createReadStream(req.file.path), {
+        filename: req.file.originalname,
+        contentType: req.file.mimetype,
+        knownLength: req.file.size,
+      });
+      for (const [key, value] of Object.entries(req.body || {})) {
+        formData.append(key, String(value));
+      }
+
+      const response = await fetch(`${PYTHON_API_URL}/api/jobs`, {
+        method: "POST",
+        body: formData as any,
+        headers: formData.getHeaders(),
+      });
+
+      res.status(response.status).json(await response.json());
+    } catch (error: any) {
+      if (error.code === 'ECONNREFUSED') {
+        return res.status(503).json({ error: "AI service unavailable - please ensure Python API is running" });
+      }
+      console.error("Error creating job:", error);
+      res.status(500).json({ error: "Failed to create job", message: error.message });
+    } finally {
+      removeUpload(req.file);
+    }
+  });
+
+  app.get("/api/jobs/:id", async (req, res) => {
+    try {
+      const response = await fetch(`${PYTHON_API_URL}/api/jobs/${encodeURIComponent(req.params.id)}`);
+      res.status(response.status).json(await response.json());
+    } catch (error: any) {
+      console.error("Error fetching job:", error);
+      res.status(503).json({ error: "AI service unavailable", message: error.message });
+    }
+  });
+
+  app.get("/api/jobs/:id/events", async (req, res) => {
+    try {
+      await pipeEventStream(res, `${PYTHON_API_URL}/api/jobs/${encodeURIComponent(req.params.id)}/events`);
+    } catch (error: any) {
+      if (res.headersSent) {
+        return res.end();
+      }
+      console.error("Error streaming job events:", error);
+      res.status(503).json({ error: "AI service unavailable", message: error.message });
+    }
+  });
+
+  app.get("/api/jobs/:id/preview", async (req, res) => {
+    try {
+      const response = await fetch(`${PYTHON_API_URL}/api/jobs/${encodeURIComponent(req.params.id)}/preview`);
+      if (!response.ok) {
+        return res.status(response.status).json(await response.json());
+      }
+
+      res.set("Content-Type", response.headers.get("content-type") || "image/jpeg");
+      response.body.pipe(res);
+    } catch (error: any) {
+      console.error("Error fetching job preview:", error);
+      res.status(503).json({ error: "AI service unavailable", message: error.message });
+    }
+  });
+
+  app.get("/api/jobs/:id/result", async (req, res) => {
+    try {
+      const response = await fetch(`${PYTHON_API_URL}/api/jobs/${encodeURIComponent(req.params.id)}/result`);
+      if (!response.ok) {
+        return res.status(response.status).json(await response.json());
+      }
+
+      res.set("Content-Type", response.headers.get("content-type") || "image/jpeg");
+      const disposition = response.headers.get("content-disposition");
+      if (disposition) {
+        res.set("Content-Disposition", disposition);
+      }
+      response.body.pipe(res);
+    } catch (error: any) {
+      console.error("Error fetching job result:", error);
+      res.status(503).json({ error: "AI service unavailable", message: error.message });
     }
   });
 
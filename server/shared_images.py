@@ -0,0 +1,349 @@
+from __future__ import annotations
+
+import atexit
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import uuid
+import weakref
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'photo-img-'
+
+
+def _default_dir() -> str:
+    # tmpfs: mapped files live in RAM and never touch a disk
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _new_path(directory: str, owner: int) -> str:
+    return os.path.join(directory, f"{PREFIX}{owner}-{uuid.uuid4().hex}")
+
+
+def _map(path: str, nbytes: int, grow: bool = False) -> mmap.mmap:
+    """Map the first `nbytes` of a buffer file, growing the file first if asked"""
+    fd = os.open(path, os.O_RDWR)
+    try:
+        if grow and os.fstat(fd).st_size < nbytes:
+            os.ftruncate(fd, nbytes)
+        return mmap.mmap(fd, max(nbytes, 1))
+    finally:
+        os.close(fd)
+
+
+class SharedArray:
+    """
+    Picklable handle to an array in a buffer file.
+
+    Crossing to a worker process costs a path and a shape rather than the
+    pixels; the other side maps the same file and reads it in place.
+    """
+
+    __slots__ = ('path', 'shape', 'dtype', 'owned')
+
+    def __init__(self, path: str, shape: Tuple[int, ...], dtype: str, owned: bool = False):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        # Set on worker results: the file is handed over to the parent
+        self.owned = owned
+
+    def __getstate__(self):
+        return self.path, self.shape, self.dtype, self.owned
+
+    def __setstate__(self, state) -> None:
+        self.path, self.shape, self.dtype, self.owned = state
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape, dtype=np.int64)) * np.dtype(self.dtype).itemsize
+
+    def attach(self) -> np.ndarray:
+        """A writable view of the array; the mapping lives as long as the view"""
+        return np.ndarray(self.shape, np.dtype(self.dtype), buffer=_map(self.path, self.nbytes))
+
+
+def _view_of(array: np.ndarray) -> Optional[mmap.mmap]:
+    """The buffer-file mapping a C-contiguous array covers exactly, if any"""
+    base = array.base
+    if (isinstance(base, mmap.mmap) and array.flags.c_contiguous
+            and array.nbytes == len(base) and array.ctypes.data == np.frombuffer(base, np.uint8).ctypes.data):
+        return base
+    return None
+
+
+def _export(value: Any, spare: Optional[str], inputs: Dict[int, SharedArray],
+            owner: int, directory: str, min_bytes: int) -> Tuple[Any, bool]:
+    """Worker side: turn a large result array into a handle; returns (value, spare used)"""
+    if not isinstance(value, np.ndarray) or value.nbytes < min_bytes or value.dtype.hasobject:
+        return value, False
+    passthrough = inputs.get(id(value))
+    if passthrough is not None:
+        return passthrough, False
+    path = spare or _new_path(directory, owner)
+    if spare is None:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600))
+    try:
+        handle = SharedArray(path, value.shape, value.dtype.str, owned=True)
+        target = np.ndarray(value.shape, value.dtype, buffer=_map(path, handle.nbytes, grow=True))
+        np.copyto(target, value)
+        del target
+    except BaseException:
+        if spare is None:
+            os.unlink(path)
+        raise
+    return handle, spare is not None
+
+
+def _run_shared(fn: Callable, args: tuple, kwargs: Dict[str, Any], spare: Optional[str],
+                owner: int, directory: str, min_bytes: int) -> Tuple[Any, bool]:
+    """
+    Worker side of SharedImages.call: map the input handles, run `fn`, and
+    write a large result (or each large item of a result tuple) to a buffer
+    file, the spare one first
+    """
+    inputs: Dict[int, SharedArray] = {}
+    resolved = []
+    for arg in args:
+        if isinstance(arg, SharedArray):
+            array = arg.attach()
+            inputs[id(array)] = arg
+            resolved.append(array)
+        else:
+            resolved.append(arg)
+    result = fn(*resolved, **kwargs)
+
+    used = False
+    if isinstance(result, tuple):
+        items = []
+        for item in result:
+            item, took = _export(item, None if used else spare, inputs, owner, directory, min_bytes)
+            used = used or took
+            items.append(item)
+        return tuple(items), used
+    return _export(result, spare, inputs, owner, directory, min_bytes)
+
+
+class SharedImages:
+    """
+    Image buffers shared with CPU worker processes.
+
+    Arrays live in memory-mapped files on tmpfs. Handing one to a worker
+    process sends a SharedArray handle rather than pickled pixels, and the
+    worker writes its result into a pooled file the parent then maps, so a
+    chain of CPU stages moves each image through memory once:
+    - empty() allocates an image buffer (e.g. for decoding into)
+    - call() runs a function on a process pool with its array arguments
+      and results passed as handles; arrays not yet in a buffer file are
+      copied into one
+    Lifetime follows the arrays: when the last view of a buffer is gone its
+    file goes back to a free pool (up to `pool_bytes`) or is deleted. Files
+    left by a process that died are removed on startup.
+    """
+
+    def __init__(self, directory: Optional[str] = None, pool_bytes: int = 512 << 20,
+                 min_bytes: int = 1 << 20):
+        """
+        Args:
+            directory: Where buffer files live (defaults to /dev/shm)
+            pool_bytes: Free buffer files kept for reuse, in bytes
+            min_bytes: Smaller arrays are simply pickled
+        """
+        self.directory = directory or _default_dir()
+        self.pool_bytes = pool_bytes
+        self.min_bytes = min_bytes
+        self.owner = os.getpid()
+
+        # Re-entrant: a buffer can be released by garbage collection while the lock is held
+        self._lock = threading.RLock()
+        self._free: List[Tuple[int, str]] = []
+        self._free_bytes = 0
+        self._live = 0
+        self._live_bytes = 0
+        # Buffer file of each live mapping, by id() of the mmap
+        self._paths: Dict[int, str] = {}
+        self._closed = False
+        self.totals = {"allocated": 0, "reused": 0, "shared": 0, "copied": 0, "released": 0}
+        self._sweep()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls) -> Optional["SharedImages"]:
+        """Build from PHOTO_SHM_DIR and PHOTO_SHM_POOL_MB; None when PHOTO_SHARED_IMAGES=0"""
+        if os.environ.get('PHOTO_SHARED_IMAGES', '1') == '0':
+            return None
+        return cls(
+            directory=os.environ.get('PHOTO_SHM_DIR') or None,
+            pool_bytes=int(float(os.environ.get('PHOTO_SHM_POOL_MB', '512')) * (1 << 20))
+        )
+
+    def _sweep(self) -> None:
+        """Delete buffer files whose owning process no longer exists"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.startswith(PREFIX):
+                continue
+            owner = name[len(PREFIX):].split('-', 1)[0]
+            if not owner.isdigit() or int(owner) == self.owner:
+                continue
+            try:
+                os.kill(int(owner), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except OSError:
+                continue
+            try:
+                os.unlink(os.path.join(self.directory, name))
+                logger.info(f"Removed stale image buffer {name}")
+            except OSError:
+                pass
+
+    def _take_free(self, nbytes: Optional[int] = None) -> Optional[str]:
+        # The smallest free file that fits, else the largest one (it is grown)
+        with self._lock:
+            if not self._free:
+                return None
+            fitting = [entry for entry in self._free if nbytes is not None and entry[0] >= nbytes]
+            entry = min(fitting) if fitting else max(self._free)
+            self._free.remove(entry)
+            self._free_bytes -= entry[0]
+            self.totals["reused"] += 1
+            return entry[1]
+
+    def _give_back(self, path: str) -> None:
+        """Return an unmapped file to the free pool, or delete it"""
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return
+        with self._lock:
+            if not self._closed and self._free_bytes + size <= self.pool_bytes:
+                self._free.append((size, path))
+                self._free_bytes += size
+                return
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _release(self, key: int, path: str, nbytes: int) -> None:
+        with self._lock:
+            self._paths.pop(key, None)
+            self._live -= 1
+            self._live_bytes -= nbytes
+            self.totals["released"] += 1
+        self._give_back(path)
+
+    def _track(self, handle: SharedArray) -> np.ndarray:
+        mapping = _map(handle.path, handle.nbytes, grow=True)
+        array = np.ndarray(handle.shape, np.dtype(handle.dtype), buffer=mapping)
+        with self._lock:
+            self._paths[id(mapping)] = handle.path
+            self._live += 1
+            self._live_bytes += handle.nbytes
+        weakref.finalize(mapping, self._release, id(mapping), handle.path, handle.nbytes)
+        return array
+
+    def empty(self, shape: Tuple[int, ...], dtype: Any = 'uint8') -> np.ndarray:
+        """An uninitialised array in a buffer file, freed with its last view"""
+        handle = SharedArray('', shape, np.dtype(dtype).str)
+        path = self._take_free(handle.nbytes)
+        if path is None:
+            path = _new_path(self.directory, self.owner)
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600))
+            with self._lock:
+                self.totals["allocated"] += 1
+        handle.path = path
+        return self._track(handle)
+
+    def _adopt(self, value: Any, arguments: Dict[str, np.ndarray], spare: Optional[str]) -> Any:
+        """Map result handles (or the handles in a result tuple) as tracked arrays"""
+        if isinstance(value, tuple):
+            return tuple(self._adopt(item, arguments, spare) for item in value)
+        if not isinstance(value, SharedArray):
+            return value
+        if not value.owned:
+            # The function returned its input: hand back the caller's array
+            return arguments[value.path]
+        if value.path != spare:
+            with self._lock:
+                self.totals["allocated"] += 1
+        return self._track(value)
+
+    def call(self, submit: Callable, fn: Callable, args: tuple, kwargs: Dict[str, Any]) -> Any:
+        """
+        Run fn(*args, **kwargs) through `submit` (e.g. a process pool's
+        submit) with large array arguments and results passed as handles
+
+        Raises:
+            Exception: Whatever `fn` raised
+        """
+        # Shared copies of the arguments stay mapped until the call is over
+        arguments: Dict[str, np.ndarray] = {}
+        handles = []
+        for arg in args:
+            if isinstance(arg, np.ndarray) and arg.nbytes >= self.min_bytes and not arg.dtype.hasobject:
+                handle, shared = self._handle(arg)
+                arguments[handle.path] = shared
+                handles.append(handle)
+            else:
+                handles.append(arg)
+        spare = self._take_free()
+        used = False
+        try:
+            result, used = submit(_run_shared, fn, tuple(handles), kwargs, spare,
+                                  self.owner, self.directory, self.min_bytes).result()
+            return self._adopt(result, arguments, spare)
+        finally:
+            if spare is not None and not used:
+                self._give_back(spare)
+
+    def _handle(self, array: np.ndarray) -> Tuple[SharedArray, np.ndarray]:
+        """A handle to `array` and the shared array it refers to, copied in unless it already is one"""
+        mapping = _view_of(array)
+        with self._lock:
+            path = self._paths.get(id(mapping)) if mapping is not None else None
+            if path is not None:
+                self.totals["shared"] += 1
+                return SharedArray(path, array.shape, array.dtype.str), array
+        shared = self.empty(array.shape, array.dtype)
+        np.copyto(shared, array)
+        with self._lock:
+            self.totals["copied"] += 1
+            path = self._paths[id(shared.base)]
+        return SharedArray(path, array.shape, array.dtype.str), shared
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "live": self._live,
+                "live_mb": round(self._live_bytes / (1 << 20), 1),
+                "pooled": len(self._free),
+                "pooled_mb": round(self._free_bytes / (1 << 20), 1),
+                **self.totals
+            }
+
+    def close(self) -> None:
+        """Delete the pooled files; live buffers are deleted as they are released"""
+        with self._lock:
+            self._closed = True
+            free, self._free = self._free, []
+            self._free_bytes = 0
+        for _, path in free:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
@@ -0,0 +1,157 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Cancelled(Exception):
+    """Raised when every caller waiting for a computation has gone away"""
+
+
+class Flight:
+    """
+    One in-flight computation and the callers waiting for it.
+
+    Each caller brings an optional cancel event, set when it stops waiting
+    (e.g. its client disconnected); a caller without one waits until the
+    end. The computation polls abandoned() between steps and stops once
+    nobody is left. Events published by the computation are replayed to
+    callers that join late, so every caller sees the full progress.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._tokens: List[Optional[threading.Event]] = []
+        self._listeners: List[Callable[..., None]] = []
+        self._history: List[tuple] = []
+
+    @property
+    def waiters(self) -> int:
+        with self._lock:
+            return sum(1 for token in self._tokens if token is None or not token.is_set())
+
+    def abandoned(self) -> bool:
+        """True once every caller has cancelled"""
+        return self.waiters == 0
+
+    def publish(self, *event: Any) -> None:
+        """Pass an event to every caller's listener"""
+        with self._lock:
+            self._history.append(event)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(*event)
+            except Exception as e:
+                logger.warning(f"Listener of {self.key[:12]} failed: {str(e)}")
+
+    def _join(self, cancel: Optional[threading.Event], listener: Optional[Callable[..., None]]) -> None:
+        with self._lock:
+            self._tokens.append(cancel)
+            history = list(self._history)
+            if listener is not None:
+                self._listeners.append(listener)
+        if listener is not None:
+            for event in history:
+                listener(*event)
+
+    def _leave(self, cancel: Optional[threading.Event], listener: Optional[Callable[..., None]]) -> None:
+        with self._lock:
+            if cancel in self._tokens:
+                self._tokens.remove(cancel)
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+
+class SingleFlight:
+    """
+    Deduplicates identical concurrent computations.
+
+    The first caller for a key runs the computation in its own thread;
+    callers arriving while it runs wait for it and get the same result (or
+    exception). Nothing is remembered once it finishes: that is what the
+    result cache is for.
+    """
+
+    def __init__(self, poll_interval: float = 0.25):
+        """
+        Args:
+            poll_interval: Seconds between checks of a waiting caller's cancel event
+        """
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._flights: Dict[str, Flight] = {}
+        self.led = 0
+        self.joined = 0
+        self.abandoned = 0
+
+    def do(self, key: str, fn: Callable[[Flight], Any],
+           cancel: Optional[threading.Event] = None,
+           listener: Optional[Callable[..., None]] = None) -> Any:
+        """
+        Run fn(flight) once for all concurrent callers with the same key
+
+        Args:
+            key: Identity of the computation
+            fn: The computation; it should raise Cancelled when
+                flight.abandoned() turns true between its steps
+            cancel: Set by the caller when it stops waiting
+            listener: Receives the events fn publishes on the flight
+
+        Raises:
+            Cancelled: If `cancel` was set before the result was ready
+        """
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = Flight(key)
+                    self._flights[key] = flight
+                    self.led += 1
+                else:
+                    self.joined += 1
+                flight._join(cancel, listener)
+
+            if leader:
+                return self._lead(flight, fn)
+
+            while not flight.done.wait(self.poll_interval):
+                if cancel is not None and cancel.is_set():
+                    flight._leave(cancel, listener)
+                    raise Cancelled(f"Stopped waiting for {key[:12]}")
+            if isinstance(flight.error, Cancelled) and not (cancel is not None and cancel.is_set()):
+                # Joined just as the last other caller left; start over
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+    def _lead(self, flight: Flight, fn: Callable[[Flight], Any]) -> Any:
+        try:
+            flight.result = fn(flight)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            if isinstance(e, Cancelled):
+                with self._lock:
+                    self.abandoned += 1
+            raise
+        finally:
+            with self._lock:
+                del self._flights[flight.key]
+            flight.done.set()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "led": self.led,
+                "joined": self.joined,
+                "abandoned": self.abandoned
+            }
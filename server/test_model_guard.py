@@ -0,0 +1,22 @@
+import pytest
+
+from model_guard import CLOSED, HALF_OPEN, ModelGuard, ModelThrottled
+from model_slots import ModelSlots
+
+
+def test_throttled_trial_does_not_block_the_breaker(tmp_path):
+    slots = ModelSlots({'swinir': 1}, directory=str(tmp_path), wait=0.05)
+    guard = ModelGuard(timeout=5, failure_threshold=1, reset_timeout=0, slots=slots)
+    breaker = guard.breaker('replicate', 'swinir')
+    breaker.record_failure('upstream error')
+    try:
+        held = slots.acquire('swinir')
+        with pytest.raises(ModelThrottled):
+            guard.call('replicate', 'swinir', lambda: 'upscaled')
+        held.release()
+
+        assert breaker.state == HALF_OPEN
+        assert guard.call('replicate', 'swinir', lambda: 'upscaled') == 'upscaled'
+        assert breaker.state == CLOSED
+    finally:
+        guard.close()
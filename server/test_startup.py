@@ -0,0 +1,14 @@
+from benchmark import LAZY_LIBRARIES, import_times
+
+# Generous next to the ~0.6s a cold import takes, so slower machines pass;
+# eager imports are caught by name rather than by time
+BUDGET_MS = 3000
+
+
+def test_api_import_is_light():
+    runs = [import_times('photo_api') for _ in range(3)]
+    best = min(runs, key=lambda entries: entries[-1][1])
+
+    loaded = sorted({name.split('.')[0] for _, _, name in best} & set(LAZY_LIBRARIES))
+    assert not loaded, f"{', '.join(loaded)} should only load when first used"
+    assert best[-1][1] / 1000 <= BUDGET_MS
@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+import pytest
+
+from photo_processor import AIPhotoProcessor
+from tiling import TileEngine
+
+WHOLE_FRAME = TileEngine(tile_size=100_000, overlap=16, workers=1)
+TILED = TileEngine(tile_size=256, overlap=16, workers=4)
+
+
+def scan(height: int = 700, width: int = 900) -> np.ndarray:
+    """A noisy colour photo with scratches and dust, several tiles in each direction"""
+    rng = np.random.RandomState(7)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    base = base.astype(np.float32) + 40 * (np.sin(x / 23.0) * np.cos(y / 17.0))[..., None]
+    image = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    for _ in range(6):
+        cv2.line(image, (rng.randint(width), 0), (rng.randint(width), height - 1), (235, 235, 235), 1)
+    for _ in range(80):
+        cv2.circle(image, (rng.randint(width), rng.randint(height)), 1, (15, 15, 15), -1)
+    return image
+
+
+@pytest.fixture(scope='module')
+def processor():
+    processor = AIPhotoProcessor()
+    yield processor
+    processor.close()
+
+
+def run(processor: AIPhotoProcessor, tiles: TileEngine, stage: str, *args) -> np.ndarray:
+    processor.tiles = tiles
+    return getattr(processor, stage)(scan(), *args).astype(np.int16)
+
+
+def test_tiled_upscaling_matches_the_whole_frame(processor):
+    diff = np.abs(run(processor, TILED, '_fallback_super_resolution', 2)
+                  - run(processor, WHOLE_FRAME, '_fallback_super_resolution', 2))
+    assert diff.max() <= 3
+
+
+def test_tiled_inpainting_matches_the_whole_frame(processor):
+    diff = np.abs(run(processor, TILED, '_apply_basic_inpainting')
+                  - run(processor, WHOLE_FRAME, '_apply_basic_inpainting'))
+    assert diff.mean() <= 0.01
+    assert (diff > 2).mean() <= 0.001
+
+
+@pytest.mark.parametrize('shape', [(333, 517, 3), (70, 1030), (1030, 64, 3)])
+@pytest.mark.parametrize('overlap', [0, 7, 16])
+@pytest.mark.parametrize('scale', [1, 3])
+def test_pointwise_operations_are_exact(shape, overlap, scale):
+    # Last tiles narrower than the overlap included
+    image = np.random.RandomState(0).randint(0, 256, shape, dtype=np.uint8)
+    upscaled = TileEngine(tile_size=64, overlap=overlap, workers=3).map(
+        image, lambda tile: tile.repeat(scale, axis=0).repeat(scale, axis=1), scale=scale
+    )
+    assert np.array_equal(upscaled, image.repeat(scale, axis=0).repeat(scale, axis=1))
@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+Tile = Tuple[int, int, int, int]
+
+
+class TileEngine:
+    """
+    Runs image operations tile by tile across several cores.
+
+    Each tile is processed together with a margin of `overlap` pixels so
+    neighbourhood operations see the same context they would on the full
+    frame. Tiles are written back in raster order and the overlap bands
+    are feather-blended into the tiles already written, so seams vanish
+    even for operations that are not strictly local. OpenCV releases the
+    GIL, so a thread pool is enough to keep every core busy, and only a
+    bounded number of tiles are in flight at any time.
+    """
+
+    def __init__(self, tile_size: int = 1024, overlap: int = 16, workers: Optional[int] = None):
+        """
+        Args:
+            tile_size: Edge length of a tile in input pixels (before the margin)
+            overlap: Margin added around each tile and blended between tiles
+            workers: Number of tiles processed in parallel (defaults to CPU count)
+        """
+        self.tile_size = max(16, tile_size)
+        self.overlap = max(0, overlap)
+        self.workers = max(1, workers or os.cpu_count() or 1)
+
+    @classmethod
+    def from_env(cls) -> "TileEngine":
+        """Build from PHOTO_TILE_SIZE, PHOTO_TILE_OVERLAP and PHOTO_TILE_WORKERS"""
+        workers = os.environ.get('PHOTO_TILE_WORKERS')
+        return cls(
+            tile_size=int(os.environ.get('PHOTO_TILE_SIZE', '1024')),
+            overlap=int(os.environ.get('PHOTO_TILE_OVERLAP', '16')),
+            workers=int(workers) if workers else None
+        )
+
+    def grid(self, height: int, width: int) -> List[Tile]:
+        """Non-overlapping tiles (y0, y1, x0, x1) covering the image in raster order"""
+        return [
+            (y, min(y + self.tile_size, height), x, min(x + self.tile_size, width))
+            for y in range(0, height, self.tile_size)
+            for x in range(0, width, self.tile_size)
+        ]
+
+    def _expand(self, tile: Tile, height: int, width: int) -> Tile:
+        y0, y1, x0, x1 = tile
+        return (max(0, y0 - self.overlap), min(height, y1 + self.overlap),
+                max(0, x0 - self.overlap), min(width, x1 + self.overlap))
+
+    def _run(self, jobs: List, fn: Callable) -> Iterator:
+        """Apply fn to jobs in parallel, yielding results in order with a bounded window"""
+        if self.workers == 1 or len(jobs) == 1:
+            for job in jobs:
+                yield fn(job)
+            return
+
+        window = self.workers * 2
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='photo-tile') as executor:
+            pending = deque()
+            for job in jobs:
+                pending.append(executor.submit(fn, job))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def map(self, image: np.ndarray, fn: Callable[..., np.ndarray],
+            scale: int = 1, out: Optional[np.ndarray] = None,
+            aux: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Apply a neighbourhood operation tile by tile
+
+        Args:
+            image: Input image (H x W or H x W x C)
+            fn: Operation applied to each tile plus margin; must return an
+                array `scale` times larger in both dimensions
+            scale: Integer output/input size ratio
+            out: Optional preallocated output array
+            aux: Optional array with the same height and width (e.g. a
+                precomputed gray plane); fn is then called as fn(tile, aux_tile)
+
+        Returns:
+            Output image of shape (H * scale, W * scale, ...)
+        """
+        height, width = image.shape[:2]
+        tiles = self.grid(height, width)
+
+        def process(tile: Tile) -> np.ndarray:
+            ey0, ey1, ex0, ex1 = self._expand(tile, height, width)
+            if aux is not None:
+                return fn(image[ey0:ey1, ex0:ex1], aux[ey0:ey1, ex0:ex1])
+            return fn(image[ey0:ey1, ex0:ex1])
+
+        for tile, result in zip(tiles, self._run(tiles, process)):
+            if out is None:
+                out = np.empty((height * scale, width * scale) + result.shape[2:], dtype=result.dtype)
+            self._blend(out, tile, self._expand(tile, height, width), result, scale)
+
+        return out
+
+    def _blend(self, out: np.ndarray, tile: Tile, expanded: Tile,
+               result: np.ndarray, scale: int) -> None:
+        y0, y1, x0, x1 = tile
+        ey0, ey1, ex0, ex1 = (v * scale for v in expanded)
+        # The outer ends of the bottom and right margins lack context; the
+        # next tiles' ramps never read them, so they are not written at all
+        ey1 = min(ey1, self._read_until(y1, out.shape[0] // scale, scale))
+        ex1 = min(ex1, self._read_until(x1, out.shape[1] // scale, scale))
+        result = result[:ey1 - ey0, :ex1 - ex0]
+        target = out[ey0:ey1, ex0:ex1]
+
+        # Bands above and to the left were written by earlier tiles; ramp
+        # from their values to this tile's across the middle of the band
+        top = (y0 * scale - ey0) * 2 if ey0 > 0 else 0
+        left = (x0 * scale - ex0) * 2 if ex0 > 0 else 0
+        if top == 0 and left == 0:
+            target[...] = result
+            return
+
+        # A last row or column of tiles can be narrower than the band
+        band_h = min(top, target.shape[0])
+        band_w = min(left, target.shape[1])
+        weight = np.ones(target.shape[:2], dtype=np.float32)
+        if top:
+            weight[:band_h] = np.minimum(weight[:band_h], self._ramp(top)[:band_h, None])
+        if left:
+            weight[:, :band_w] = np.minimum(weight[:, :band_w], self._ramp(left)[None, :band_w])
+
+        if result.ndim == 3:
+            weight = weight[:, :, None]
+
+        # Only the bands need floating point; the rest is copied as is
+        if band_h:
+            self._mix(target[:band_h], result[:band_h], weight[:band_h])
+        if band_w:
+            self._mix(target[band_h:, :band_w], result[band_h:, :band_w], weight[band_h:, :band_w])
+        target[band_h:, band_w:] = result[band_h:, band_w:]
+
+    def _read_until(self, end: int, size: int, scale: int) -> int:
+        """Output coordinate where the ramp of the tile starting at `end` stops reading the one before"""
+        if end >= size:
+            return size * scale
+        start = max(0, end - self.overlap) * scale
+        length = (end * scale - start) * 2
+        return start + length - length // 4
+
+    @staticmethod
+    def _ramp(length: int) -> np.ndarray:
+        """
+        Weights of this tile across a shared band of `length` pixels.
+
+        The outer quarter on each side is where one of the two tiles ran
+        out of context, so the ramp spans the middle half only.
+        """
+        margin = length // 4
+        ramp = np.zeros(length, dtype=np.float32)
+        ramp[length - margin:] = 1.0
+        middle = length - 2 * margin
+        ramp[margin:length - margin] = (np.arange(middle, dtype=np.float32) + 0.5) / middle
+        return ramp
+
+    @staticmethod
+    def _mix(target: np.ndarray, result: np.ndarray, weight: np.ndarray) -> None:
+        mixed = target.astype(np.float32) * (1.0 - weight) + result.astype(np.float32) * weight
+        if np.issubdtype(target.dtype, np.integer):
+            info = np.iinfo(target.dtype)
+            np.clip(np.rint(mixed, out=mixed), info.min, info.max, out=mixed)
+        target[...] = mixed.astype(target.dtype)
+
+    def map_rows(self, image: np.ndarray, fn: Callable[[np.ndarray], np.ndarray],
+                 out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Apply a per-pixel operation (no neighbourhood) in parallel row bands
+
+        `out` may be `image` itself for an in-place update.
+        """
+        height = image.shape[0]
+        bands = [(y, min(y + self.tile_size, height)) for y in range(0, height, self.tile_size)]
+
+        def process(band: Tuple[int, int]) -> np.ndarray:
+            return fn(image[band[0]:band[1]])
+
+        for (y0, y1), result in zip(bands, self._run(bands, process)):
+            if out is None:
+                out = np.empty((height,) + result.shape[1:], dtype=result.dtype)
+            out[y0:y1] = result
+        return out
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+# Tint curves as (a_slope, b_slope, a_tint, b_tint, gamma): the LAB a/b of
+# a pixel with lightness L are 128 + (L - 128) * slope, plus tint * (L / 255) ** gamma
+PROFILES = {
+    'sepia': (0.15, 0.12, 20.0, 15.0, 0.8),
+    'warm': (0.10, 0.15, 14.0, 26.0, 0.7),
+    'cool': (0.04, -0.06, -6.0, -20.0, 0.9),
+}
+DEFAULT_PROFILE = 'sepia'
+REFERENCE = 'reference'
+
+# Reference photos are sampled at about this many pixels
+REFERENCE_PIXELS = 1_000_000
+# Lightness bins with fewer reference pixels than this are interpolated
+MIN_BIN_PIXELS = 16
+SMOOTHING = 9
+
+
+def _curve(levels: np.ndarray, slope: float, tint: float, gamma: float) -> np.ndarray:
+    # Same operations, in the same order, as the original per-pixel fallback,
+    # so the sepia table reproduces its output exactly
+    channel = np.clip(128 + (levels.astype(float) - 128) * slope, 0, 255).astype(np.uint8)
+    factor = (levels / 255.0) ** gamma
+    return np.clip(channel + factor * tint, 0, 255).astype(np.uint8)
+
+
+def profile_curves(profile: str) -> Tuple[np.ndarray, np.ndarray]:
+    """a and b channels for each lightness 0-255 under a built-in profile"""
+    a_slope, b_slope, a_tint, b_tint, gamma = PROFILES[profile]
+    levels = np.arange(256, dtype=np.uint8)
+    return _curve(levels, a_slope, a_tint, gamma), _curve(levels, b_slope, b_tint, gamma)
+
+
+def learn_curves(reference: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Average a and b per lightness of a color reference photo
+
+    Args:
+        reference: RGB uint8 image whose toning should be reproduced
+
+    Returns:
+        (a, b) tables of 256 uint8 entries, interpolated across lightness
+        values the reference hardly uses and lightly smoothed
+    """
+    height, width = reference.shape[:2]
+    factor = (REFERENCE_PIXELS / float(height * width)) ** 0.5
+    if factor < 1:
+        reference = cv2.resize(reference, (max(1, round(width * factor)), max(1, round(height * factor))),
+                               interpolation=cv2.INTER_AREA)
+    lab = cv2.cvtColor(reference, cv2.COLOR_RGB2LAB).reshape(-1, 3)
+    lightness = lab[:, 0]
+    counts = np.bincount(lightness, minlength=256)
+    used = np.flatnonzero(counts >= MIN_BIN_PIXELS)
+    if used.size == 0:
+        raise ValueError("Reference photo has too few pixels to learn a tint from")
+
+    levels = np.arange(256)
+    curves = []
+    for channel in (1, 2):
+        sums = np.bincount(lightness, weights=lab[:, channel], minlength=256)
+        means = np.interp(levels, used, sums[used] / counts[used])
+        padded = np.pad(means, SMOOTHING // 2, mode='edge')
+        smoothed = np.convolve(padded, np.ones(SMOOTHING) / SMOOTHING, mode='valid')
+        curves.append(np.clip(np.rint(smoothed), 0, 255).astype(np.uint8))
+    return curves[0], curves[1]
+
+
+class TintColorizer:
+    """
+    OpenCV fallback colorization as lookup tables.
+
+    A profile gives each lightness one a/b pair, so the whole mapping from
+    LAB lightness to RGB is a 256-entry table. Colorizing converts the image
+    to LAB, copies L over the a and b planes and runs cv2.LUT in place: no
+    float images, and one image-sized buffer in all. Gray (2D) images skip
+    the LAB conversion, since their lightness is itself a table lookup.
+
+    Profiles: 'sepia' (the original fallback, bit for bit), 'warm', 'cool',
+    and 'reference', which learns the toning of a color photo.
+    """
+
+    def __init__(self, profile: str = DEFAULT_PROFILE, reference: Optional[np.ndarray] = None):
+        """
+        Args:
+            profile: One of PROFILES, or 'reference'
+            reference: RGB photo to learn the 'reference' profile from
+
+        Raises:
+            ValueError: For an unknown profile, or 'reference' without a photo
+        """
+        if profile != REFERENCE and profile not in PROFILES:
+            raise ValueError(f"Unknown tint profile '{profile}'; use one of: "
+                             f"{', '.join(list(PROFILES) + [REFERENCE])}")
+        if profile == REFERENCE and reference is None:
+            raise ValueError("The reference tint profile needs a reference photo")
+
+        self.profile = profile
+        # Built-in profiles are computed with their first table
+        self._curves = learn_curves(reference) if profile == REFERENCE else None
+        self._lock = threading.Lock()
+        self._tables: Dict[str, np.ndarray] = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # CPU worker processes get a copy; locks do not pickle
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "TintColorizer":
+        """
+        Build from PHOTO_TINT_PROFILE and PHOTO_TINT_REFERENCE (a photo,
+        which selects the 'reference' profile); falls back to sepia when the
+        settings are unusable
+        """
+        reference_path = os.environ.get('PHOTO_TINT_REFERENCE')
+        profile = os.environ.get('PHOTO_TINT_PROFILE', REFERENCE if reference_path else DEFAULT_PROFILE)
+        reference = None
+        if profile == REFERENCE and reference_path:
+            bgr = cv2.imread(reference_path, cv2.IMREAD_COLOR)
+            if bgr is not None:
+                reference = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        try:
+            return cls(profile, reference)
+        except ValueError as e:
+            logger.warning(f"{str(e)}; using the {DEFAULT_PROFILE} tint")
+            return cls(DEFAULT_PROFILE)
+
+    @property
+    def key(self) -> str:
+        """Identifies the profile's output for cache keys"""
+        if self.profile != REFERENCE:
+            return self.profile
+        return f"{REFERENCE}:{hashlib.sha1(b''.join(c.tobytes() for c in self._curves)).hexdigest()[:12]}"
+
+    def _table(self, name: str) -> np.ndarray:
+        with self._lock:
+            table = self._tables.get(name)
+            if table is None:
+                table = self._build(name)
+                self._tables[name] = table
+            return table
+
+    def _build(self, name: str) -> np.ndarray:
+        levels = np.arange(256, dtype=np.uint8)
+        a, b = self._curves if self._curves is not None else profile_curves(self.profile)
+        # Lightness -> RGB, converted by OpenCV exactly as full images are
+        lab = np.stack([levels, a, b], axis=-1).reshape(1, 256, 3)
+        rgb = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+        if name == 'lightness':
+            return rgb
+        # Gray level -> RGB: a gray pixel's lightness, then the tint
+        gray = np.repeat(levels, 3).reshape(1, 256, 3)
+        lightness = cv2.cvtColor(gray, cv2.COLOR_RGB2LAB)[0, :, 0]
+        return rgb[:, lightness]
+
+    def colorize(self, image: np.ndarray, lab: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Tint a monochrome image
+
+        Args:
+            image: RGB or single-channel gray uint8 image
+            lab: The image already in LAB, if at hand; it is overwritten
+
+        Returns:
+            The tinted RGB image
+        """
+        if image.ndim == 2:
+            rgb = cv2.merge((image, image, image))
+            return cv2.LUT(rgb, self._table('gray'), dst=rgb)
+        if lab is None:
+            lab = cv2.cvtColor(image, cv2.COLOR_RGB2LAB)
+        cv2.mixChannels([lab], [lab], [0, 1, 0, 2])
+        return cv2.LUT(lab, self._table('lightness'), dst=lab)
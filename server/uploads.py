@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from typing import BinaryIO, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'uploads')
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the configured size limit"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"File size must be less than {limit // (1024 * 1024)}MB")
+        self.limit = limit
+
+
+def max_upload_bytes() -> int:
+    """Upload size limit from PHOTO_MAX_UPLOAD_MB (default 100)"""
+    return int(float(os.environ.get('PHOTO_MAX_UPLOAD_MB', '100')) * 1024 * 1024)
+
+
+class SpooledUpload:
+    """
+    An upload copied to a temporary file on disk.
+
+    The content hash is computed while copying, so the pipeline can key its
+    cache without reading the file again. The file is deleted on close()
+    unless it has been moved elsewhere.
+    """
+
+    def __init__(self, path: str, size: int, digest: str, filename: Optional[str]):
+        self.path = path
+        self.size = size
+        self.digest = digest
+        self.filename = filename
+
+    def close(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self) -> "SpooledUpload":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _spool(source: BinaryIO, filename: Optional[str], directory: str, max_bytes: int,
+           chunk_size: int) -> SpooledUpload:
+    os.makedirs(directory, exist_ok=True)
+    suffix = os.path.splitext(filename or '')[1][:16]
+    fd, path = tempfile.mkstemp(prefix='upload-', suffix=suffix, dir=directory)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                hasher.update(chunk)
+                target.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return SpooledUpload(path, size, hasher.hexdigest(), filename)
+
+
+def spool_file(source: BinaryIO, filename: Optional[str], max_bytes: Optional[int] = None,
+               directory: Optional[str] = None, chunk_size: int = 1024 * 1024) -> SpooledUpload:
+    """
+    Copy a file object to disk from its start; the blocking counterpart of spool_upload()
+
+    Raises:
+        UploadTooLarge: If the file is larger than max_bytes
+    """
+    if max_bytes is None:
+        max_bytes = max_upload_bytes()
+    directory = directory or os.environ.get('PHOTO_UPLOAD_DIR', DEFAULT_UPLOAD_DIR)
+    source.seek(0)
+    return _spool(source, filename, directory, max_bytes, chunk_size)
+
+
+async def spool_upload(file, max_bytes: Optional[int] = None, directory: Optional[str] = None,
+                       chunk_size: int = 1024 * 1024) -> SpooledUpload:
+    """
+    Copy an UploadFile to disk in chunks, enforcing the size limit as it goes
+
+    Args:
+        file: FastAPI UploadFile
+        max_bytes: Size limit (defaults to PHOTO_MAX_UPLOAD_MB)
+        directory: Spool directory (defaults to PHOTO_UPLOAD_DIR or server/data/uploads)
+        chunk_size: Bytes copied at a time
+
+    Raises:
+        UploadTooLarge: If the upload is larger than max_bytes
+    """
+    if max_bytes is None:
+        max_bytes = max_upload_bytes()
+    if getattr(file, 'size', None) is not None and file.size > max_bytes:
+        raise UploadTooLarge(max_bytes)
+    directory = directory or os.environ.get('PHOTO_UPLOAD_DIR', DEFAULT_UPLOAD_DIR)
+
+    await file.seek(0)
+    upload = await asyncio.to_thread(_spool, file.file, file.filename, directory, max_bytes, chunk_size)
+    logger.info(f"Spooled upload {file.filename}: {upload.size} bytes")
+    return upload